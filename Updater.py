@@ -38,7 +38,10 @@ class Updater(multiprocessing.Process):
 
         self.image_processing_mode = config['main image processing']['image_processing_mode']
         self.motion_with_feedback = bool(int(config['main image processing']['motion_with_feedback']))
-        self.num_pixel_threshold = int(config['image delta']['num_pixel_threshold'])
+        if self.image_processing_mode in ('background subtraction', 'motion vectors'):
+            self.num_pixel_threshold = int(config[self.image_processing_mode]['num_pixel_threshold'])
+        else:
+            self.num_pixel_threshold = int(config['image delta']['num_pixel_threshold'])
         self.nn_motion_thresh = float(config['neural net']['nn_distance_thresh'])
         self.nn_count_eggs = bool(int(config['neural net']['nn_count_eggs']))
         self.max_difference = max_difference
@@ -101,16 +104,18 @@ class Updater(multiprocessing.Process):
                 motion_list = deepcopy(self.motion_list[:])
                 self.motion_list[:] = []
             # use motion list to decide whether to turn the leds on
-            if self.image_processing_mode == 'image delta':
+            if self.image_processing_mode in ('image delta', 'background subtraction', 'motion vectors'):
+                # both modes give a number of changed pixels per image
                 next_params['opto_on'] = self.image_delta_motion_decision(motion_list)
 
             elif self.image_processing_mode == 'neural net':
                 next_params['opto_on'] = self.neural_net_motion_decision(motion_list)
                 if self.nn_count_eggs:
                     with self.egg_count_list_lock:
-                        egg_count = mean(self.egg_count_list[:])
-                        self.data['egg_count'] = egg_count
+                        egg_counts = self.egg_count_list[:]
                         self.egg_count_list.clear()
+                    # eggs are counted less often than the worm is located, so there may not be a count this time
+                    self.data['egg_count'] = float(mean(egg_counts)) if egg_counts else 'None'
 
             self.data['motion'] = self.motion_average
             self.data['opto_on'] = next_params['opto_on']
@@ -202,13 +207,17 @@ class Updater(multiprocessing.Process):
         Logger.debug('Upload: Source folder %s' % source)
         Logger.debug('Upload: Destination folder %s' % dest)
         try:
-            p = Popen(["rclone", "copy", source, dest])
+            # videos that are still being written or remuxed end in .tmp
+            p = Popen(["rclone", "copy", "--exclude", "*.tmp", source, dest])
             p.wait(timeout=50)
         except OSError:
             Logger.debug('Updater: Cannot upload videos to remote')
         except TimeoutExpired:
             p.kill()
-        ManageLocalFiles.cleanup_files(source, join(self.remote_savepath, 'videos'), self.rclone_name)
+        # segments.csv gets a row for every video segment until the experiment ends, so it stays on the SD card like
+        # data.h5 - deleted, it would be started again with only the newest rows and overwrite the remote copy
+        ManageLocalFiles.cleanup_files(source, join(self.remote_savepath, 'videos'), self.rclone_name,
+                                       exclude_ext='segments.csv')
 
         # upload image folder
         source = join(self.local_savepath, 'images/')
@@ -216,18 +225,22 @@ class Updater(multiprocessing.Process):
         Logger.debug('Upload: Source folder %s' % source)
         Logger.debug('Upload: Destination folder %s' % dest)
         try:
-            p = Popen(["rclone", "copy", source, dest])
+            # image stacks that are still being written end in .tmp
+            p = Popen(["rclone", "copy", "--exclude", "*.tmp", source, dest])
             p.wait(timeout=50)
         except OSError:
             Logger.debug('Updater: Cannot upload images to remote')
         except TimeoutExpired:
             p.kill()
-        # while experiment is running, don't delete .h5 file! it will only exist if user chooses to save processed data
-        # from neural net processing
+        # while experiment is running, don't delete data.h5 file! it will only exist if user chooses to save processed
+        # data from neural net processing. The same goes for tracks.csv and arenas.csv, which the multi-worm tracker
+        # and the arena log keep appending to - deleting them would lose every row written before the upload. Only
+        # files directly in the images folder are cleaned up, so uploaded image stacks (in unprocessed/ and
+        # processed/) stay on the SD card
         ManageLocalFiles.cleanup_files(source,
                                        join(self.remote_savepath, 'images'),
                                        self.rclone_name,
-                                       exclude_ext='.h5')
+                                       exclude_ext=('data.h5', 'tracks.csv', 'arenas.csv'))
 
     def neural_net_motion_decision(self, motion_list):
         # set up a default opto_on to return
@@ -0,0 +1,30 @@
+"""
+Times DeltaKernel against delta_movement on 640x480 frames. Run from the top of the repository:
+
+    python3 -m benchmarks.delta_kernel
+"""
+import timeit
+
+import cv2
+import numpy as np
+
+from imageProcessing.image_processing import DeltaKernel, delta_movement
+
+
+def main(repeat=5, number=200):
+    rng = np.random.default_rng(0)
+    im1 = cv2.GaussianBlur(rng.integers(0, 256, (480, 640), dtype=np.uint8), (5, 5), 0)
+    im2 = np.roll(im1, 3, axis=1)
+    imaging_parameters = {'strel': cv2.getStructuringElement(cv2.MORPH_CROSS, (5, 5)),
+                          'delta_threshold': 10,
+                          'save_processed_images': False}
+    kernel = DeltaKernel(imaging_parameters)
+    assert kernel(im1, im2, 1) == delta_movement(im1, im2, 1, imaging_parameters)
+    old = min(timeit.repeat(lambda: delta_movement(im1, im2, 1, imaging_parameters), repeat=repeat, number=number))
+    new = min(timeit.repeat(lambda: kernel(im1, im2, 1), repeat=repeat, number=number))
+    print('delta_movement: %.3f ms per frame' % (old / number * 1000))
+    print('DeltaKernel:    %.3f ms per frame (%.1fx faster)' % (new / number * 1000, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+import math
+import time
+
+from kivy.logger import Logger
+
+
+class Sink:
+    """
+    Something an AcquisitionScheduler drives: video to disk, a live stream, image analysis... Every method is
+    optional. poll() is called after every wait and may raise to report a camera error; rollover(), pause() and
+    resume() mark the end of a video, the start of an inter-video interval and the start of the next video;
+    sample() is called every sample_period seconds if that's set (once start() has run). suspend() and reattach()
+    are called around a camera restart (see CameraSupervisor) and by default stop and start the sink; sinks that
+    keep state, like an open video file or an analysis pool, should only let go of the old camera and pick up the
+    new one. suspend() may be called again before reattach().
+    """
+    sample_period = None
+
+    def start(self):
+        pass
+
+    def suspend(self):
+        self.stop()
+
+    def reattach(self):
+        self.start()
+
+    def poll(self):
+        pass
+
+    def rollover(self):
+        pass
+
+    def pause(self):
+        pass
+
+    def resume(self):
+        pass
+
+    def sample(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class Lateness:
+    """ How late events of one kind ran after their deadlines. """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.worst = 0
+        self.skipped = 0
+
+    def add(self, lateness):
+        self.count += 1
+        self.total += lateness
+        self.worst = max(self.worst, lateness)
+
+    def summary(self):
+        mean = self.total / self.count if self.count else 0
+        return '%s events, %.1f ms late on average (worst %.1f ms), %s skipped' % (
+            self.count, mean * 1000, self.worst * 1000, self.skipped)
+
+
+class AcquisitionScheduler:
+    """
+    Runs an acquisition from absolute deadlines on a monotonic clock. Videos roll over every video_length seconds
+    from the start (or pause for inter_video_interval seconds in between), and sinks with a sample_period are sampled
+    on their own fixed grid starting straight away. Every deadline is worked out from the start time rather than from
+    when the last event ran, so the time taken by captures and logging never adds up to drift; an event that is a
+    whole period or more late skips the deadlines it missed. wait(timeout) is called between events (at most max_wait
+    seconds at a time, so done() is checked regularly) and should raise if the camera fails. How late every event
+    ran is logged, and summarised when the acquisition ends.
+    """
+
+    def __init__(self, sinks, video_length, inter_video_interval, wait, max_wait=1, clock=time.monotonic):
+        self.sinks = sinks
+        self.video_length = video_length
+        self.inter_video_interval = inter_video_interval
+        self.wait = wait
+        self.max_wait = max_wait
+        self.clock = clock
+        self.lateness = {'video': Lateness(), 'sample': Lateness()}
+        self.start = None
+        self.paused = False
+
+    def run(self, done):
+        """ Run until done() returns True. May be called again, e.g. after the camera has been restarted. """
+        now = self.clock()
+        if self.start is None:
+            self.start = now
+        video_deadline, paused = self.video_phase(now)
+        if paused != self.paused:
+            # a pause started or ended while the camera was down
+            self.call('pause' if paused else 'resume')
+            self.paused = paused
+        sample_deadlines = {sink: self.sample_phase(now, sink.sample_period) for sink in self.sinks
+                            if sink.sample_period}
+        while not done():
+            deadline = min([video_deadline] + list(sample_deadlines.values()))
+            self.wait(min(max(deadline - self.clock(), 0), self.max_wait))
+            for sink in self.sinks:
+                sink.poll()
+
+            now = self.clock()
+            if now >= video_deadline:
+                self.ran('video', now - video_deadline)
+                if self.inter_video_interval <= 0:
+                    self.call('rollover')
+                    period = self.video_length
+                elif not self.paused:
+                    self.call('pause')
+                    period = self.inter_video_interval
+                else:
+                    self.call('resume')
+                    period = self.video_length
+                self.paused = self.inter_video_interval > 0 and not self.paused
+                # deadlines missed are skipped a whole video and interval at a time, so pauses and resumes alternate
+                video_deadline = self.next_deadline('video', video_deadline, period,
+                                                    self.video_length + max(self.inter_video_interval, 0))
+
+            for sink, due in sample_deadlines.items():
+                if now >= due:
+                    self.ran('sample', now - due)
+                    sink.sample()
+                    sample_deadlines[sink] = self.next_deadline('sample', due, sink.sample_period)
+
+        for kind, lateness in self.lateness.items():
+            if lateness.count:
+                Logger.info('AcquisitionScheduler: %s: %s' % (kind, lateness.summary()))
+
+    def video_phase(self, now):
+        """ The next video deadline on the schedule after now, and whether the video is paused until then. """
+        elapsed = now - self.start
+        if self.inter_video_interval <= 0:
+            return self.start + (elapsed // self.video_length + 1) * self.video_length, False
+        cycle = self.video_length + self.inter_video_interval
+        cycles, position = divmod(elapsed, cycle)
+        video_start = self.start + cycles * cycle
+        if position < self.video_length:
+            return video_start + self.video_length, False
+        return video_start + cycle, True
+
+    def sample_phase(self, now, period):
+        """ The first sample deadline on the grid that isn't before now (the start time, on the first run). """
+        return self.start + math.ceil((now - self.start) / period) * period
+
+    def call(self, method):
+        for sink in self.sinks:
+            getattr(sink, method)()
+
+    def ran(self, kind, lateness):
+        self.lateness[kind].add(lateness)
+        Logger.debug('AcquisitionScheduler: %s event ran %.1f ms late' % (kind, lateness * 1000))
+
+    def next_deadline(self, kind, deadline, period, cycle=None):
+        cycle = cycle or period
+        deadline += period
+        now = self.clock()
+        if deadline <= now:
+            # stay on the original grid rather than restarting it from now
+            missed = int((now - deadline) // cycle) + 1
+            self.lateness[kind].skipped += missed
+            deadline += missed * cycle
+            Logger.info('AcquisitionScheduler: running behind, skipped %s %s deadlines' % (missed, kind))
+        return deadline
+
+
+class CameraSupervisor:
+    """
+    Restarts the camera when it fails during an acquisition, as a small state machine. It's 'running' until recover()
+    is called with the error, then 'restarting': the sinks are suspended, which closes the partly recorded video
+    segment, reopen() replaces the camera and the sinks are reattached to it. A failed attempt is retried after
+    backoff seconds, doubling each time up to max_backoff, and after max_retries failed attempts the supervisor gives
+    up and is 'failed'. errors are the exception types a restart attempt can fail with. Every restart's latency is
+    logged, and summary() gives the totals.
+    """
+
+    def __init__(self, sinks, reopen, errors, max_retries=5, backoff=1, max_backoff=30, sleep=time.sleep,
+                 clock=time.monotonic):
+        self.sinks = sinks
+        self.reopen = reopen
+        self.errors = errors
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.clock = clock
+        self.state = 'running'
+        self.restarts = 0
+        self.downtime = 0
+
+    def recover(self, err):
+        """ Restart the camera after err. Returns True once it's recording again, or False if it couldn't be. """
+        self.state = 'restarting'
+        began = self.clock()
+        Logger.warning('CameraSupervisor: camera error, restarting the camera: %s' % err)
+        for attempt in range(self.max_retries):
+            if attempt:
+                self.sleep(min(self.backoff * 2 ** (attempt - 1), self.max_backoff))
+            self.suspend()
+            try:
+                self.reopen()
+                for sink in self.sinks:
+                    sink.reattach()
+            except self.errors as retry_err:
+                Logger.warning('CameraSupervisor: restart attempt %s of %s failed: %s' % (attempt + 1,
+                                                                                          self.max_retries, retry_err))
+                continue
+            latency = self.clock() - began
+            self.restarts += 1
+            self.downtime += latency
+            self.state = 'running'
+            Logger.info('CameraSupervisor: camera restarted in %.2f s (attempt %s)' % (latency, attempt + 1))
+            return True
+        self.state = 'failed'
+        Logger.error('CameraSupervisor: giving up after %s failed restart attempts' % self.max_retries)
+        return False
+
+    def suspend(self):
+        for sink in reversed(self.sinks):
+            try:
+                sink.suspend()
+            except self.errors as err:
+                Logger.info('CameraSupervisor: unable to suspend %s cleanly: %s' % (type(sink).__name__, err))
+
+    def summary(self):
+        return '%s camera restarts, %.1f s without a camera' % (self.restarts, self.downtime)
@@ -1,3 +1,4 @@
+import os
 import time
 from datetime import datetime
 from os.path import join
@@ -11,7 +12,15 @@ import cv2
 import numpy as np
 import math
 
-from imageProcessing.image_processing import ProcessorPool, CurrentImage, delta_movement
+from imageProcessing.image_processing import ProcessorPool, CurrentImage, LumaStreamOutput, MotionVectorAnalysis, \
+    delta_movement, arena_boxes
+from imageProcessing.motion_vectors import parse_roi
+from imageProcessing.process_pool import SharedMemoryProcessorPool
+from imageProcessing.inference_backends import model_input_size
+from hardwareSupport.segment_writer import SegmentWriter, DiscardOutput
+from hardwareSupport.remuxer import Remuxer
+from hardwareSupport.acquisition import AcquisitionScheduler, CameraSupervisor, Sink
+from hardwareSupport.preview_server import PreviewFrames, PreviewServer, MJPEGPreviewOutput, OverlayPreviewOutput
 
 try:
     import picamera
@@ -21,11 +30,205 @@ except ImportError:
     raise
 
 
+# splitter ports of the h264 recording saved to disk, the live stream, analysis captures and the local preview
+VIDEO_PORT = 1
+STREAM_PORT = 3
+CAPTURE_PORT = 0
+PREVIEW_PORT = 2
+# JPEG quality of preview frames
+PREVIEW_QUALITY = 50
+
+
 def build_stream_command(fps, youtube_link, youtube_key):
     stream_cmd = 'ffmpeg -ar 44100 -ac 2 -acodec pcm_s16le -f s16le -ac 2 -i /dev/zero -f h264 -r %s -i - -c:v copy -c:a aac -ab 128k -strict experimental -f flv -r %s %s%s ' % (fps, fps, youtube_link, youtube_key)
     return stream_cmd
 
 
+class VideoSink(Sink):
+    """ Records video to disk in segments (see SegmentWriter). """
+
+    def __init__(self, camera_support):
+        self.camera_support = camera_support
+
+    def start(self):
+        self.camera_support.start_video()
+
+    def rollover(self):
+        self.camera_support.next_video()
+
+    def pause(self):
+        self.camera_support.pause_video()
+
+    def resume(self):
+        self.camera_support.next_video()
+
+    def suspend(self):
+        self.camera_support.suspend_video()
+
+    def reattach(self):
+        self.camera_support.reattach_video()
+
+    def stop(self):
+        self.camera_support.stop_video()
+
+
+class StreamSink(Sink):
+    """
+    Streams video to youtube through ffmpeg. If the stream fails (usually a bad youtube link or key), it's stopped
+    and recording to disk carries on.
+    """
+
+    def __init__(self, camera_support):
+        self.camera_support = camera_support
+        self.stream_pipe = None
+        self.streaming = False
+        # streaming when the camera failed, so the stream is picked up again on the new camera
+        self.resume_stream = False
+
+    def start(self):
+        camera_support = self.camera_support
+        if self.stream_pipe is None:
+            stream_cmd = build_stream_command(camera_support.fps, camera_support.youtube_link,
+                                              camera_support.youtube_key)
+            self.stream_pipe = subprocess.Popen(stream_cmd, shell=True, stdin=subprocess.PIPE)
+        camera_support.camera.start_recording(self.stream_pipe.stdin, format='h264', bitrate=2000000,
+                                              splitter_port=STREAM_PORT)
+        self.streaming = True
+
+    def poll(self):
+        if not self.streaming:
+            return
+        try:
+            # raises whatever stopped the stream's encoder, without waiting
+            self.camera_support.camera.wait_recording(0, splitter_port=STREAM_PORT)
+        except BrokenPipeError:
+            Logger.warning('Streaming: Your youtube link or youtube key is likely invalid')
+            self.streaming = False
+            try:
+                self.camera_support.camera.stop_recording(splitter_port=STREAM_PORT)
+            except BrokenPipeError:
+                pass
+        except picamera.PiCameraNotRecording:
+            self.streaming = False
+
+    def suspend(self):
+        # ffmpeg is kept running, so the stream carries on where it left off
+        if self.streaming:
+            self.streaming = False
+            self.resume_stream = True
+            try:
+                self.camera_support.camera.stop_recording(splitter_port=STREAM_PORT)
+            except (picamera.PiCameraError, BrokenPipeError):
+                pass
+
+    def reattach(self):
+        if self.resume_stream:
+            self.camera_support.camera.start_recording(self.stream_pipe.stdin, format='h264', bitrate=2000000,
+                                                       splitter_port=STREAM_PORT)
+            self.streaming = True
+            self.resume_stream = False
+
+    def stop(self):
+        if self.stream_pipe is None:
+            return
+        if self.streaming:
+            self.streaming = False
+            try:
+                self.camera_support.camera.stop_recording(splitter_port=STREAM_PORT)
+            except (picamera.PiCameraError, BrokenPipeError):
+                # the stream has already stopped (or the camera couldn't be restarted), and that's fine
+                pass
+        self.stream_pipe.stdin.close()
+        try:
+            self.stream_pipe.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.stream_pipe.kill()
+        self.stream_pipe = None
+
+
+class PreviewSink(Sink):
+    """
+    Serves a small, low frame rate preview over http on the local network (see PreviewServer), from its own splitter
+    port, so rigs can be watched without streaming full video through the internet. If the port is taken, there's
+    no preview and recording carries on.
+    """
+
+    def __init__(self, camera_support):
+        self.camera_support = camera_support
+        self.frames = PreviewFrames()
+        self.server = None
+        self.recording = False
+
+    def start(self):
+        if self.server is None:
+            try:
+                self.server = PreviewServer(self.camera_support.preview_port, self.frames)
+            except OSError as err:
+                Logger.warning('Camera: unable to serve the preview on port %s: %s' % (
+                    self.camera_support.preview_port, err))
+                return
+        self.reattach()
+
+    def reattach(self):
+        camera_support = self.camera_support
+        if self.server is None:
+            return
+        size = camera_support.preview_resolution
+        if camera_support.preview_overlay:
+            output = OverlayPreviewOutput(self.frames, camera_support.preview_fps, size, PREVIEW_QUALITY,
+                                          camera_support.preview_boxes(), camera_support.motion_list,
+                                          camera_support.motion_list_lock)
+            camera_support.camera.start_recording(output, format='bgr', splitter_port=PREVIEW_PORT, resize=size)
+        else:
+            # the camera's own JPEG encoder does the work
+            output = MJPEGPreviewOutput(self.frames, camera_support.preview_fps)
+            camera_support.camera.start_recording(output, format='mjpeg', splitter_port=PREVIEW_PORT, resize=size,
+                                                  quality=PREVIEW_QUALITY)
+        self.recording = True
+
+    def suspend(self):
+        if self.recording:
+            self.recording = False
+            try:
+                self.camera_support.camera.stop_recording(splitter_port=PREVIEW_PORT)
+            except picamera.PiCameraError:
+                pass
+
+    def stop(self):
+        self.suspend()
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+
+class AnalysisSink(Sink):
+    """
+    Online image analysis. Images are captured every image_frequency seconds, unless they come from the yuv stream
+    or the encoder's motion vectors.
+    """
+
+    def __init__(self, camera_support):
+        self.camera_support = camera_support
+
+    def start(self):
+        self.camera_support.start_image_pool()
+        if self.camera_support.capture_images:
+            self.sample_period = self.camera_support.image_frequency
+
+    def sample(self):
+        self.camera_support.capture_image()
+
+    def suspend(self):
+        self.camera_support.stop_luma_stream()
+
+    def reattach(self):
+        # the pool (and its frame numbering) carries on, only the camera's outputs are started again
+        self.camera_support.start_analysis_outputs()
+
+    def stop(self):
+        self.camera_support.stop_image_pool()
+
+
 class CameraSupport(threading.Thread):
 
     def __init__(self, camera, config_file, image_processing_params,
@@ -48,28 +251,59 @@ class CameraSupport(threading.Thread):
         self.resolution = config['camera settings']['resolution']
         self.gain = config['camera settings']['gain']
         self.inter_video_interval = int(config['camera settings']['inter_video_interval'])
+        self.remux_videos = bool(int(config['camera settings']['remux_videos']))
+        self.restart_retries = int(config['camera settings']['restart_retries'])
+        self.restart_backoff = float(config['camera settings']['restart_backoff'])
 
         self.webstream = bool(int(config['webstreaming']['do_webstream']))
         self.youtube_link = config['webstreaming']['youtube_link']
         self.youtube_key = config['webstreaming']['youtube_key']
+        self.preview = bool(int(config['webstreaming']['do_preview']))
+        self.preview_port = int(config['webstreaming']['preview_port'])
+        # rounded up to a multiple of 32 x 16, the size the camera pads unencoded frames to
+        width, height = (int(i) for i in config['webstreaming']['preview_resolution'].split('x'))
+        self.preview_resolution = ((width + 31) & ~31, (height + 15) & ~15)
+        self.preview_fps = float(config['webstreaming']['preview_fps'])
+        self.preview_overlay = bool(int(config['webstreaming']['preview_overlay']))
 
         self.image_processing_params = image_processing_params
         self.image_processing_mode = config['main image processing']['image_processing_mode']
         if self.image_processing_mode == 'neural net':
-            # reduce size of image to try to save memory - since tensorflow will resize anyway
-            width, height = self.image_processing_params['image_resolution']
-            new_width = 1024
-            new_height = int((new_width / width) * height)
-            self.image_processing_params['image_resolution'] = new_width, new_height
+            # capture images at the size the model scales them to, so the camera's hardware resizer does that work.
+            # Worm locations are still reported in pixels of the configured image resolution
+            resolution = self.image_processing_params['image_resolution']
+            self.image_processing_params['output_resolution'] = resolution
+            input_size = model_input_size(self.image_processing_params['nn_backend'],
+                                          join(os.getcwd(), 'neural_net'), resolution)
+            if input_size is None:
+                # reduce size of image to try to save memory - since tensorflow will resize anyway
+                width, height = resolution
+                new_width = 1024
+                input_size = new_width, int((new_width / width) * height)
+            Logger.info('Camera: neural net images will be captured at %sx%s' % input_size)
+            self.image_processing_params['image_resolution'] = input_size
         self.image_processing_params['nn_count_eggs'] = bool(int(config['neural net']['nn_count_eggs']))
         self.img_pool = None
 
-        self.image_frequency = int(config['main image processing']['image_frequency'])
+        # in seconds - may be a fraction of a second when analysis frames come from a continuous yuv stream
+        self.image_frequency = float(config['main image processing']['image_frequency'])
+        self.capture_mode = config['main image processing']['capture_mode']
+        self.pool_backend = config['main image processing']['pool_backend']
+        self.pool_size = int(config['main image processing']['pool_size'])
+        self.luma_output = None
+        # encoder motion vector output for 'motion vectors' mode
+        self.mv_output = None
+        # whether analysis images are taken with camera.capture() (rather than coming from a stream)
+        self.capture_images = False
         self.hc_image_frequency = int(config['LED matrix']['hc_image_frequency'])
         self.timelapse_option = timelapse_option
 
         self.save_dir = config['experiment settings']['local_exp_path']
         self.video_save_dir = join(self.save_dir, 'videos')
+        self.segments = None
+        # the output the video recording is currently going to, and whether that's between videos
+        self.video_output = None
+        self.video_paused = False
         self.image_processing_params['img_dir'] = join(self.save_dir, 'images')
         self.video_length = video_length
 
@@ -97,17 +331,19 @@ class CameraSupport(threading.Thread):
     def run(self):
 
         if self.timelapse_option == 'None':
-            if not self.webstream and self.image_processing_mode == 'None':
-                self.video_only()
-
-            elif self.webstream and self.image_processing_mode == 'None':
-                self.video_and_webstream()
-
-            elif self.image_processing_mode != 'None' and not self.webstream:
-                self.video_and_motion()
-
-            elif self.webstream and self.image_processing_mode != 'None':
-                self.video_and_motion_and_webstream()
+            # analysis is started first, since the video recording carries its motion vector output
+            sinks = []
+            if self.image_processing_mode != 'None':
+                Logger.info('Camera: local motion detection')
+                sinks.append(AnalysisSink(self))
+            sinks.append(VideoSink(self))
+            if self.webstream:
+                Logger.info('Camera: youtube livestream')
+                sinks.append(StreamSink(self))
+            if self.preview:
+                Logger.info('Camera: local preview')
+                sinks.append(PreviewSink(self))
+            self.record(sinks)
 
         elif self.timelapse_option == 'linescan':
             self.linescan_timelapse()
@@ -117,284 +353,176 @@ class CameraSupport(threading.Thread):
 
         return
 
-    def video_only(self):
-        Logger.info('Camera: Video capture only')
-        # record a sequence of videos until the end of the experiment
-        with picamera.PiCameraCircularIO(self.camera, seconds=self.video_length, splitter_port=2) as stream:
-            self.camera.start_recording(stream, format='h264', splitter_port=2)
-            try:
-                start_time = time.time()
-                Logger.info('Camera: recording started, start time is: %s' % start_time)
-                while not self.is_exp_done() and not self.stop_cam_event.is_set():
-                    self.camera.wait_recording(self.video_length, splitter_port=2)
-                    timestr = time.strftime("%Y%m%d_%H%M%S")
-                    videofile = "VID_{}.h264".format(timestr)
-                    videopath = join(self.video_save_dir, videofile)
-                    stream.copy_to(videopath)
-                    stream.clear()
-                    time.sleep(self.inter_video_interval)
-            except picamera.PiCameraError:
-                # if for whatever reason the picamera has some sort of error, close the camera and restart the function!
-                Logger.info('Camera: PiCamera error, re-starting camera')
-                if self.camera is not None:
-                    self.camera.close()
-                # set resolution and fps
-                self.camera = picamera.PiCamera(resolution=self.resolution)
-                self.camera.framerate = int(float(self.fps))
-                self.video_only()
-            finally:
-                # wait a few seconds to make sure everything is wrapped up
-                time.sleep(5)
-                # stop recording gracefully
+    def record(self, sinks):
+        """ Record until the end of the experiment, driving the sinks from an AcquisitionScheduler. """
+        scheduler = AcquisitionScheduler(sinks, self.video_length, self.inter_video_interval,
+                                         lambda timeout: self.camera.wait_recording(timeout, splitter_port=VIDEO_PORT))
+        # if for whatever reason the picamera has some sort of error, the camera is reopened and the sinks carry on
+        # with it, on the same schedule; the experiment only ends early if the camera can't be reopened
+        supervisor = CameraSupervisor(sinks, self.reopen_camera, picamera.PiCameraError,
+                                      max_retries=self.restart_retries, backoff=self.restart_backoff)
+        try:
+            for sink in sinks:
+                sink.start()
+            Logger.info('Camera: recording started, start time is: %s' % time.time())
+            while True:
                 try:
-                    self.camera.stop_recording(splitter_port=2)
-                except picamera.PiCameraNotRecording:
-                    # the splitter port has already stopped recording
-                    pass
-                Logger.info('Camera: recording stopped')
-                self.stop_exp_event.set()
-
-    def video_and_webstream(self):
-        Logger.info('Camera: Video and youtube livestream')
-        stream_cmd = build_stream_command(self.fps, self.youtube_link, self.youtube_key)
-        stream_pipe = subprocess.Popen(stream_cmd, shell=True, stdin=subprocess.PIPE)
-        with picamera.PiCameraCircularIO(self.camera, seconds=self.video_length, splitter_port=2) as stream:
-            self.camera.start_recording(stream, format='h264', splitter_port=2)
-            self.camera.start_recording(stream_pipe.stdin, format='h264', bitrate=2000000, splitter_port=3)
-            try:
-                start_time = time.time()
-                Logger.info('Camera: recording started, start time is: %s' % start_time)
-                while not self.is_exp_done() and not self.stop_cam_event.is_set():
-                    self.camera.wait_recording(self.video_length, splitter_port=2)
-                    # if there's an issue with the stream and it closes,
-                    # just ignore it and continue recording to disk
-                    try:
-                        self.camera.wait_recording(self.video_length, splitter_port=3)
-                    except picamera.PiCameraNotRecording:
-                        pass
-                    timestr = time.strftime("%Y%m%d_%H%M%S")
-                    videofile = "VID_{}.h264".format(timestr)
-                    videopath = join(self.video_save_dir, videofile)
-                    stream.copy_to(videopath)
-                    stream.clear()
-                    time.sleep(self.inter_video_interval)
+                    scheduler.run(self.is_recording_done)
+                    break
+                except picamera.PiCameraError as err:
+                    if not supervisor.recover(err):
+                        break
+        finally:
+            # wait a few seconds to make sure all image processing is wrapped up
+            time.sleep(5)
+            # stop recording gracefully
+            self.stop_sinks(sinks)
+            Logger.info('Camera: recording stopped, %s' % supervisor.summary())
+            self.stop_exp_event.set()
+
+    def preview_boxes(self):
+        """ The motion vector ROI or the analysis arenas, if there are any, in preview pixels. """
+        width, height = self.preview_resolution
+        if self.image_processing_mode == 'motion vectors':
+            # the ROI is in video pixels
+            roi = parse_roi(self.image_processing_params['mv_roi'])
+            boxes = [roi] if roi is not None else []
+            from_width, from_height = self.camera.resolution
+        elif self.image_processing_mode in ('image delta', 'background subtraction'):
+            boxes = arena_boxes(self.image_processing_params) or []
+            from_width, from_height = self.image_processing_params['image_resolution']
+        else:
+            return []
+        return [(x0 * width // from_width, y0 * height // from_height, x1 * width // from_width,
+                 y1 * height // from_height) for x0, y0, x1, y1 in boxes]
 
-            except BrokenPipeError:
-                Logger.warning('Streaming: Your youtube link or youtube key is likely invalid')
-                self.camera.stop_recording(splitter_port=3)
-            except picamera.PiCameraError:
-                # if for whatever reason the picamera has some sort of error, close the camera and restart the function!
-                Logger.info('Camera: PiCamera error, re-starting camera')
-                if self.camera is not None:
-                    self.camera.close()
-                # set resolution and fps
-                self.camera = picamera.PiCamera(resolution=self.resolution)
-                self.camera.framerate = int(float(self.fps))
-                self.video_and_webstream()
-            finally:
-                # wait a few seconds to make sure everything is wrapped up
-                time.sleep(5)
-                # stop recording gracefully
-                try:
-                    self.camera.stop_recording(splitter_port=2)
-                    self.camera.stop_recording(splitter_port=3)
-                except picamera.PiCameraNotRecording:
-                    # the camera is already closed, and that's fine
-                    pass
-                stream_pipe.stdin.close()
-                try:
-                    stream_pipe.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    stream_pipe.kill()
-                Logger.info('Camera: recording stopped')
-                self.stop_exp_event.set()
-
-    def video_and_motion(self):
-        Logger.info('Camera: video and local motion detection')
-        cur_image = CurrentImage(self.image_processing_params)
-        self.img_pool = ProcessorPool(3, cur_image, self.motion_list, self.motion_list_lock,
-                                      self.egg_count_list, self.egg_count_list_lock)
-        with picamera.PiCameraCircularIO(self.camera, seconds=self.video_length, splitter_port=2) as stream:
-            self.camera.start_recording(stream, format='h264', splitter_port=2)
+    def reopen_camera(self):
+        if self.camera is not None:
             try:
-                start_time = time.time()
-                Logger.info('Camera: recording started, start time is: %s' % start_time)
-                self.camera.capture(self.img_pool, format='bgr', splitter_port=3,
-                                    resize=self.image_processing_params['image_resolution'],
-                                    use_video_port=True)
-                Logger.info('Camera: capture at time %s' % time.strftime("%Y%m%d_%H%M%S"))
-                img_counter = 1
-                if self.img_pool.processor is not None:
-                    self.img_pool.frame_queue.put(img_counter)
-                    Logger.debug('Camera: img_counter in frame queue')
-                    self.img_pool.processor.frame_event.set()
-                    Logger.debug('Camera: frame_event set')
-                t_image = 0
-                while not self.is_exp_done() and not self.stop_cam_event.is_set():
-                    Logger.debug('Camera: video recording started')
-                    t_video = 0
-                    while t_video < self.video_length:
-                        self.camera.wait_recording(1, splitter_port=2)
-                        t_video += 1
-                        t_image += 1
-                        if t_image == self.image_frequency:
-                            self.camera.capture(self.img_pool, format='bgr', splitter_port=3,
-                                                resize=self.image_processing_params['image_resolution'],
-                                                use_video_port=True)
-                            Logger.info('Camera: capture while collecting video at time %s' % time.time())
-                            img_counter += 1
-                            if self.img_pool.processor is not None:
-                                self.img_pool.frame_queue.put(img_counter)
-                                Logger.debug('Camera: img_counter in frame queue')
-                                self.img_pool.processor.frame_event.set()
-                                Logger.debug('Camera: frame_event set')
-                            vmem = psutil.virtual_memory()
-                            Logger.debug('Memory usage is %s' % vmem.percent)
-                            t_image = 0
-                    timestr = time.strftime("%Y%m%d_%H%M%S")
-                    videofile = "VID_{}.h264".format(timestr)
-                    videopath = join(self.video_save_dir, videofile)
-                    stream.copy_to(videopath)
-                    stream.clear()
-                    Logger.debug('Camera: video %s collected' % videopath)
-                    t_inter_video = 0
-                    if self.inter_video_interval > 0:
-                        Logger.debug('Camera: start inter-video interval')
-                        while t_inter_video < self.inter_video_interval:
-                            time.sleep(1)
-                            t_image += 1
-                            t_inter_video += 1
-                            if t_image == self.image_frequency:
-                                self.camera.capture(self.img_pool, format='bgr', splitter_port=3,
-                                                    resize=self.image_processing_params['image_resolution'],
-                                                    use_video_port=True)
-                                Logger.info('Camera: capture during inter-video interval at time %s' % time.time())
-                                img_counter += 1
-                                if self.img_pool.processor is not None:
-                                    self.img_pool.frame_queue.put(img_counter)
-                                    # Logger.debug('Camera: img_counter in frame_queue')
-                                    self.img_pool.processor.frame_event.set()
-                                    # Logger.debug('Camera: frame_event set')
-                                vmem = psutil.virtual_memory()
-                                Logger.debug('Memory usage is %s' % vmem.percent)
-                                t_image = 0
-                        Logger.debug('Camera: end inter-video interval')
+                self.camera.close()
+            except picamera.PiCameraError as err:
+                Logger.info('Camera: unable to close the camera cleanly: %s' % err)
+        # set resolution and fps
+        self.camera = picamera.PiCamera(resolution=self.resolution)
+        self.camera.framerate = int(float(self.fps))
 
-            except picamera.PiCameraError:
-                # if for whatever reason the picamera isn't recording, restart the function!
-                Logger.info('Camera: PiCamera error, re-starting camera')
-                if self.camera is not None:
-                    self.camera.close()
-                # set resolution and fps
-                self.camera = picamera.PiCamera(resolution=self.resolution)
-                self.camera.framerate = int(float(self.fps))
-                self.video_and_motion()
-            finally:
-               # wait a few seconds to make sure all image processing is wrapped up
-                time.sleep(5)
-                # stop recording gracefully
-                try:
-                    self.camera.stop_recording(splitter_port=2)
-                except picamera.PiCameraNotRecording:
-                    # the splitter port has already stopped recording
-                    pass
-                Logger.info('Camera: recording stopped')
-                self.img_pool.exit()
-                self.stop_exp_event.set()
-
-    def video_and_motion_and_webstream(self):
-        Logger.info('Camera: video, youtube live stream, and local motion detection')
-        stream_cmd = build_stream_command(self.fps, self.youtube_link, self.youtube_key)
-        stream_pipe = subprocess.Popen(stream_cmd, shell=True, stdin=subprocess.PIPE)
-        cur_image = CurrentImage(self.image_processing_params)
-        self.img_pool = ProcessorPool(3, cur_image, self.motion_list, self.motion_list_lock, self.egg_count_list, self.egg_count_list_lock)
-        with picamera.PiCameraCircularIO(self.camera, seconds=self.video_length, splitter_port=2) as stream:
-            self.camera.start_recording(stream, format='h264', splitter_port=2)
-            self.camera.start_recording(stream_pipe.stdin, format='h264', bitrate=2000000, splitter_port=3)
+    def stop_sinks(self, sinks):
+        for sink in reversed(sinks):
             try:
-                start_time = time.time()
-                Logger.info('Camera: recording started, start time is: %s' % start_time)
-                self.camera.capture(self.img_pool, format='bgr', splitter_port=0,
-                                    resize=self.image_processing_params['image_resolution'],
-                                    use_video_port=True)
-                img_counter = 1
-                if self.img_pool.processor is not None:
-                    self.img_pool.frame_queue.put(img_counter)
-                    self.img_pool.processor.frame_event.set()
-                t_image = 0
-                while not self.is_exp_done() and not self.stop_cam_event.is_set():
-                    t_video = 0
-                    while t_video < self.video_length:
-                        self.camera.wait_recording(1, splitter_port=2)
-                        try:
-                            self.camera.wait_recording(1, splitter_port=3)
-                        except picamera.PiCameraNotRecording:
-                            pass
-                        if t_image == self.image_frequency:
-                            self.camera.capture(self.img_pool, format='bgr', splitter_port=0,
-                                                resize=self.image_processing_params['image_resolution'],
-                                                use_video_port=True)
-                            img_counter += 1
-                            if self.img_pool.processor is not None:
-                                self.img_pool.frame_queue.put(img_counter)
-                                self.img_pool.processor.frame_event.set()
-                            t_image = 0
-                        t_video += 1
-                        t_image += 1
-                    timestr = time.strftime("%Y%m%d_%H%M%S")
-                    videofile = "VID_{}.h264".format(timestr)
-                    videopath = join(self.video_save_dir, videofile)
-                    stream.copy_to(videopath)
-                    stream.clear()
-                    t_inter_video = 0
-                    if self.inter_video_interval > 0:
-                        while t_inter_video < self.inter_video_interval:
-                            time.sleep(1)
-                            t_image += 1
-                            t_inter_video += 1
-                            if t_image == self.image_frequency:
-                                self.camera.capture(self.img_pool, format='bgr', splitter_port=3,
-                                                    resize=self.image_processing_params['image_resolution'],
-                                                    use_video_port=True)
-                                Logger.info('Camera: capture during inter-video interval at time %s' % time.time())
-                                img_counter += 1
-                                if self.img_pool.processor is not None:
-                                    self.img_pool.frame_queue.put(img_counter)
-                                    self.img_pool.processor.frame_event.set()
-                                vmem = psutil.virtual_memory()
-                                Logger.debug('Memory usage is %s' % vmem.percent)
-                                t_image = 0
-
-            except BrokenPipeError:
-                Logger.warning('Streaming: Your youtube link or youtube key is likely invalid')
-                self.camera.stop_recording(splitter_port=3)
+                sink.stop()
             except picamera.PiCameraError as err:
-                # if for whatever reason the picamera isn't recording, restart the function!
-                Logger.info('Camera: PiCamera error, re-starting camera. Error is %s' % err)
-                if self.camera is not None:
-                    self.camera.close()
-                # set resolution and fps
-                self.camera = picamera.PiCamera(resolution=self.resolution)
-                self.camera.framerate = int(float(self.fps))
-                self.video_and_motion_and_webstream()
-            finally:
-                # wait a few seconds to make sure all image processing is wrapped up
-                time.sleep(5)
-                # stop recording gracefully
-                try:
-                    self.camera.stop_recording(splitter_port=2)
-                    self.camera.stop_recording(splitter_port=3)
-                except picamera.PiCameraNotRecording:
-                    # the splitter port has already stopped recording
-                    pass
-                Logger.info('Camera: recording stopped')
-                self.img_pool.exit()
-                stream_pipe.stdin.close()
-                try:
-                    stream_pipe.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    stream_pipe.kill()
-                self.stop_exp_event.set()
+                Logger.info('Camera: unable to stop %s cleanly: %s' % (type(sink).__name__, err))
+
+    def is_recording_done(self):
+        return self.is_exp_done() or self.stop_cam_event.is_set()
+
+    def capture_image(self):
+        self.camera.capture(self.img_pool, format='bgr', splitter_port=CAPTURE_PORT,
+                            resize=self.image_processing_params['image_resolution'], use_video_port=True)
+        Logger.info('Camera: capture at time %s' % time.time())
+        vmem = psutil.virtual_memory()
+        Logger.debug('Memory usage is %s' % vmem.percent)
+
+    def stop_image_pool(self):
+        self.stop_luma_stream()
+        if self.img_pool is not None:
+            self.img_pool.exit()
+            self.img_pool = None
+
+    def start_video(self):
+        """ Start recording video to disk as a series of files (see SegmentWriter). """
+        remuxer = Remuxer(self.fps) if self.remux_videos else None
+        self.segments = SegmentWriter(self.camera, self.video_save_dir, VIDEO_PORT, remuxer=remuxer)
+        self.video_output = self.segments.new_segment()
+        self.video_paused = False
+        self.camera.start_recording(self.video_output, format='h264', splitter_port=VIDEO_PORT,
+                                    motion_output=self.mv_output)
+
+    def next_video(self):
+        # picamera splits at the next keyframe, so no frames are lost between files
+        self.video_output = self.segments.new_segment()
+        self.video_paused = False
+        self.camera.split_recording(self.video_output, splitter_port=VIDEO_PORT)
+
+    def pause_video(self):
+        # video is thrown away until next_video(), but the encoder (and its motion vectors) keeps running
+        self.video_output = DiscardOutput(self.segments)
+        self.video_paused = True
+        self.camera.split_recording(self.video_output, splitter_port=VIDEO_PORT)
+
+    def suspend_video(self):
+        """ Stop recording from a failed camera. The writer is kept, so its remux queue and frame numbers carry on. """
+        if self.video_output is None:
+            return
+        try:
+            self.camera.stop_recording(splitter_port=VIDEO_PORT)
+        except picamera.PiCameraError as err:
+            Logger.debug('Camera: video recording already stopped: %s' % err)
+        # closes the segment so far, unless stopping the recording already did
+        self.video_output.flush()
+        self.video_output = None
+
+    def reattach_video(self):
+        self.segments.restart(self.camera, float(self.fps))
+        self.video_output = DiscardOutput(self.segments) if self.video_paused else self.segments.new_segment()
+        self.camera.start_recording(self.video_output, format='h264', splitter_port=VIDEO_PORT,
+                                    motion_output=self.mv_output)
+
+    def stop_video(self):
+        try:
+            self.camera.stop_recording(splitter_port=VIDEO_PORT)
+        except picamera.PiCameraError as err:
+            # the splitter port has already stopped recording, or the camera couldn't be restarted
+            Logger.debug('Camera: video recording already stopped: %s' % err)
+        self.video_output = None
+        if self.segments is not None:
+            self.segments.close()
+
+    def start_image_pool(self):
+        if self.image_processing_mode == 'motion vectors':
+            # the encoder does the work, so there are no images to capture or pool to process them
+            self.start_analysis_outputs()
+            Logger.info('Camera: analysing encoder motion vectors')
+            return
+        cur_image = CurrentImage(self.image_processing_params)
+        # analysis frames either come from a continuous, resized yuv recording, of which only the luma plane is kept
+        # (so no BGR->gray conversion is needed downstream), or from one bgr capture() per sample
+        channels = 1 if self.capture_mode == 'yuv stream' else 3
+        if self.pool_backend == 'processes' and self.image_processing_mode == 'image delta' and \
+                not self.image_processing_params['use_roi'] and cur_image.arenas is None:
+            self.img_pool = SharedMemoryProcessorPool(self.pool_size, cur_image, self.motion_list,
+                                                      self.motion_list_lock, self.egg_count_list,
+                                                      self.egg_count_list_lock, channels=channels)
+        else:
+            if self.pool_backend == 'processes':
+                Logger.info('Camera: process pool only supports image delta without an ROI or arenas, '
+                            'using threads')
+            self.img_pool = ProcessorPool(self.pool_size, cur_image, self.motion_list, self.motion_list_lock,
+                                          self.egg_count_list, self.egg_count_list_lock, channels=channels)
+        if self.capture_mode == 'yuv stream':
+            self.start_analysis_outputs()
+            Logger.info('Camera: yuv analysis stream started, sampling every %s seconds' % self.image_frequency)
+        else:
+            self.capture_images = True
+
+    def start_analysis_outputs(self):
+        """ Connect analysis to the camera: the encoder's motion vector output, or the yuv stream into the pool. """
+        if self.image_processing_mode == 'motion vectors':
+            self.mv_output = MotionVectorAnalysis(self.camera, self.motion_list, self.motion_list_lock,
+                                                  self.image_processing_params)
+        elif self.capture_mode == 'yuv stream':
+            self.luma_output = LumaStreamOutput(self.img_pool, self.image_frequency)
+            self.camera.start_recording(self.luma_output, format='yuv', splitter_port=0,
+                                        resize=self.image_processing_params['image_resolution'])
+
+    def stop_luma_stream(self):
+        if self.luma_output is not None:
+            try:
+                self.camera.stop_recording(splitter_port=0)
+            except picamera.PiCameraError:
+                # not recording, or the camera has failed
+                pass
+            self.luma_output = None
 
     def calibrate_brightness(self):
         # figure out the size of the numpy matrix to capture to
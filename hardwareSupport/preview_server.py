@@ -0,0 +1,217 @@
+import socketserver
+import threading
+import time
+from http import server
+
+import cv2
+import numpy as np
+from kivy.logger import Logger
+
+PAGE = b"""<html>
+<head><title>mi-pi preview</title></head>
+<body style="margin: 0; background: black">
+<img src="stream.mjpg" style="width: 100%; height: 100%; object-fit: contain">
+</body>
+</html>
+"""
+BOUNDARY = 'FRAME'
+
+
+class PreviewFrames:
+    """
+    The latest preview JPEG, shared by every viewer. Frames are published by a camera output and sent as they are
+    to however many viewers are connected, so nothing is ever encoded per viewer. While nobody is watching,
+    outputs skip their frames altogether.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.frame = None
+        self.frame_no = 0
+        self.viewers = 0
+
+    def publish(self, jpeg):
+        with self.condition:
+            self.frame = jpeg
+            self.frame_no += 1
+            self.condition.notify_all()
+
+    def wait(self, last_frame_no, timeout):
+        """ Wait for a frame newer than last_frame_no. Returns (frame_no, jpeg), which may be old on a timeout. """
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame_no != last_frame_no, timeout)
+            return self.frame_no, self.frame
+
+    def add_viewer(self, max_viewers):
+        """ Returns False if there are already max_viewers. """
+        with self.condition:
+            if self.viewers >= max_viewers:
+                return False
+            self.viewers += 1
+            return True
+
+    def remove_viewer(self):
+        with self.condition:
+            self.viewers -= 1
+
+
+class PreviewOutput:
+    """ Base for the preview's picamera custom outputs, which keep at most fps frames a second while anyone watches. """
+
+    def __init__(self, frames, fps):
+        self.frames = frames
+        self.interval = 1 / fps
+        self.next_frame = None
+
+    def due(self):
+        if not self.frames.viewers:
+            return False
+        now = time.monotonic()
+        if self.next_frame is not None and now < self.next_frame:
+            return False
+        # schedule against the previous deadline rather than now, so the frame rate doesn't drift
+        self.next_frame = now + self.interval if self.next_frame is None else self.next_frame + self.interval
+        if self.next_frame < now:
+            self.next_frame = now + self.interval
+        return True
+
+    def flush(self):
+        pass
+
+
+class MJPEGPreviewOutput(PreviewOutput):
+    """
+    Output for an 'mjpeg' recording. The camera's hardware encoder makes the JPEGs, so a frame costs the Pi nothing
+    but copying it. A JPEG may arrive in several buffers; each one starts with an SOI marker.
+    """
+
+    def __init__(self, frames, fps):
+        super(MJPEGPreviewOutput, self).__init__(frames, fps)
+        self.buf = None
+
+    def write(self, buf):
+        if buf.startswith(b'\xff\xd8'):
+            # the start of a new JPEG, so the last one is complete
+            if self.buf is not None:
+                self.frames.publish(bytes(self.buf))
+            self.buf = bytearray() if self.due() else None
+        if self.buf is not None:
+            self.buf.extend(buf)
+        return len(buf)
+
+
+class OverlayPreviewOutput(PreviewOutput):
+    """
+    Output for a 'bgr' recording at the preview size (a multiple of 32 x 16, so frames aren't padded). boxes (the
+    arenas or the motion vector ROI, in preview pixels) and the latest value on the motion list are drawn on each
+    frame kept, which is then encoded to a JPEG once for all viewers.
+    """
+
+    def __init__(self, frames, fps, size, quality, boxes, motion_list, motion_list_lock):
+        super(OverlayPreviewOutput, self).__init__(frames, fps)
+        self.width, self.height = size
+        self.quality = quality
+        self.boxes = boxes or []
+        self.motion_list = motion_list
+        self.motion_list_lock = motion_list_lock
+
+    def write(self, buf):
+        if self.due():
+            image = np.frombuffer(buf, dtype=np.uint8)[:self.width * self.height * 3].reshape(
+                (self.height, self.width, 3)).copy()
+            for x0, y0, x1, y1 in self.boxes:
+                cv2.rectangle(image, (x0, y0), (x1, y1), (0, 255, 0), 1)
+            with self.motion_list_lock:
+                motion = self.motion_list[-1] if len(self.motion_list) else None
+            text = time.strftime('%H:%M:%S')
+            if motion is not None:
+                text += '  motion %.1f' % motion
+            cv2.putText(image, text, (4, self.height - 6), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 255), 1)
+            ok, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            if ok:
+                self.frames.publish(jpeg.tobytes())
+        return len(buf)
+
+
+class PreviewHandler(server.BaseHTTPRequestHandler):
+    """ / is a page showing the preview, /stream.mjpg the MJPEG stream itself and /frame.jpg a single frame. """
+
+    def do_GET(self):
+        if self.path == '/':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(PAGE)))
+            self.end_headers()
+            self.wfile.write(PAGE)
+        elif self.path in ('/stream.mjpg', '/frame.jpg'):
+            if not self.server.frames.add_viewer(self.server.max_viewers):
+                self.send_error(503, 'Too many viewers')
+                return
+            try:
+                if self.path == '/stream.mjpg':
+                    self.send_stream()
+                else:
+                    self.send_frame()
+            finally:
+                self.server.frames.remove_viewer()
+        else:
+            self.send_error(404)
+
+    def send_stream(self):
+        self.send_response(200)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=%s' % BOUNDARY)
+        self.end_headers()
+        frame_no = None
+        try:
+            while not self.server.stopping:
+                new_frame_no, jpeg = self.server.frames.wait(frame_no, timeout=1)
+                if new_frame_no == frame_no or jpeg is None:
+                    continue
+                frame_no = new_frame_no
+                self.wfile.write(b'--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % (
+                    BOUNDARY.encode(), len(jpeg)))
+                self.wfile.write(jpeg)
+                self.wfile.write(b'\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # the viewer went away
+            pass
+
+    def send_frame(self):
+        # outputs only keep frames while someone watches, so wait for a fresh one
+        frame_no, jpeg = self.server.frames.wait(self.server.frames.frame_no, timeout=5)
+        if jpeg is None:
+            self.send_error(503, 'No preview yet')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(jpeg)))
+        self.end_headers()
+        self.wfile.write(jpeg)
+
+    def log_message(self, format, *args):
+        Logger.debug('PreviewServer: %s %s' % (self.address_string(), format % args))
+
+
+class PreviewServer(socketserver.ThreadingMixIn, server.HTTPServer):
+    """
+    Serves the preview over http on the local network, from its own thread, with one thread per viewer. At most
+    max_viewers are let in at a time, so the cost of the preview is bounded however many browsers are pointed at it.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, frames, max_viewers=4):
+        super(PreviewServer, self).__init__(('', port), PreviewHandler)
+        self.frames = frames
+        self.max_viewers = max_viewers
+        self.stopping = False
+        self.thread = threading.Thread(target=self.serve_forever, name='preview_server', daemon=True)
+        self.thread.start()
+        Logger.info('PreviewServer: serving the preview on port %s' % port)
+
+    def close(self):
+        self.stopping = True
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
@@ -0,0 +1,106 @@
+import os
+import queue
+import shutil
+import subprocess
+import threading
+
+from kivy.logger import Logger
+
+
+class Remuxer(threading.Thread):
+    """
+    Copies finished h264 segments into mp4 files at low CPU and disk priority, without re-encoding. Raw h264 has no
+    container, timestamps or seek index, so every tool has to decode a whole file to find a frame; the mp4 has a
+    sample table for seeking (moved to the front of the file) and, if mp4fpsmod is installed, the camera's own frame
+    timestamps instead of a constant frame rate. Segments are queued with add() and the .h264 file is deleted once
+    its mp4 is complete. If ffmpeg is missing or a remux fails, the segment is kept as .h264.
+    """
+
+    def __init__(self, fps, timeout=300):
+        super(Remuxer, self).__init__(name='remuxer')
+        self.fps = fps
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.ffmpeg = shutil.which('ffmpeg')
+        self.mp4fpsmod = shutil.which('mp4fpsmod')
+        # run at the lowest CPU and (where ionice exists) idle disk priority, so recording always comes first
+        self.prefix = []
+        if shutil.which('nice'):
+            self.prefix += ['nice', '-n', '19']
+        if shutil.which('ionice'):
+            self.prefix += ['ionice', '-c', '3']
+        if self.ffmpeg is None:
+            Logger.warning('Remuxer: ffmpeg not found, videos will be kept as .h264')
+        elif self.mp4fpsmod is None:
+            Logger.info('Remuxer: mp4fpsmod not found, mp4 files will have a constant frame rate')
+        self.remuxed = 0
+        self.failed = 0
+        self.start()
+
+    def add(self, src, dest, timestamps):
+        """
+        Queue the h264 file src (which may have any extension) to be remuxed to dest.mp4, or renamed to dest.h264 if
+        that fails. timestamps are the camera timestamps (microseconds) of its frames, in order.
+        """
+        self.queue.put((src, dest, timestamps))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            src, dest, timestamps = item
+            if self.ffmpeg is not None and self.remux(src, dest, timestamps):
+                self.remuxed += 1
+            else:
+                self.failed += 1
+                os.replace(src, dest + '.h264')
+
+    def run_command(self, cmd):
+        try:
+            subprocess.run(self.prefix + cmd, check=True, timeout=self.timeout,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except subprocess.CalledProcessError as err:
+            Logger.warning('Remuxer: %s failed: %s' % (cmd[0], err.stderr.decode(errors='replace').strip()))
+            return False
+        except (OSError, subprocess.TimeoutExpired) as err:
+            Logger.warning('Remuxer: %s failed: %s' % (cmd[0], err))
+            return False
+        return True
+
+    def remux(self, src, dest, timestamps):
+        mp4 = dest + '.mp4'
+        constant_rate = dest + '.cfr.tmp'
+        timecodes = dest + '.timecodes.tmp'
+        try:
+            # the raw stream has no timestamps, so ffmpeg makes constant frame rate ones
+            if not self.run_command([self.ffmpeg, '-y', '-loglevel', 'error', '-fflags', '+genpts',
+                                     '-framerate', str(self.fps), '-f', 'h264', '-i', src, '-c', 'copy',
+                                     '-movflags', '+faststart', '-f', 'mp4', constant_rate]):
+                return False
+            if self.mp4fpsmod is not None and len(timestamps) > 1 and None not in timestamps:
+                with open(timecodes, 'w') as f:
+                    f.write('# timecode format v2\n')
+                    for timestamp in timestamps:
+                        f.write('%.3f\n' % ((timestamp - timestamps[0]) / 1000))
+                if self.run_command([self.mp4fpsmod, '-t', timecodes, '-o', mp4 + '.tmp', constant_rate]):
+                    os.replace(mp4 + '.tmp', mp4)
+                else:
+                    # e.g. a frame count mismatch; the constant frame rate file is still seekable
+                    Logger.info('Remuxer: keeping constant frame rate timestamps for %s' % mp4)
+                    os.replace(constant_rate, mp4)
+            else:
+                os.replace(constant_rate, mp4)
+            os.remove(src)
+            Logger.debug('Remuxer: %s remuxed' % mp4)
+            return True
+        finally:
+            for path in (constant_rate, timecodes, mp4 + '.tmp'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def close(self):
+        # segments already queued are remuxed before the thread exits
+        self.queue.put(None)
+        self.join()
+        Logger.info('Remuxer: %s videos remuxed, %s kept as h264' % (self.remuxed, self.failed))
@@ -0,0 +1,210 @@
+import csv
+import os
+import queue
+import threading
+import time
+from os.path import join, basename, exists
+
+from kivy.logger import Logger
+
+
+class SegmentOutput:
+    """
+    picamera custom output for one video segment. Encoded buffers are handed to the SegmentWriter's queue as they
+    arrive, and the frame number and camera timestamp of every complete frame are noted. picamera flushes the output
+    when the recording is split or stopped, which marks the end of the segment.
+    """
+
+    def __init__(self, writer, name):
+        self.writer = writer
+        # path without an extension; the file is written as <name>.h264.tmp until it's finished
+        self.name = name
+        self.path = name + '.h264.tmp'
+        self.frame_nos = []
+        self.timestamps = []
+        self.written = False
+        self.flushed = False
+
+    def write(self, buf):
+        frame_no, timestamp = self.writer.note_frame()
+        if frame_no is not None:
+            self.frame_nos.append(frame_no)
+            self.timestamps.append(timestamp)
+        # picamera hands over a fresh bytes object per buffer, so it can be queued without copying
+        self.writer.queue_chunk(self, buf)
+        self.written = True
+        return len(buf)
+
+    def flush(self):
+        # a failed camera may not get as far as flushing, so this is also called when it's restarted
+        if self.flushed:
+            return
+        self.flushed = True
+        if self.written:
+            self.writer.queue_chunk(self, None)
+
+
+class DiscardOutput:
+    """ Output that throws the video away, for the gaps between videos when there's an inter-video interval. """
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, buf):
+        # frames are still counted, so frame numbers carry on across the gap
+        self.writer.note_frame()
+        return len(buf)
+
+    def flush(self):
+        pass
+
+
+class SegmentWriter(threading.Thread):
+    """
+    Writes an h264 recording straight to disk as a series of VID_<time>.h264 files. The camera thread only starts the
+    recording with new_segment() and moves on to the next file with camera.split_recording(new_segment()), which
+    picamera does at a keyframe without dropping frames; the encoder's buffers wait in a small bounded queue and are
+    written, and finished files closed, by this thread. Files end in .tmp until they're finished, so they aren't
+    uploaded half written. Each segment gets a frame index, VID_<time>_frames.csv, with the recording's frame number
+    and camera timestamp (microseconds) of every frame, and its first and last frame are appended to segments.csv in
+    the video folder, so consecutive files can be checked for gaps. Finished segments are handed to remuxer (see
+    Remuxer) if there is one. If the camera is restarted, restart() moves the writer over to the new camera and
+    frame numbers carry on from the old recording, skipping the frames that were lost in between.
+    """
+
+    def __init__(self, camera, video_dir, splitter_port, queue_size=256, remuxer=None):
+        super(SegmentWriter, self).__init__(name='segment_writer')
+        self.camera = camera
+        self.video_dir = video_dir
+        self.splitter_port = splitter_port
+        self.remuxer = remuxer
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.log_path = join(video_dir, 'segments.csv')
+        self.last_timestr = None
+        self.names_this_second = set()
+        self.output = None
+        self.file = None
+        self.segments = 0
+        self.full_waits = 0
+        # frame numbers of a recording that follows a camera restart are offset to carry on from the last one
+        self.frame_offset = 0
+        self.next_frame_no = 0
+        self.last_frame_time = None
+        self.restart_fps = None
+        self.frames_lost = 0
+        self.closed = False
+        self.start()
+
+    def new_segment(self):
+        timestr = time.strftime("%Y%m%d_%H%M%S")
+        if timestr != self.last_timestr:
+            self.names_this_second = set()
+        self.last_timestr = timestr
+        name = join(self.video_dir, "VID_{}".format(timestr))
+        n = 0
+        # more than one segment started in the same second, possibly by an earlier writer if the camera was restarted
+        while name in self.names_this_second or exists(name + '_frames.csv'):
+            n += 1
+            name = join(self.video_dir, "VID_{}_{}".format(timestr, n))
+        self.names_this_second.add(name)
+        return SegmentOutput(self, name)
+
+    def current_frame(self):
+        # PiCamera.frame only describes one of the active encoders, so ask the encoder on our port directly
+        encoder = self.camera._encoders.get(self.splitter_port)
+        return getattr(encoder, 'frame', None)
+
+    def note_frame(self):
+        """
+        Frame number and camera timestamp of the frame being written, or (None, None) for buffers holding SPS headers
+        or part of a frame. Called from the camera thread for every buffer.
+        """
+        frame = self.current_frame()
+        if frame is None or not frame.complete or frame.header:
+            return None, None
+        now = time.monotonic()
+        if self.restart_fps is not None:
+            # the first frame since the camera was restarted
+            lost = 0
+            if self.last_frame_time is not None:
+                lost = max(int(round((now - self.last_frame_time) * self.restart_fps)) - 1, 0)
+            self.frame_offset = self.next_frame_no + lost - frame.index
+            self.frames_lost += lost
+            self.restart_fps = None
+            Logger.info('SegmentWriter: %s frames lost while the camera restarted' % lost)
+        frame_no = self.frame_offset + frame.index
+        self.next_frame_no = frame_no + 1
+        self.last_frame_time = now
+        return frame_no, frame.timestamp
+
+    def restart(self, camera, fps):
+        """
+        Follow a new camera, before its recording is started. Frames the old camera would have recorded in between
+        (at fps) are counted as lost, and numbered as if they had been, so frame_no gaps show where they're missing.
+        """
+        self.camera = camera
+        self.restart_fps = fps
+
+    def queue_chunk(self, output, buf):
+        try:
+            self.queue.put_nowait((output, buf))
+        except queue.Full:
+            # video can't be dropped, so the encoder has to wait for the SD card
+            self.full_waits += 1
+            Logger.debug('SegmentWriter: queue full, waiting to write video')
+            self.queue.put((output, buf))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            output, buf = item
+            if output is not self.output:
+                self.finish_segment()
+                self.output = output
+                self.file = open(output.path, 'ab')
+            if buf is None:
+                self.finish_segment()
+            else:
+                self.file.write(buf)
+
+    def finish_segment(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        output = self.output
+        self.output = None
+        self.segments += 1
+        with open(output.name + '_frames.csv', 'w', newline='') as f:
+            index = csv.writer(f)
+            index.writerow(['frame', 'frame_no', 'timestamp'])
+            index.writerows(zip(range(len(output.frame_nos)), output.frame_nos, output.timestamps))
+        with open(self.log_path, 'a', newline='') as f:
+            log = csv.writer(f)
+            if f.tell() == 0:
+                log.writerow(['segment', 'frames', 'first_frame', 'last_frame', 'first_timestamp', 'last_timestamp'])
+            if output.frame_nos:
+                log.writerow([basename(output.name), len(output.frame_nos), output.frame_nos[0],
+                              output.frame_nos[-1], output.timestamps[0], output.timestamps[-1]])
+            else:
+                log.writerow([basename(output.name), 0, None, None, None, None])
+        if self.remuxer is not None:
+            self.remuxer.add(output.path, output.name, output.timestamps)
+        else:
+            os.replace(output.path, output.name + '.h264')
+        Logger.debug('SegmentWriter: video %s collected' % output.name)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.join()
+        # a segment is left open if the recording wasn't stopped cleanly
+        self.finish_segment()
+        Logger.info('SegmentWriter: %s videos written, waited for the disk %s times, %s frames lost to camera '
+                    'restarts' % (self.segments, self.full_waits, self.frames_lost))
+        if self.remuxer is not None:
+            self.remuxer.close()
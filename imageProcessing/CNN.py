@@ -1,80 +1,70 @@
 import threading
 import os
-from os.path import join, exists
+from os.path import join
 
 import cv2
-import h5py
 import numpy as np
-import tensorflow as tf
 from kivy.logger import Logger
 
-from object_detection.utils import label_map_util
-from object_detection.utils import visualization_utils as vis_util
+from imageProcessing.detection_store import DetectionWriter
+from imageProcessing.inference_backends import InferenceError, load_backend, load_label_map
+from imageProcessing.inference_worker import RemoteBackend
 
 
 class CNN:
-    ''' The CNN class loads a frozen tensorflow inference graph for object detection. The internal '_run' method runs
-    the actual detection, while the outward facing 'get_worm_location' method will specifically find the center of the
-     bounding-box for the highest-scoring worm object (class 1 in the provided frozen inference graph). '''
-
-    def __init__(self, save_processed_images, img_dir, img_dims):
+    ''' The CNN class loads an object detection model through one of the inference backends (the frozen tensorflow
+    inference graph by default). The internal '_run' method runs the actual detection, while the outward facing
+    'get_worm_location' method will specifically find the center of the bounding-box for the highest-scoring worm
+    object (class 1 in the provided frozen inference graph). '''
+
+    def __init__(self, save_processed_images, img_dir, img_dims, crop_size=None, backend='tensorflow',
+                 backend_kwargs=None, worker_process=False, max_batch=4, max_latency=0.05, output_dims=None):
+        # image processors hold this while they use the model
         self.lock = threading.Lock()
-        self.box_file_lock = threading.Lock()
         self.save_processed_images = save_processed_images
         self.img_dir = img_dir
         if self.save_processed_images:
-            self.h5_file = join(self.img_dir, 'processed', 'data.h5')
-        self.width, self.height = img_dims
+            # boxes and scores of the worms and eggs found in every frame
+            self.detections = DetectionWriter(join(self.img_dir, 'processed', 'data.h5'))
+        # largest image that will be passed in
+        self.max_width, self.max_height = img_dims
+        # worm locations are given in pixels of this size of image, whatever size the analysed images are
+        self.width, self.height = output_dims if output_dims is not None else img_dims
+        # RGB buffers for _prep_image, per thread and image shape
+        self.local = threading.local()
+        # if set, worms are tracked by searching a crop_size square around where the worm is expected to be, and the
+        # whole image is only searched when that fails
+        self.crop_size = crop_size
+        # the last two worm locations found, as (frame_no, y, x) in coordinates normalized to the image size
+        self.track = []
+        self.track_lock = threading.Lock()
         self.cwd = os.getcwd()
-        self.graph, self.sess, self.category_index = self.load_graph()
-        Logger.info('CNN: tensorflow model loaded')
-
-    def load_graph(self):
-
-        detection_graph = tf.Graph()
-        with detection_graph.as_default():
-            od_graph_def = tf.compat.v1.GraphDef()
-            with tf.io.gfile.GFile(join(self.cwd, 'neural_net/frozen_inference_graph.pb'), 'rb') as fid:
-                serialized_graph = fid.read()
-                od_graph_def.ParseFromString(serialized_graph)
-                tf.import_graph_def(od_graph_def, name='')
-
-        # Load label map
-        label_map = label_map_util.load_labelmap(join(self.cwd, 'neural_net/label_map.pbtxt'))
-        categories = label_map_util.convert_label_map_to_categories(label_map, max_num_classes=2,
-                                                                    use_display_name=True)
-        category_index = label_map_util.create_category_index(categories)
-
-        # create a session
-        sess = tf.compat.v1.Session(graph=detection_graph)
-
-        return detection_graph, sess, category_index
-
-    def _run(self, expanded_image):
-
-        with self.graph.as_default():
-            image_tensor = self.graph.get_tensor_by_name('image_tensor:0')
-            boxes = self.graph.get_tensor_by_name('detection_boxes:0')
-            scores = self.graph.get_tensor_by_name('detection_scores:0')
-            classes = self.graph.get_tensor_by_name('detection_classes:0')
-            num_detections = self.graph.get_tensor_by_name('num_detections:0')
-
-            # Actual detection.
-            (boxes, scores, classes, num_detections) = self.sess.run(
-                [boxes, scores, classes, num_detections],
-                feed_dict={image_tensor: expanded_image})
-
-            classes = np.squeeze(classes).astype(np.int32)
-            boxes = np.squeeze(boxes)
-            scores = np.squeeze(scores)
-            return classes, boxes, scores
+        model_dir = join(self.cwd, 'neural_net')
+        if worker_process:
+            # returns once the inference process has loaded the model, and raises InferenceError if it couldn't
+            self.backend = RemoteBackend(backend, model_dir, backend_kwargs or {},
+                                         max_image_size=self.max_width * self.max_height * 3,
+                                         max_batch=max_batch, max_latency=max_latency)
+            # the inference process batches requests that arrive together, so let up to a batch's worth in at once
+            self.lock = threading.Semaphore(max_batch)
+        else:
+            self.backend = load_backend(backend, model_dir, **(backend_kwargs or {}))
+        self.category_index = load_label_map(join(model_dir, 'label_map.pbtxt'))
+        Logger.info('CNN: %s model loaded' % backend)
+
+    def _run(self, image):
+        # every backend returns classes, boxes as (ymin, xmin, ymax, xmax) normalized to the image, and scores,
+        # ordered from the highest score to the lowest
+        return self.backend.run(image)
 
     def _prep_image(self, image):
-        # transform back to color from grayscale
-        image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
-        # change color order from BGR to RGB
-        image = image[:, :, [2, 1, 0]]
-        return image
+        # the model takes 3 channels. All three are the same gray level, so there's no BGR/RGB order to fix
+        if not hasattr(self.local, 'buffers'):
+            self.local.buffers = {}
+        rgb = self.local.buffers.get(image.shape)
+        if rgb is None:
+            rgb = self.local.buffers[image.shape] = np.empty(image.shape + (3,), dtype=np.uint8)
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB, dst=rgb)
 
     def _screen_results(self, target_class, min_score, classes, boxes, scores):
         # screen out classes that are not 1 (worm class) and scores > .8
@@ -114,6 +104,7 @@ class CNN:
         return center_x, center_y
 
     def _label_image(self, image, box, score, class_idx=1):
+        from object_detection.utils import visualization_utils as vis_util
         ymin, xmin, ymax, xmax = box
         class_label = self.category_index[class_idx]['name']
         display_str = '{}: {}%'.format(class_label, int(100*score))
@@ -129,87 +120,134 @@ class CNN:
             use_normalized_coordinates=True)
         return image
 
-    def get_worm_location(self, image, frame_no):
+    def _find_worms(self, image, crop=None):
+        """
+        Run detection on image, or only on the crop (x0, y0, x1, y1) of it, and return the worm boxes and scores
+        with the top worm box, all in coordinates normalized to the whole image.
+        """
+        full_shape = image.shape[:2]
+        if crop is not None:
+            x0, y0, x1, y1 = crop
+            image = image[y0:y1, x0:x1]
+        classes, boxes, scores = self._run(self._prep_image(image))
+        target_class = 1
+        min_score = 0.8
+        num_worms, worm_classes, worm_boxes, worm_scores = self._screen_results(target_class, min_score,
+                                                                                classes, boxes, scores)
+        if crop is not None and num_worms > 0:
+            worm_boxes = self._uncrop_boxes(worm_boxes, crop, full_shape)
+        worm_class, worm_box, worm_score = self._get_top_result(num_worms, worm_classes, worm_boxes, worm_scores)
+        return worm_boxes, worm_scores, worm_box
+
+    def _uncrop_boxes(self, boxes, crop, full_shape):
+        """ Map boxes normalized to a crop back to coordinates normalized to the full image. """
+        x0, y0, x1, y1 = crop
+        height, width = full_shape
+        boxes = np.array(boxes, dtype=np.float64).reshape(-1, 4)
+        boxes[:, [0, 2]] = (y0 + boxes[:, [0, 2]] * (y1 - y0)) / height
+        boxes[:, [1, 3]] = (x0 + boxes[:, [1, 3]] * (x1 - x0)) / width
+        return boxes
+
+    def _predict_location(self, frame_no):
+        """ Where the worm should be in frame_no, from the last two locations found and constant velocity. """
+        with self.track_lock:
+            track = list(self.track)
+        if not track:
+            return None
+        f1, y1, x1 = track[-1]
+        if len(track) == 2:
+            f0, y0, x0 = track[0]
+            if f1 != f0:
+                scale = (frame_no - f1) / (f1 - f0)
+                return y1 + (y1 - y0) * scale, x1 + (x1 - x0) * scale
+        return y1, x1
+
+    def _crop_around(self, location, shape):
+        """ A crop_size square around a normalized (y, x) location, shifted to lie inside an image of this shape. """
+        height, width = shape[:2]
+        crop_w, crop_h = min(self.crop_size, width), min(self.crop_size, height)
+        y, x = location
+        x0 = int(min(max(x * width - crop_w / 2, 0), width - crop_w))
+        y0 = int(min(max(y * height - crop_h / 2, 0), height - crop_h))
+        return x0, y0, x0 + crop_w, y0 + crop_h
+
+    def _box_inside_crop(self, box, crop, shape):
+        """ False if the box reaches an edge of the crop that isn't an edge of the image - the worm may be cut off. """
+        height, width = shape[:2]
+        x0, y0, x1, y1 = crop
+        ymin, xmin, ymax, xmax = box
+        # one pixel of slack
+        return not ((x0 > 0 and xmin * width <= x0 + 1) or (y0 > 0 and ymin * height <= y0 + 1) or
+                    (x1 < width and xmax * width >= x1 - 1) or (y1 < height and ymax * height >= y1 - 1))
+
+    def _track_worm(self, image, frame_no):
+        """
+        Look for the worm near where it's expected to be, and fall back on the whole image if there's no confident
+        detection in the crop or the worm runs off its edge.
+        """
+        location = self._predict_location(frame_no)
+        if location is not None:
+            crop = self._crop_around(location, image.shape)
+            worm_boxes, worm_scores, worm_box = self._find_worms(image, crop)
+            if worm_box is not None and self._box_inside_crop(worm_box, crop, image.shape):
+                return worm_boxes, worm_scores, worm_box
+            Logger.debug('CNN: lost the worm in the crop around %s, searching the whole image' % (location,))
+        return self._find_worms(image)
+
+    def _update_track(self, frame_no, worm_box):
+        with self.track_lock:
+            if worm_box is None:
+                # no idea where the worm is, so search the whole image next time
+                self.track = []
+                return
+            ymin, xmin, ymax, xmax = worm_box
+            self.track = self.track[-1:] + [(frame_no, (ymin + ymax) / 2, (xmin + xmax) / 2)]
+
+    def get_worm_location(self, image, frame_no, timestamp=None):
         # default to no center x or y position
         worm_center_x = None
         worm_center_y = None
-        image = self._prep_image(image)
-        # Expand dimensions since the model expects images to have shape: [1, None, None, 3]
-        expanded_image = np.expand_dims(image, axis=0)
         try:
-            classes, boxes, scores = self._run(expanded_image)
-            target_class = 1
-            min_score = 0.8
-            num_worms, worm_classes, worm_boxes, worm_scores = self._screen_results(target_class, min_score,
-                                                                                    classes, boxes, scores)
-            worm_class, worm_box, worm_score = self._get_top_result(num_worms, worm_classes, worm_boxes, worm_scores)
+            if self.crop_size:
+                worm_boxes, worm_scores, worm_box = self._track_worm(image, frame_no)
+                self._update_track(frame_no, worm_box)
+            else:
+                worm_boxes, worm_scores, worm_box = self._find_worms(image)
 
-            if self.save_processed_images:
-                if worm_box is not None:
-                    with self.box_file_lock:
-                        if exists(self.h5_file):
-                            with h5py.File(self.h5_file, 'a') as hf:
-                                frame_boxes_name = 'worm_boxes_frame_' + str(frame_no)
-                                hf.create_dataset(frame_boxes_name, data=worm_boxes)
-                                frame_scores_name = 'worm_score_frame_' + str(frame_no)
-                                hf.create_dataset(frame_scores_name, data=worm_scores)
-                        else:
-                            with h5py.File(self.h5_file, 'w') as hf:
-                                frame_boxes_name = 'worm_boxes_frame_' + str(frame_no)
-                                hf.create_dataset(frame_boxes_name, data=worm_boxes)
-                                frame_scores_name = 'worm_score_frame_' + str(frame_no)
-                                hf.create_dataset(frame_scores_name, data=worm_scores)
+            if self.save_processed_images and worm_box is not None:
+                self.detections.append(frame_no, timestamp, 1, worm_boxes, worm_scores)
 
             if worm_box is not None:
                 worm_center_x, worm_center_y = self._get_box_center(worm_box)
 
-        except tf.compat.v1.errors.ResourceExhaustedError:
+        except InferenceError as err:
             # just return the center point as None, None
-            pass
+            Logger.warning('CNN: unable to find worm in frame %s: %s' % (frame_no, err))
 
         return worm_center_x, worm_center_y
 
-    def count_eggs(self, image, frame_no):
+    def count_eggs(self, image, frame_no, timestamp=None):
         num_eggs = None
         # default to no center x or y positions
-        image = self._prep_image(image)
-        # Expand dimensions since the model expects images to have shape: [1, None, None, 3]
-        expanded_image = np.expand_dims(image, axis=0)
         try:
-
-            classes, boxes, scores = self._run(expanded_image)
+            classes, boxes, scores = self._run(self._prep_image(image))
             target_class = 2
             min_score = 0.8
             num_eggs, egg_classes, egg_boxes, egg_scores = self._screen_results(target_class, min_score, classes, boxes, scores)
             if self.save_processed_images:
-                if egg_boxes is not None:
-                    with self.box_file_lock:
-                        if exists(self.h5_file):
-                            with h5py.File(self.h5_file, 'a') as hf:
-                                frame_boxes_name = 'egg_boxes_frame_' + str(frame_no)
-                                hf.create_dataset(frame_boxes_name, data=egg_boxes)
-                                frame_scores_name = 'egg_score_frame_' + str(frame_no)
-                                hf.create_dataset(frame_scores_name, data=egg_scores)
-                        else:
-                            with h5py.File(self.h5_file, 'w') as hf:
-                                frame_boxes_name = 'egg_boxes_frame_' + str(frame_no)
-                                hf.create_dataset(frame_boxes_name, data=egg_boxes)
-                                frame_scores_name = 'egg_score_frame_' + str(frame_no)
-                                hf.create_dataset(frame_scores_name, data=egg_scores)
-
-        except tf.compat.v1.errors.ResourceExhaustedError:
+                self.detections.append(frame_no, timestamp, 2, egg_boxes, egg_scores)
+
+        except InferenceError as err:
             # just return the number of eggs as None
-            pass
+            Logger.warning('CNN: unable to count eggs in frame %s: %s' % (frame_no, err))
 
         return num_eggs
 
-    def get_worm_location_and_count_eggs(self, image, frame_no):
+    def get_worm_location_and_count_eggs(self, image, frame_no, timestamp=None):
         worm_center_x, worm_center_y = (None, None)
         num_eggs = None
-        image = self._prep_image(image)
-        expanded_image = np.expand_dims(image, axis=0)
         try:
-            classes, boxes, scores = self._run(expanded_image)
+            classes, boxes, scores = self._run(self._prep_image(image))
 
             target_class = 2
             min_score = 0.8
@@ -224,36 +262,44 @@ class CNN:
                 worm_center_x, worm_center_y = self._get_box_center(worm_box)
 
             if self.save_processed_images:
-                with self.box_file_lock:
-                    if exists(self.h5_file):
-                        with h5py.File(self.h5_file, 'a') as hf:
-                            if egg_boxes is not None:
-                                frame_boxes_name = 'egg_boxes_frame_' + str(frame_no)
-                                hf.create_dataset(frame_boxes_name, data=egg_boxes)
-                                frame_scores_name = 'egg_score_frame_' + str(frame_no)
-                                hf.create_dataset(frame_scores_name, data=egg_scores)
-                            if worm_box is not None:
-                                frame_boxes_name = 'worm_boxes_frame_' + str(frame_no)
-                                hf.create_dataset(frame_boxes_name, data=worm_boxes)
-                                frame_scores_name = 'worm_score_frame_' + str(frame_no)
-                                hf.create_dataset(frame_scores_name, data=worm_scores)
-                    else:
-                        with h5py.File(self.h5_file, 'w') as hf:
-                            if egg_boxes is not None:
-                                frame_boxes_name = 'egg_boxes_frame_' + str(frame_no)
-                                hf.create_dataset(frame_boxes_name, data=egg_boxes)
-                                frame_scores_name = 'egg_score_frame_' + str(frame_no)
-                                hf.create_dataset(frame_scores_name, data=egg_scores)
-                            if worm_box is not None:
-                                frame_boxes_name = 'worm_boxes_frame_' + str(frame_no)
-                                hf.create_dataset(frame_boxes_name, data=worm_boxes)
-                                frame_scores_name = 'worm_score_frame_' + str(frame_no)
-                                hf.create_dataset(frame_scores_name, data=worm_scores)
-
-        except tf.compat.v1.errors.ResourceExhaustedError:
+                self.detections.append(frame_no, timestamp, 2, egg_boxes, egg_scores)
+                if worm_box is not None:
+                    self.detections.append(frame_no, timestamp, 1, worm_boxes, worm_scores)
+
+        except InferenceError as err:
             # just return the center point as None, None and the number of eggs as None
-            pass
+            Logger.warning('CNN: unable to process frame %s: %s' % (frame_no, err))
 
         return num_eggs, worm_center_x, worm_center_y
 
-
+    def find_all_worms(self, image, frame_no, timestamp=None, count_eggs=False):
+        """
+        Find every worm in the whole image rather than just the top one, for multi-worm tracking. Returns the number
+        of eggs (None unless count_eggs) and the worm boxes as an (n, 4) array of x0, y0, x1, y1 in output pixels.
+        """
+        num_eggs = None
+        worm_boxes = np.zeros((0, 4))
+        try:
+            classes, boxes, scores = self._run(self._prep_image(image))
+            min_score = 0.8
+            num_worms, worm_classes, worm_boxes, worm_scores = self._screen_results(1, min_score,
+                                                                                    classes, boxes, scores)
+            worm_boxes = np.asarray(worm_boxes).reshape(-1, 4)
+            if count_eggs:
+                num_eggs, egg_classes, egg_boxes, egg_scores = self._screen_results(2, min_score,
+                                                                                    classes, boxes, scores)
+            if self.save_processed_images:
+                self.detections.append(frame_no, timestamp, 1, worm_boxes, worm_scores)
+                if count_eggs:
+                    self.detections.append(frame_no, timestamp, 2, egg_boxes, egg_scores)
+        except InferenceError as err:
+            Logger.warning('CNN: unable to find worms in frame %s: %s' % (frame_no, err))
+        # (ymin, xmin, ymax, xmax) fractions of the image to pixels
+        pixel_boxes = worm_boxes[:, [1, 0, 3, 2]] * [self.width, self.height, self.width, self.height]
+        return num_eggs, pixel_boxes
+
+    def close(self):
+        if isinstance(self.backend, RemoteBackend):
+            self.backend.close()
+        if self.save_processed_images:
+            self.detections.close()
@@ -0,0 +1,102 @@
+import threading
+
+import h5py
+import numpy as np
+from kivy.logger import Logger
+
+# name, dtype and shape of one row of each dataset
+FIELDS = (('frame_no', np.int64, ()),
+          ('timestamp', np.float64, ()),
+          ('class', np.int16, ()),
+          ('score', np.float32, ()),
+          ('box', np.float32, (4,)))
+
+
+class DetectionWriter:
+    """
+    Keeps one HDF5 file open and appends neural net detections to it, one row per box, in a handful of resizable,
+    chunked and compressed datasets ('frame_no', 'timestamp', 'class', 'score' and 'box' as ymin, xmin, ymax, xmax
+    normalized to the image). Rows are buffered in memory and written by a background thread every flush_interval
+    seconds, so the image processors never wait on the SD card.
+    """
+
+    def __init__(self, path, flush_interval=5, chunk_rows=1024, compression_level=4):
+        self.path = path
+        self.file = h5py.File(path, 'a')
+        for name, dtype, shape in FIELDS:
+            if name not in self.file:
+                self.file.create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape,
+                                         chunks=(chunk_rows,) + shape, dtype=dtype,
+                                         compression='gzip', compression_opts=compression_level)
+        self.lock = threading.Lock()
+        self.rows = []
+        self.flush_interval = flush_interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='detection_writer')
+        self.thread.start()
+
+    def append(self, frame_no, timestamp, class_id, boxes, scores):
+        """ Queue the boxes and scores of one class found in a frame. """
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+        timestamp = np.nan if timestamp is None else timestamp
+        with self.lock:
+            for box, score in zip(boxes, scores):
+                self.rows.append((frame_no, timestamp, class_id, score, box))
+
+    def run(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            rows, self.rows = self.rows, []
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        n = self.file['frame_no'].shape[0]
+        for (name, dtype, shape), column in zip(FIELDS, columns):
+            dataset = self.file[name]
+            dataset.resize(n + len(rows), axis=0)
+            dataset[n:] = np.array(column, dtype=dtype)
+        self.file.flush()
+        Logger.debug('DetectionWriter: wrote %s detections' % len(rows))
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+
+
+class DetectionReader:
+    """ Reads detections written by DetectionWriter back as arrays. """
+
+    def __init__(self, path):
+        self.file = h5py.File(path, 'r')
+
+    def read(self, first_frame=None, last_frame=None, class_id=None):
+        """
+        Return a dict of arrays (one entry per field) with the detections from first_frame to last_frame inclusive,
+        optionally only those of one class, sorted by frame number.
+        """
+        frame_nos = self.file['frame_no'][:]
+        keep = np.ones(frame_nos.shape, dtype=bool)
+        if first_frame is not None:
+            keep &= frame_nos >= first_frame
+        if last_frame is not None:
+            keep &= frame_nos <= last_frame
+        if class_id is not None:
+            keep &= self.file['class'][:] == class_id
+        rows = np.flatnonzero(keep)
+        rows = rows[np.argsort(frame_nos[rows], kind='stable')]
+        return {name: self.file[name][:][rows] for name, dtype, shape in FIELDS}
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
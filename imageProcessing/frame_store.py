@@ -0,0 +1,112 @@
+import glob
+import os
+from os.path import join
+
+import h5py
+import numpy as np
+
+
+class FrameStackWriter:
+    """
+    Appends frames to chunked, compressed HDF5 stacks instead of writing one image file per frame. Each stack holds a
+    'frames' dataset (one chunk per frame) alongside 'frame_no' and 'timestamp' indexes, and a new stack file is
+    started every frames_per_file frames. The stack being written is named '.h5.tmp' and renamed to '.h5' once it's
+    complete, so only finished stacks are uploaded. Stack numbers already taken in the directory (e.g. by a writer
+    before a restart that had the same prefix) are skipped, so earlier stacks are never overwritten.
+    """
+
+    def __init__(self, directory, prefix, frames_per_file=500, compression_level=1):
+        self.directory = directory
+        self.prefix = prefix
+        self.frames_per_file = frames_per_file
+        self.compression_level = compression_level
+        self.file = None
+        self.path = None
+        self.file_index = 0
+        self.count = 0
+
+    def _open(self, image):
+        self.path = join(self.directory, '%s_%05d.h5' % (self.prefix, self.file_index))
+        while os.path.exists(self.path) or os.path.exists(self.path + '.tmp'):
+            self.file_index += 1
+            self.path = join(self.directory, '%s_%05d.h5' % (self.prefix, self.file_index))
+        self.file = h5py.File(self.path + '.tmp', 'w')
+        self.file.create_dataset('frames', shape=(0,) + image.shape, maxshape=(None,) + image.shape,
+                                 chunks=(1,) + image.shape, dtype=image.dtype,
+                                 compression='gzip', compression_opts=self.compression_level)
+        self.file.create_dataset('frame_no', shape=(0,), maxshape=(None,), chunks=(256,), dtype=np.int64)
+        self.file.create_dataset('timestamp', shape=(0,), maxshape=(None,), chunks=(256,), dtype=np.float64)
+        self.count = 0
+        self.file_index += 1
+
+    def append(self, frame_no, timestamp, image):
+        if self.file is None:
+            self._open(image)
+        n = self.count
+        for name in ('frames', 'frame_no', 'timestamp'):
+            self.file[name].resize(n + 1, axis=0)
+        self.file['frames'][n] = image
+        self.file['frame_no'][n] = frame_no
+        self.file['timestamp'][n] = np.nan if timestamp is None else timestamp
+        self.count += 1
+        # keep the file readable if the experiment is cut short
+        self.file.flush()
+        if self.count >= self.frames_per_file:
+            self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            os.rename(self.path + '.tmp', self.path)
+            self.file = None
+
+
+class FrameStackReader:
+    """
+    Random access to the frames in a folder of stacks written by FrameStackWriter, by frame number. Unfinished
+    ('.h5.tmp') stacks are read too.
+    """
+
+    def __init__(self, directory):
+        self.paths = sorted(glob.glob(join(directory, '*.h5')) + glob.glob(join(directory, '*.h5.tmp')))
+        self.files = {}
+        # frame number -> (stack path, row)
+        self.index = {}
+        self.timestamps = {}
+        for path in self.paths:
+            with h5py.File(path, 'r') as hf:
+                if 'frames' not in hf:
+                    # e.g. the neural net detections file
+                    continue
+                frame_nos = hf['frame_no'][:]
+                timestamps = hf['timestamp'][:]
+            for row, (frame_no, timestamp) in enumerate(zip(frame_nos, timestamps)):
+                self.index[int(frame_no)] = (path, row)
+                self.timestamps[int(frame_no)] = float(timestamp)
+
+    def frame_numbers(self):
+        return sorted(self.index)
+
+    def timestamp(self, frame_no):
+        return self.timestamps[frame_no]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, frame_no):
+        path, row = self.index[frame_no]
+        if path not in self.files:
+            self.files[path] = h5py.File(path, 'r')
+        return self.files[path]['frames'][row]
+
+    def close(self):
+        for hf in self.files.values():
+            hf.close()
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
@@ -1,14 +1,18 @@
+import csv
+import os
 import cv2
 import numpy as np
 import threading
-import queue
-import io
 from kivy.logger import Logger
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from statistics import mean
 from os.path import join
 from imageProcessing.CNN import CNN
+from imageProcessing.image_writer import image_writer_from_parameters
+from imageProcessing.motion_vectors import aggregate_motion_vectors, parse_roi
+from imageProcessing.tracking import MultiWormTracker
 
 import picamera
 import picamera.array
@@ -16,7 +20,8 @@ import picamera.array
 
 def get_image_mask(img, imaging_parameters):
 
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     im_limx = img.shape[0] - 2
     im_limy = img.shape[1] - 2
     # currently copy pasta'd from Tierpsy Tracker
@@ -56,6 +61,10 @@ def get_image_mask(img, imaging_parameters):
 
     # drawContours left an extra line if the blob touches the border. It is
     # necessary to remove it
+    return _dilate_mask(mask, imaging_parameters)
+
+
+def _dilate_mask(mask, imaging_parameters):
     mask[0, :] = 0
     mask[:, 0] = 0
     mask[-1, :] = 0
@@ -70,6 +79,87 @@ def get_image_mask(img, imaging_parameters):
     return mask
 
 
+def _good_components(img, imaging_parameters):
+    """
+    Label the thresholded blobs of a grayscale image and pick out the ones between min_area and max_area that (unless
+    keep_border_data is set) don't touch the image border, with one array operation over all blobs instead of a loop
+    over contours. Areas are those cv2.contourArea gives a blob's outer contour, holes included, worked out from pixel
+    counts with Pick's theorem: a polygon through the centres of the B edge pixels of a blob of N pixels (holes filled)
+    has area N - B/2 - 1. That's exact unless the contour passes through a pixel twice, where a blob is only joined
+    diagonally, which makes it out by a pixel or two. Returns the blob label image, a boolean 'keep' flag per label,
+    the area of every label, and the hole label image with a 'keep' flag per hole (holes of kept blobs are kept).
+    """
+    mask = cv2.adaptiveThreshold(
+        img,
+        255,
+        cv2.ADAPTIVE_THRESH_MEAN_C,
+        cv2.THRESH_BINARY,
+        imaging_parameters['thresh_block_size'],
+        -imaging_parameters['threshold_c'])
+    n_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    left = stats[:, cv2.CC_STAT_LEFT]
+    top = stats[:, cv2.CC_STAT_TOP]
+    right = left + stats[:, cv2.CC_STAT_WIDTH] - 1
+    bottom = top + stats[:, cv2.CC_STAT_HEIGHT] - 1
+    areas = stats[:, cv2.CC_STAT_AREA].astype(np.float64)
+
+    # holes are the (4-connected, the complement of 8-connected blobs) background regions that don't reach the
+    # border. The pixel to the left of a hole's first pixel belongs to the blob around it
+    n_holes, hole_labels, hole_stats, hole_centroids = cv2.connectedComponentsWithStats(cv2.bitwise_not(mask),
+                                                                                        connectivity=4)
+    hole_left = hole_stats[:, cv2.CC_STAT_LEFT]
+    hole_top = hole_stats[:, cv2.CC_STAT_TOP]
+    inner = (hole_left > 0) & (hole_top > 0) & \
+            (hole_left + hole_stats[:, cv2.CC_STAT_WIDTH] < img.shape[1]) & \
+            (hole_top + hole_stats[:, cv2.CC_STAT_HEIGHT] < img.shape[0])
+    # hole label 0 is the blobs themselves
+    inner[0] = False
+    holes = np.flatnonzero(inner)
+    first_x = np.argmax(hole_labels[hole_top[holes]] == holes[:, None], axis=1)
+    around = labels[hole_top[holes], first_x - 1]
+    np.add.at(areas, around, hole_stats[holes, cv2.CC_STAT_AREA])
+    # the edge pixels of the blobs with their holes filled, i.e. the pixels their outer contours run through
+    filled = mask.copy()
+    filled[inner[hole_labels]] = 255
+    eroded = cv2.erode(filled, cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3)),
+                       borderType=cv2.BORDER_CONSTANT, borderValue=0)
+    edges = np.bincount(labels[filled > eroded], minlength=n_labels)
+    areas = np.maximum(areas - edges / 2 - 1, 0)
+
+    keep = (areas >= imaging_parameters['min_area']) & (areas <= imaging_parameters['max_area'])
+    if not imaging_parameters['keep_border_data']:
+        # same limits as the contour check: blobs reaching within a pixel of the border are dropped
+        keep &= (left > 1) & (top > 1) & (right < img.shape[1] - 2) & (bottom < img.shape[0] - 2)
+    # label 0 is the background
+    keep[0] = False
+    keep_holes = np.zeros(n_holes, dtype=bool)
+    keep_holes[holes] = keep[around]
+    return labels, keep, areas, hole_labels, keep_holes
+
+
+def get_component_mask(img, imaging_parameters):
+    """
+    Drop-in alternative to get_image_mask using connected components with stats, which is much faster when there are
+    thousands of blobs. Holes in kept blobs are filled, as drawing a filled contour does, and areas match
+    cv2.contourArea (see _good_components) except where a blob is only joined diagonally, so a blob within a pixel or
+    two of min_area or max_area may occasionally be classified differently. A hole only ever counts as part of the
+    blob around it, whereas get_image_mask also judges the hole's own contour as a blob; that only makes a difference
+    when a blob too big to keep has worm-sized holes in it.
+    """
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    labels, keep, areas, hole_labels, keep_holes = _good_components(img, imaging_parameters)
+    # render every kept blob and its holes at once with a lookup from label to mask value
+    mask = (keep[labels] | keep_holes[hole_labels]).astype(img.dtype)
+    return _dilate_mask(mask, imaging_parameters)
+
+
+def get_component_areas(img, imaging_parameters):
+    """ Drop-in alternative to get_contour_areas, see get_component_mask for how areas are measured. """
+    labels, keep, areas, hole_labels, keep_holes = _good_components(img, imaging_parameters)
+    return mean(areas[keep].tolist())
+
+
 def apply_mask(img, mask):
     img = cv2.bitwise_and(img, img, mask=mask)
     return img
@@ -133,236 +223,820 @@ def delta_movement(im1, im2, frame_no, imaging_parameters):
     return mvmnt
 
 
+class DeltaKernel:
+    """
+    Per-thread version of delta_movement for the per-frame path. It keeps its scratch images between calls, does the
+    subtraction, opening and thresholding in place and counts pixels with cv2.countNonZero, so no temporaries are
+    allocated per frame. It returns the same pixel count as delta_movement.
+    """
+
+    def __init__(self, imaging_parameters, writer=None, subdir='processed'):
+        self.imaging_parameters = imaging_parameters
+        # processed images are queued on this ImageWriter if there is one, and written inline otherwise
+        self.writer = writer
+        self.subdir = subdir
+        self.diff = None
+        self.moved1 = None
+        self.moved2 = None
+        self.last_mvmnt = 0
+
+    def __call__(self, im1, im2, frame_no):
+        imaging_parameters = self.imaging_parameters
+        if self.diff is None or self.diff.shape != im1.shape:
+            self.diff, self.moved1, self.moved2 = [np.empty(im1.shape, dtype=np.uint8) for i in range(3)]
+        strel = imaging_parameters['strel']
+        # cv2.threshold keeps pixels strictly above the threshold, like the '>' in delta_movement
+        threshold = imaging_parameters['delta_threshold']
+
+        cv2.subtract(im1, im2, dst=self.diff)
+        cv2.morphologyEx(self.diff, cv2.MORPH_OPEN, strel, dst=self.moved1)
+        cv2.threshold(self.moved1, threshold, 255, cv2.THRESH_BINARY, dst=self.moved1)
+
+        cv2.subtract(im2, im1, dst=self.diff)
+        cv2.morphologyEx(self.diff, cv2.MORPH_OPEN, strel, dst=self.moved2)
+        cv2.threshold(self.moved2, threshold, 255, cv2.THRESH_BINARY, dst=self.moved2)
+
+        mvmnt = cv2.countNonZero(self.moved1) + cv2.countNonZero(self.moved2)
+        self.last_mvmnt = mvmnt
+
+        if imaging_parameters['save_processed_images']:
+            cv2.bitwise_or(self.moved1, self.moved2, dst=self.diff)
+            im_diff = cv2.cvtColor(self.diff, cv2.COLOR_GRAY2RGB)
+            if self.writer is not None:
+                self.writer.save(self.subdir, frame_no, im_diff, copy=False)
+            else:
+                fn = 'img' + str(frame_no) + '.png'
+                fp2 = join(imaging_parameters['img_dir'], self.subdir, fn)
+                cv2.imwrite(fp2, im_diff)
+
+        return mvmnt
+
+    def edges_moved(self):
+        """ Which edges (top, bottom, left, right) of the last delta had moving pixels on them. """
+        if self.last_mvmnt == 0:
+            return False, False, False, False
+        edges = (np.s_[0, :], np.s_[-1, :], np.s_[:, 0], np.s_[:, -1])
+        return tuple(bool(self.moved1[edge].any() or self.moved2[edge].any()) for edge in edges)
+
+
+class BackgroundModel:
+    """
+    Online model of the empty plate for 'background subtraction' mode. Each frame is compared against the model rather
+    than against the frame before it, and the model is then updated in place, either as an exponentially weighted
+    running average or with OpenCV's Gaussian mixture (MOG2) subtractor. The work per frame is a handful of
+    whole-image operations into buffers kept between calls, so memory use doesn't grow over an experiment. Returns the
+    number of foreground pixels and their centroid.
+    """
+
+    def __init__(self, imaging_parameters, writer=None, subdir='processed'):
+        self.imaging_parameters = imaging_parameters
+        self.writer = writer
+        self.subdir = subdir
+        self.method = imaging_parameters['bg_method']
+        # fraction of the model replaced by each new frame
+        self.learning_rate = imaging_parameters['bg_learning_rate']
+        self.threshold = imaging_parameters['bg_threshold']
+        # frames are analysed concurrently, so the model is updated by one of them at a time, in the order they finish
+        self.lock = threading.Lock()
+        self.mog = None
+        if self.method == 'gaussian mixture':
+            self.mog = cv2.createBackgroundSubtractorMOG2(detectShadows=False)
+        self.background = None
+        self.background_u8 = None
+        self.diff = None
+        self.foreground = None
+
+    def __call__(self, im, frame_no):
+        with self.lock:
+            if self.background is None or self.background.shape != im.shape:
+                self.background = im.astype(np.float32)
+                self.background_u8, self.diff, self.foreground = [np.empty(im.shape, dtype=np.uint8)
+                                                                  for i in range(3)]
+                if self.mog is not None:
+                    self.mog.apply(im, self.diff, 1)
+                # the first frame only seeds the model
+                return None
+
+            if self.mog is not None:
+                self.mog.apply(im, self.diff, self.learning_rate)
+            else:
+                cv2.convertScaleAbs(self.background, dst=self.background_u8)
+                cv2.absdiff(im, self.background_u8, dst=self.diff)
+                cv2.threshold(self.diff, self.threshold, 255, cv2.THRESH_BINARY, dst=self.diff)
+                cv2.accumulateWeighted(im, self.background, self.learning_rate)
+            # remove speckle, as for image deltas
+            cv2.morphologyEx(self.diff, cv2.MORPH_OPEN, self.imaging_parameters['strel'], dst=self.foreground)
+
+            fg_pixels = cv2.countNonZero(self.foreground)
+            centroid_x, centroid_y = None, None
+            if fg_pixels > 0:
+                moments = cv2.moments(self.foreground, binaryImage=True)
+                centroid_x = moments['m10'] / moments['m00']
+                centroid_y = moments['m01'] / moments['m00']
+
+            if self.imaging_parameters['save_processed_images']:
+                im_fg = cv2.cvtColor(self.foreground, cv2.COLOR_GRAY2RGB)
+                if self.writer is not None:
+                    self.writer.save(self.subdir, frame_no, im_fg, copy=False)
+                else:
+                    fp = join(self.imaging_parameters['img_dir'], self.subdir, 'img' + str(frame_no) + '.png')
+                    cv2.imwrite(fp, im_fg)
+
+            return fg_pixels, centroid_x, centroid_y
+
+
+class InferenceGate:
+    """
+    Cheap check run before the neural net, for 'neural net' mode. Each image is shrunk by scale and compared with the
+    last image the neural net was actually run on; if no pixel of the small image has changed by more than threshold
+    grey levels the worm can't have moved, so inference is skipped. The neural net is still run at least once every
+    max_skips + 1 images so the last location can't go stale.
+    """
+
+    def __init__(self, imaging_parameters, scale=8):
+        self.threshold = imaging_parameters['nn_gate_threshold']
+        self.max_skips = imaging_parameters['nn_gate_max_skips']
+        self.scale = scale
+        self.lock = threading.Lock()
+        self.reference = None
+        self.diff = None
+        self.skips_in_row = 0
+        self.checked = 0
+        self.skipped = 0
+
+    def shrink(self, im):
+        height, width = im.shape[:2]
+        size = (max(width // self.scale, 1), max(height // self.scale, 1))
+        # area interpolation averages out pixel noise
+        return cv2.resize(im, size, interpolation=cv2.INTER_AREA)
+
+    def should_skip(self, small):
+        with self.lock:
+            self.checked += 1
+            if self.reference is None or self.reference.shape != small.shape or \
+                    self.skips_in_row >= self.max_skips:
+                return False
+            if self.diff is None or self.diff.shape != small.shape:
+                self.diff = np.empty(small.shape, dtype=np.uint8)
+            cv2.absdiff(small, self.reference, dst=self.diff)
+            if cv2.minMaxLoc(self.diff)[1] > self.threshold:
+                return False
+            self.skips_in_row += 1
+            self.skipped += 1
+            return True
+
+    def inferred(self, small):
+        """ Record the image the neural net was just run on. """
+        with self.lock:
+            self.reference = small
+            self.skips_in_row = 0
+
+
+class RoiTracker:
+    """
+    Keeps a padded bounding box around the worm so that image deltas only need to be taken inside it. The box is
+    found with get_image_mask (or get_component_mask) and refreshed every refresh_frames frames, or on the next frame
+    if motion reaches one of its edges, i.e. the worm may be leaving it.
+    """
+
+    def __init__(self, imaging_parameters):
+        self.imaging_parameters = imaging_parameters
+        self.refresh_frames = imaging_parameters['roi_refresh_frames']
+        self.padding = imaging_parameters['roi_padding']
+        if imaging_parameters['roi_mask_method'] == 'components':
+            self.get_mask = get_component_mask
+        else:
+            self.get_mask = get_image_mask
+        self.lock = threading.Lock()
+        # x0, y0, x1, y1
+        self.box = None
+        self.last_refresh = None
+        self.stale = True
+
+    def get_box(self, frame_no, im):
+        with self.lock:
+            if self.stale or abs(frame_no - self.last_refresh) >= self.refresh_frames:
+                self.refresh(frame_no, im)
+            return self.box
+
+    def refresh(self, frame_no, im):
+        height, width = im.shape[:2]
+        x, y, w, h = cv2.boundingRect(self.get_mask(im, self.imaging_parameters))
+        if w == 0 or h == 0:
+            # nothing that looks like a worm, so fall back to the whole frame
+            self.box = (0, 0, width, height)
+        else:
+            self.box = (max(x - self.padding, 0), max(y - self.padding, 0),
+                        min(x + w + self.padding, width), min(y + h + self.padding, height))
+        self.last_refresh = frame_no
+        self.stale = False
+        Logger.debug('RoiTracker: frame %s, ROI is %s' % (frame_no, self.box))
+
+    def check_edges(self, box, edges_moved, shape):
+        """ Mark the box for a refresh if there was motion on an edge that isn't the edge of the frame. """
+        x0, y0, x1, y1 = box
+        height, width = shape[:2]
+        top, bottom, left, right = edges_moved
+        if (top and y0 > 0) or (bottom and y1 < height) or (left and x0 > 0) or (right and x1 < width):
+            with self.lock:
+                if box == self.box:
+                    self.stale = True
+
+
+def arena_boxes(imaging_parameters):
+    """
+    The (x0, y0, x1, y1) boxes, in analysis image pixels, of the arenas (e.g. wells) the field of view is split into,
+    or None if the whole image is one arena. A list of boxes ('x0,y0,x1,y1;x0,y0,x1,y1;...') takes precedence over
+    an even grid of 'columns x rows'.
+    """
+    width, height = imaging_parameters['image_resolution']
+    rois = imaging_parameters['arena_rois']
+    if rois.strip() not in ('', 'None'):
+        boxes = []
+        for roi in rois.split(';'):
+            if roi.strip():
+                x0, y0, x1, y1 = parse_roi(roi)
+                boxes.append((max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)))
+        return boxes
+    cols, rows = (int(i) for i in imaging_parameters['arena_grid'].split('x'))
+    if cols * rows == 1:
+        return None
+    return [(col * width // cols, row * height // rows, (col + 1) * width // cols, (row + 1) * height // rows)
+            for row in range(rows) for col in range(cols)]
+
+
+class ArenaLog:
+    """
+    Writes the motion of every arena to a csv file with one row per image and one column per arena, so several
+    animals imaged under one camera are scored separately. Rows must be written in frame order.
+    """
+
+    def __init__(self, path, n_arenas):
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if self.file.tell() == 0:
+            self.writer.writerow(['frame_no', 'timestamp'] + ['arena_%s' % (i + 1) for i in range(n_arenas)])
+
+    def write(self, frame_no, timestamp, motions):
+        self.writer.writerow([frame_no, timestamp] + list(motions))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class LumaStreamOutput:
+    """
+    Custom output for a continuous, unencoded 'yuv' recording on its own splitter port. picamera hands over one
+    complete frame per write; only the Y (luma) plane of a frame is passed on to the ProcessorPool, and frames are
+    decimated so that at most one is analysed every image_frequency seconds (fractions of a second are fine).
+    """
+
+    def __init__(self, pool, image_frequency):
+        self.pool = pool
+        self.image_frequency = image_frequency
+        self.y_size = pool.cur_image.fwidth * pool.cur_image.fheight
+        self.next_sample = None
+
+    def write(self, buf):
+        now = time.monotonic()
+        if self.next_sample is None or now >= self.next_sample:
+            if self.next_sample is None:
+                self.next_sample = now
+            # schedule against the previous deadline rather than now, so the sampling rate doesn't drift
+            self.next_sample += self.image_frequency
+            if self.next_sample < now:
+                self.next_sample = now + self.image_frequency
+            self.pool.write(buf[:self.y_size])
+            self.pool.flush()
+        return len(buf)
+
+    def flush(self):
+        pass
+
+
+class MotionVectorAnalysis(picamera.array.PiMotionAnalysis):
+    """
+    Motion output for the h264 recording in 'motion vectors' mode. The encoder already estimates a motion vector for
+    every macroblock of every frame, so each frame is reduced to a moving pixel count (see aggregate_motion_vectors)
+    and added straight to the motion list, at the full video frame rate and without decoding or differencing images.
+    """
+
+    def __init__(self, camera, motion_list, motion_list_lock, imaging_parameters, size=None):
+        super(MotionVectorAnalysis, self).__init__(camera, size)
+        self.motion_list = motion_list
+        self.motion_list_lock = motion_list_lock
+        self.min_magnitude = imaging_parameters['mv_min_magnitude']
+        self.roi = parse_roi(imaging_parameters['mv_roi'])
+        self.frame_count = 0
+
+    def analyse(self, a):
+        self.frame_count += 1
+        mvmnt = aggregate_motion_vectors(a, self.min_magnitude, self.roi)
+        with self.motion_list_lock:
+            self.motion_list.append(mvmnt)
+
+
+class FrameSequencer:
+    """
+    Puts frames that were processed out of order by concurrent ImageProcessors back in sequence.
+    add_frame() pairs each frame with the one before it, so deltas are always taken between consecutive frames no
+    matter which thread finishes first, and release() hands one result per frame to a callback strictly in frame order.
+    """
+
+    def __init__(self, callback, first_frame=1):
+        self.lock = threading.Lock()
+        self.release_lock = threading.Lock()
+        self.callback = callback
+        self.first_frame = first_frame
+        self.next_frame = first_frame
+        # frame_no -> [timestamp, image buffer, number of pairs still to be formed or finished]
+        self.frames = {}
+        self.results = {}
+        # image buffers are recycled once both pairs a frame belongs to are finished
+        self.free_buffers = []
+
+    def add_frame(self, frame_no, timestamp, im):
+        """
+        Keep a copy of this frame's image (None if it couldn't be read) and return the pairs of consecutive frames it
+        completes, as (frame_no, timestamp, previous image, image) tuples. Each pair must be handed back to
+        finish_pair() once it's been processed.
+        """
+        with self.lock:
+            buf = None
+            if im is not None:
+                for i, free in enumerate(self.free_buffers):
+                    if free.shape == im.shape:
+                        buf = self.free_buffers.pop(i)
+                        break
+                else:
+                    buf = np.empty(im.shape, dtype=im.dtype)
+                np.copyto(buf, im)
+            refs = 1 if frame_no == self.first_frame else 2
+            self.frames[frame_no] = [timestamp, buf, refs]
+
+            pairs = []
+            if frame_no - 1 in self.frames:
+                prev = self.frames[frame_no - 1]
+                pairs.append((frame_no, timestamp, prev[1], buf))
+            if frame_no + 1 in self.frames:
+                nxt = self.frames[frame_no + 1]
+                pairs.append((frame_no + 1, nxt[0], buf, nxt[1]))
+            return pairs
+
+    def finish_pair(self, pair):
+        frame_no = pair[0]
+        with self.lock:
+            for n in (frame_no - 1, frame_no):
+                entry = self.frames[n]
+                entry[2] -= 1
+                if entry[2] == 0:
+                    del self.frames[n]
+                    if entry[1] is not None:
+                        self.free_buffers.append(entry[1])
+
+    def release(self, frame_no, timestamp, result):
+        with self.release_lock:
+            self.results[frame_no] = (timestamp, result)
+            while self.next_frame in self.results:
+                frame_no = self.next_frame
+                timestamp, result = self.results.pop(frame_no)
+                # move on before the callback, so a frame that fails can't hold up every frame after it
+                self.next_frame += 1
+                try:
+                    self.callback(frame_no, timestamp, result)
+                except Exception:
+                    Logger.exception('FrameSequencer: unable to handle the result of frame %s' % frame_no)
+
+
 class ProcessorPool:
 
     def __init__(self, num_threads, cur_image,
                  motion_list, motion_list_lock,
-                 egg_count_list, egg_count_list_lock):
+                 egg_count_list, egg_count_list_lock, channels=3):
         self.done = False
         self.cur_image = cur_image
+        # 3 for bgr captures, 1 for the luma plane of a yuv stream
+        self.channels = channels
         self.lock = threading.Lock()
         self.motion_list = motion_list
         self.motion_list_lock = motion_list_lock
         self.egg_count_list = egg_count_list
         self.egg_count_list_lock = egg_count_list_lock
-        self.frame_queue = queue.Queue(maxsize=num_threads)
+        self.sequencer = FrameSequencer(self.emit)
+        self.writer = None
+        if cur_image.imaging_parameters['save_images'] or cur_image.imaging_parameters['save_processed_images']:
+            self.writer = image_writer_from_parameters(cur_image.imaging_parameters)
+        # frames are numbered as they are handed to a processor, so dropped frames never leave a gap in the sequence
+        self.frame_count = 0
+        self.frame_time = None
+        # preallocate one frame slot per processor, big enough for either padding picamera may use
+        # (see CurrentImage.raw_resolution). Frames are copied straight into a slot as they are written and workers
+        # get views of it, so nothing is allocated per frame.
+        fwidth, fheight = cur_image.raw_resolution((cur_image.width, cur_image.height), splitter=True)
+        self.slot_size = max(fwidth * fheight, cur_image.fwidth * cur_image.fheight) * channels
+        self.frames = np.empty((num_threads, self.slot_size), dtype=np.uint8)
         self.processor = None
-        self.pool = [ImageProcessor(self) for i in range(num_threads)]
+        self.filling = False
+        self.offset = 0
+        self.background = None
+        self.arena_backgrounds = None
+        self.arena_log = None
+        self.arena_executor = None
+        if cur_image.arenas is not None:
+            self.arena_log = ArenaLog(join(cur_image.imaging_parameters['img_dir'], 'arenas.csv'),
+                                      len(cur_image.arenas))
+            # the arenas of a frame are analysed in parallel, by as many threads as there are processors, so a frame
+            # takes about as long as its slowest arena rather than the sum of them
+            self.arena_executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='arena')
+        if cur_image.image_processing_mode == 'background subtraction':
+            if cur_image.arenas is None:
+                self.background = BackgroundModel(cur_image.imaging_parameters, self.writer)
+            else:
+                # every arena has its own picture of its empty well
+                self.arena_backgrounds = [BackgroundModel(cur_image.imaging_parameters, self.writer, subdir)
+                                          for subdir in cur_image.arena_subdirs]
+        # every processor, whether it's idle in the pool or busy with a frame
+        self.processors = [ImageProcessor(self, slot) for slot in range(num_threads)]
+        self.pool = list(self.processors)
         Logger.info('ProcessorPool: initialized')
 
     def write(self, image):
         if not self.done:
-            with self.lock:
-                if self.pool:
-                    # if pool's not empty, grab a processor
-                    self.processor = self.pool.pop()
-                else:
-                    # No processor's available, we'll have to skip
-                    # this frame; you may want to print a warning
-                    # here to see whether you hit this case
-                    self.processor = None
-                    Logger.info('ProcessorPool: no processor available')
+            if not self.filling:
+                # this is the first chunk of a new frame
+                self.filling = True
+                self.offset = 0
+                self.frame_time = time.time()
+                with self.lock:
+                    if self.pool:
+                        # if pool's not empty, grab a processor
+                        self.processor = self.pool.pop()
+                    else:
+                        # No processor's available, we'll have to skip
+                        # this frame; you may want to print a warning
+                        # here to see whether you hit this case
+                        self.processor = None
+                        Logger.info('ProcessorPool: no processor available')
             if self.processor:
-                try:
-                    self.processor.stream.write(image)
-                    self.processor.im_event.set()
-                except MemoryError:
-                    Logger.debug('ProcessorPool: memory error whilst writing image to stream')
+                # captures may arrive in several chunks, so copy each one in after the last
+                chunk = np.frombuffer(image, dtype=np.uint8)
+                end = self.offset + chunk.size
+                if end > self.slot_size:
+                    Logger.debug('ProcessorPool: frame is larger than its slot, dropping it')
+                    with self.lock:
+                        self.pool.append(self.processor)
+                    self.processor = None
+                else:
+                    self.frames[self.processor.slot, self.offset:end] = chunk
+                    self.offset = end
 
     def flush(self):
-        pass
+        # picamera flushes the output once a capture is complete
+        if self.filling:
+            self.filling = False
+            if self.processor:
+                self.frame_count += 1
+                self.processor.nbytes = self.offset
+                self.processor.frame_no = self.frame_count
+                self.processor.timestamp = self.frame_time
+                self.processor.im_event.set()
+                self.processor = None
+
+    def emit(self, frame_no, timestamp, result):
+        """ Called by the sequencer with each frame's result, in frame order. """
+        if result is None:
+            return
+        if self.cur_image.image_processing_mode == 'image delta':
+            if self.arena_log is not None:
+                self.arena_log.write(frame_no, timestamp, result)
+                # one arena drives the LED feedback
+                result = result[self.cur_image.arena_feedback]
+            with self.motion_list_lock:
+                self.motion_list.append(result)
+
+        elif self.cur_image.image_processing_mode == 'background subtraction':
+            if self.arena_log is not None:
+                self.arena_log.write(frame_no, timestamp, [arena_result[0] for arena_result in result])
+                fg_pixels, centroid_x, centroid_y = result[self.cur_image.arena_feedback]
+                if centroid_x is not None:
+                    # arena to image coordinates
+                    x0, y0, x1, y1 = self.cur_image.arenas[self.cur_image.arena_feedback]
+                    centroid_x, centroid_y = centroid_x + x0, centroid_y + y0
+                result = fg_pixels, centroid_x, centroid_y
+            fg_pixels, centroid_x, centroid_y = result
+            with self.motion_list_lock:
+                self.motion_list.append(fg_pixels)
+            if centroid_x is not None:
+                self.cur_image.set_worm_loc(centroid_x, centroid_y)
+
+        elif self.cur_image.image_processing_mode == 'neural net':
+            if self.cur_image.tracker is not None:
+                self.emit_tracks(frame_no, timestamp, result)
+                return
+            num_eggs, new_worm_loc_x, new_worm_loc_y, inferred = result
+            old_worm_loc_x, old_worm_loc_y = self.cur_image.get_last_worm_loc()
+            if not inferred:
+                # the inference gate found the image unchanged, so the worm is where it was
+                new_worm_loc_x, new_worm_loc_y = old_worm_loc_x, old_worm_loc_y
+            # distance between the old and new box centers
+            if new_worm_loc_y is not None and old_worm_loc_y is not None:
+                mvmnt = np.sqrt(np.square(new_worm_loc_x - old_worm_loc_x) +
+                                np.square(new_worm_loc_y - old_worm_loc_y))
+                with self.motion_list_lock:
+                    self.motion_list.append(mvmnt)
+
+            if new_worm_loc_y is not None:
+                # set worm_loc in cur_image
+                self.cur_image.set_worm_loc(new_worm_loc_x, new_worm_loc_y)
+
+            if num_eggs is not None:
+                with self.egg_count_list_lock:
+                    self.egg_count_list.append(num_eggs)
+
+    def emit_tracks(self, frame_no, timestamp, result):
+        """ emit() for multi-worm tracking: the designated track's motion is the one used for LED feedback. """
+        num_eggs, worm_boxes, _, inferred = result
+        tracker = self.cur_image.tracker
+        if inferred:
+            motions = tracker.update(frame_no, timestamp, worm_boxes)
+            mvmnt = motions.get(tracker.designated)
+        else:
+            # the inference gate found the image unchanged, so no worm moved
+            mvmnt = 0 if tracker.designated is not None else None
+        if mvmnt is not None:
+            with self.motion_list_lock:
+                self.motion_list.append(mvmnt)
+        worm_loc_x, worm_loc_y = tracker.designated_center()
+        if worm_loc_x is not None:
+            self.cur_image.set_worm_loc(worm_loc_x, worm_loc_y)
+        if num_eggs is not None:
+            with self.egg_count_list_lock:
+                self.egg_count_list.append(num_eggs)
 
     def exit(self):
-        # make sure frame queue is cleared out
-        while not self.frame_queue.empty():
-            self.frame_queue.get()
-            self.frame_queue.task_done()
-        self.frame_queue.join()
-        if self.processor:
-            with self.lock:
-                self.pool.append(self.processor)
-                self.processor = None
-        # Now, empty the pool, joining each thread as we go
-        while self.pool:
-            with self.lock:
-                try:
-                    proc = self.pool.pop()
-                except IndexError:
-                    pass  # pool is empty
+        # stop handing out frames, then wait for every processor, including the ones still busy with a frame, before
+        # closing the writer, logs and models they use
+        self.done = True
+        for proc in self.processors:
             proc.terminated = True
+        for proc in self.processors:
             proc.join()
+        if self.arena_executor is not None:
+            self.arena_executor.shutdown()
+        if self.writer is not None:
+            self.writer.close()
+        if self.arena_log is not None:
+            self.arena_log.close()
+        if self.cur_image.image_processing_mode == 'neural net':
+            self.cur_image.CNN.close()
+            if self.cur_image.tracker is not None:
+                self.cur_image.tracker.close()
+            gate = self.cur_image.gate
+            if gate is not None:
+                Logger.info('InferenceGate: neural net skipped for %s of %s images' % (gate.skipped, gate.checked))
         Logger.info('ProcessorPool: exiting')
-        self.done = True
 
 
 class ImageProcessor(threading.Thread):
-    def __init__(self, owner):
+    def __init__(self, owner, slot):
         super(ImageProcessor, self).__init__(name='im_processor')
         self.im_event = threading.Event()
-        self.frame_event = threading.Event()
         self.terminated = False
-        self.stream = io.BytesIO()
         self.owner = owner
+        # index of this processor's frame slot in owner.frames, and the frame currently held in it
+        self.slot = slot
+        self.nbytes = 0
+        self.frame_no = None
+        self.timestamp = None
+        self.sequenced = False
+        self.gray = np.empty((owner.cur_image.height, owner.cur_image.width), dtype=np.uint8)
+        self.delta_kernel = DeltaKernel(owner.cur_image.imaging_parameters, owner.writer)
+        self.arena_kernels = None
+        if owner.cur_image.arenas is not None:
+            # each arena keeps its own scratch images, which differ in size
+            self.arena_kernels = [DeltaKernel(owner.cur_image.imaging_parameters, owner.writer, subdir)
+                                  for subdir in owner.cur_image.arena_subdirs]
         self.start()
 
     def run(self):
-        img_parameters = self.owner.cur_image.imaging_parameters
         # This method runs in a separate thread
         while not self.terminated:
             # Wait for an image to be added to the queue
             if self.im_event.wait(1):
-                if self.frame_event.wait(1):
-                    try:
-                        t1 = time.time()
-
-                        if len(self.stream.getvalue()) != (self.owner.cur_image.fwidth *
-                                                           self.owner.cur_image.fheight * 3):
-                            fwidth, fheight = self.owner.cur_image.raw_resolution((self.owner.cur_image.width,
-                                                                                   self.owner.cur_image.height),
-                                                                                  splitter=True)
-                            if len(self.stream.getvalue()) != (fwidth * fheight * 3):
-                                raise picamera.PiCameraValueError(
-                                    'Incorrect buffer length for resolution %dx%d' % (self.owner.cur_image.width,
-                                                                                      self.owner.cur_image.height))
-                        # convert the image to a numpy array usable by opencv
-                        im = np.frombuffer(self.stream.getvalue(), dtype=np.uint8). \
-                            reshape((self.owner.cur_image.fheight, self.owner.cur_image.fwidth, 3))[
-                             :self.owner.cur_image.height, :self.owner.cur_image.width, :]
-                        Logger.debug('ImageProcessor: image converted')
-                        self.frame_event.wait(timeout=5)
-                        frame_no = self.owner.frame_queue.get()
-                        Logger.info('ImageProcessor: Frame %s' % frame_no)
-                        # if it's the first frame, we just convert to grayscale
-                        if frame_no is 1:
-
-                                im = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
-                                if img_parameters['save_images']:
-                                    fp = join(img_parameters['img_dir'], 'unprocessed', 'img1.png')
-                                    cv2.imwrite(fp, im)
-
-                                if self.owner.cur_image.image_processing_mode == 'neural net':
-                                    # see if resizing helps with memory issues?
-                                    # scale_percent = 80  # percent of original size
-                                    # width = int(self.owner.cur_image.fwidth * scale_percent / 100)
-                                    # height = int(self.owner.cur_image.fheight * scale_percent / 100)
-                                    # dim = (width, height)
-                                    # # resize image
-                                    # im = cv2.resize(im, dim, interpolation=cv2.INTER_AREA)
-                                    # get worm location and set it
-                                    with self.owner.cur_image.CNN.lock:
-                                        worm_loc_x, worm_loc_y = self.owner.cur_image.CNN.get_worm_location(im, frame_no)
-                                    self.owner.cur_image.set_worm_loc(worm_loc_x, worm_loc_y)
-
-                                elif self.owner.cur_image.image_processing_mode == 'image delta':
-                                    self.owner.cur_image.set_image(im)
-
-                                time_elapsed = time.time() - t1
-                                Logger.info(
-                                    'ImageProcessor: First image processed, time elapsed is %s, frame no is %s'
-                                    % (time_elapsed, frame_no))
-
-
-                        # if it's past the first frame, convert to gray and calculate the movement delta between this
-                        # and the previous image and send that info to the Update process via the motion_queue
-                        else:
-                                # convert new image to gray
-
-                                im = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
-                                if img_parameters['save_images']:
-                                    fn = 'img' + str(frame_no) + '.png'
-                                    fp = join(img_parameters['img_dir'], 'unprocessed', fn)
-                                    cv2.imwrite(fp, im)
-
-                                if self.owner.cur_image.image_processing_mode == 'image delta':
-                                    im1 = self.owner.cur_image.im
-                                    mvmnt = delta_movement(im1, im, frame_no, img_parameters)
-                                    self.owner.cur_image.set_image(im)
-
-                                    with self.owner.motion_list_lock:
-                                        self.owner.motion_list.append(mvmnt)
-
-                                elif self.owner.cur_image.image_processing_mode == 'neural net':
-                                    # see if resizing helps with memory issues?
-                                    # scale_percent = 80  # percent of original size
-                                    # width = int(self.owner.cur_image.fwidth * scale_percent / 100)
-                                    # height = int(self.owner.cur_image.fheight * scale_percent / 100)
-                                    # dim = (width, height)
-                                    # # resize image
-                                    # im = cv2.resize(im, dim, interpolation=cv2.INTER_AREA)
-                                    if not self.owner.cur_image.nn_count_eggs:
-                                        with self.owner.cur_image.CNN.lock:
-                                            new_worm_loc_x, new_worm_loc_y = \
-                                                self.owner.cur_image.CNN.get_worm_location(im, frame_no)
-
-                                        old_worm_loc_x, old_worm_loc_y = self.owner.cur_image.get_last_worm_loc()
-                                        # distance between the old and new box centers
-                                        if new_worm_loc_y is not None and old_worm_loc_y is not None:
-                                            mvmnt = np.sqrt(np.square(new_worm_loc_x - old_worm_loc_x) +
-                                                            np.square(new_worm_loc_y - old_worm_loc_y))
-
-                                            with self.owner.motion_list_lock:
-                                                self.owner.motion_list.append(mvmnt)
-
-                                        if new_worm_loc_y is not None:
-                                            # set worm_loc in cur_image
-                                            self.owner.cur_image.set_worm_loc(new_worm_loc_x, new_worm_loc_y)
-
-                                    elif self.owner.cur_image.nn_count_eggs:
-                                        with self.owner.cur_image.CNN.lock:
-                                            num_eggs, new_worm_loc_x, new_worm_loc_y = \
-                                                self.owner.cur_image.CNN.get_worm_location_and_count_eggs(im, frame_no)
-
-                                        old_worm_loc_x, old_worm_loc_y = self.owner.cur_image.get_last_worm_loc()
-                                        # distance between the old and new box centers
-                                        if new_worm_loc_y is not None and old_worm_loc_y is not None:
-                                            mvmnt = np.sqrt(np.square(new_worm_loc_x - old_worm_loc_x) +
-                                                            np.square(new_worm_loc_y - old_worm_loc_y))
-
-                                            with self.owner.motion_list_lock:
-                                                self.owner.motion_list.append(mvmnt)
-                                        if new_worm_loc_y is not None:
-                                            # set worm_loc in cur_image
-                                            self.owner.cur_image.set_worm_loc(new_worm_loc_x, new_worm_loc_y)
-
-                                        with self.owner.egg_count_list_lock:
-                                            self.owner.egg_count_list.append(num_eggs)
-
-                                time_elapsed = time.time() - t1
-
-                                Logger.info('ImageProcessor: image processed, time elapsed is %s, frame no is %s'
-                                            % (time_elapsed, frame_no))
-
-                        # reset frame event to False
-                        self.owner.frame_queue.task_done()
-
-                    finally:
-                        self.stream.seek(0)
-                        self.stream.truncate()
-                        # Reset the events
-                        self.im_event.clear()
-                        self.frame_event.clear()
-                        Logger.debug('ImageProcessor: Returning processor to pool')
-                        # Return ourselves to the available pool
-                        with self.owner.lock:
-                            self.owner.pool.append(self)
+                frame_no, timestamp = self.frame_no, self.timestamp
+                self.sequenced = False
+                try:
+                    t1 = time.time()
+                    Logger.info('ImageProcessor: Frame %s' % frame_no)
+                    self.process(self.read_frame(), frame_no, timestamp)
+                    time_elapsed = time.time() - t1
+                    Logger.info('ImageProcessor: image processed, time elapsed is %s, frame no is %s'
+                                % (time_elapsed, frame_no))
+                except Exception as err:
+                    # keep the thread alive - the sequencer would otherwise wait forever for this frame
+                    Logger.warning('ImageProcessor: unable to process frame %s: %s' % (frame_no, err))
+
+                finally:
+                    if not self.sequenced:
+                        # let the sequencer know the frame is missing, so the frames after it aren't held back
+                        self.skip(frame_no, timestamp)
+                    # Reset the event
+                    self.im_event.clear()
+                    Logger.debug('ImageProcessor: Returning processor to pool')
+                    # Return ourselves to the available pool
+                    with self.owner.lock:
+                        self.owner.pool.append(self)
+
+    def read_frame(self):
+        """ Return a grayscale view of the frame in this processor's slot. """
+        cur_image = self.owner.cur_image
+        channels = self.owner.channels
+        fwidth, fheight = cur_image.fwidth, cur_image.fheight
+        if self.nbytes != fwidth * fheight * channels:
+            fwidth, fheight = cur_image.raw_resolution((cur_image.width, cur_image.height), splitter=True)
+            if self.nbytes != (fwidth * fheight * channels):
+                raise picamera.PiCameraValueError(
+                    'Incorrect buffer length for resolution %dx%d' % (cur_image.width, cur_image.height))
+        # view the frame slot as an image usable by opencv, without copying it
+        im = self.owner.frames[self.slot, :self.nbytes].reshape((fheight, fwidth, channels))[
+             :cur_image.height, :cur_image.width, :]
+        if channels == 1:
+            # luma frames are already grayscale
+            return im[:, :, 0]
+        return cv2.cvtColor(im, cv2.COLOR_BGR2GRAY, dst=self.gray)
+
+    def process(self, im, frame_no, timestamp):
+        img_parameters = self.owner.cur_image.imaging_parameters
+        if img_parameters['save_images']:
+            self.owner.writer.save('unprocessed', frame_no, im, timestamp)
+
+        if self.owner.cur_image.image_processing_mode == 'image delta':
+            self.add_delta_frame(frame_no, timestamp, im)
+
+        elif self.owner.cur_image.image_processing_mode == 'neural net':
+            # inference runs concurrently; the distance between consecutive worm locations is worked out in frame
+            # order by ProcessorPool.emit
+            cnn = self.owner.cur_image.CNN
+            gate = self.owner.cur_image.gate
+            num_eggs = None
+            if gate is not None:
+                small = gate.shrink(im)
+                if gate.should_skip(small):
+                    # nothing has changed since the last inference, so the worm hasn't moved
+                    self.release(frame_no, timestamp, (None, None, None, False))
+                    return
+            if self.owner.cur_image.tracker is not None:
+                # every worm is needed, so the whole image is searched; they're matched to tracks in frame order
+                count_eggs = self.owner.cur_image.egg_count_due(timestamp)
+                with cnn.lock:
+                    num_eggs, worm_boxes = cnn.find_all_worms(im, frame_no, timestamp, count_eggs)
+                if gate is not None:
+                    gate.inferred(small)
+                self.release(frame_no, timestamp, (num_eggs, worm_boxes, None, True))
+                return
+            if not self.owner.cur_image.egg_count_due(timestamp):
+                # localization only, which can use the tracking crop
+                with cnn.lock:
+                    worm_loc_x, worm_loc_y = cnn.get_worm_location(im, frame_no, timestamp)
+            else:
+                # eggs can be anywhere, so this searches the whole image and finds the worm in the same pass
+                with cnn.lock:
+                    num_eggs, worm_loc_x, worm_loc_y = cnn.get_worm_location_and_count_eggs(im, frame_no,
+                                                                                             timestamp)
+            if gate is not None:
+                gate.inferred(small)
+            self.release(frame_no, timestamp, (num_eggs, worm_loc_x, worm_loc_y, True))
+
+        elif self.owner.cur_image.image_processing_mode == 'background subtraction':
+            arenas = self.owner.cur_image.arenas
+            if arenas is None:
+                self.release(frame_no, timestamp, self.owner.background(im, frame_no))
+            else:
+                def subtract(background, box):
+                    x0, y0, x1, y1 = box
+                    return background(im[y0:y1, x0:x1], frame_no)
+
+                results = self.map_arenas(subtract, self.owner.arena_backgrounds)
+                # each arena's model is seeded by the first frame it sees, and with several workers that needn't be the
+                # same frame for every arena, so wait until they all have a result
+                self.release(frame_no, timestamp,
+                             results if all(result is not None for result in results) else None)
+
+        else:
+            self.release(frame_no, timestamp, None)
+
+    def map_arenas(self, analyse, models):
+        """
+        Call analyse(model, (x0, y0, x1, y1)) for every arena and its model (a DeltaKernel or BackgroundModel), on the
+        pool's arena threads, and return the results in arena order.
+        """
+        return list(self.owner.arena_executor.map(analyse, models, self.owner.cur_image.arenas))
+
+    def release(self, frame_no, timestamp, result):
+        self.sequenced = True
+        self.owner.sequencer.release(frame_no, timestamp, result)
+
+    def add_delta_frame(self, frame_no, timestamp, im):
+        sequencer = self.owner.sequencer
+        self.sequenced = True
+        if frame_no == sequencer.first_frame:
+            # nothing to compare the first frame against
+            sequencer.release(frame_no, timestamp, None)
+        for pair in sequencer.add_frame(frame_no, timestamp, im):
+            pair_frame_no, pair_timestamp, im1, im2 = pair
+            mvmnt = None
+            try:
+                if im1 is not None and im2 is not None:
+                    roi = self.owner.cur_image.roi
+                    arenas = self.owner.cur_image.arenas
+                    if arenas is not None:
+                        def delta(kernel, box):
+                            x0, y0, x1, y1 = box
+                            return kernel(im1[y0:y1, x0:x1], im2[y0:y1, x0:x1], pair_frame_no)
+
+                        mvmnt = self.map_arenas(delta, self.arena_kernels)
+                    elif roi is None:
+                        mvmnt = self.delta_kernel(im1, im2, pair_frame_no)
+                    else:
+                        # only difference the area around the worm
+                        box = roi.get_box(pair_frame_no, im2)
+                        x0, y0, x1, y1 = box
+                        mvmnt = self.delta_kernel(im1[y0:y1, x0:x1], im2[y0:y1, x0:x1], pair_frame_no)
+                        roi.check_edges(box, self.delta_kernel.edges_moved(), im2.shape)
+            except Exception as err:
+                # a frame can complete two pairs, and both must be finished and released whatever happens to either,
+                # or the frames after them are held back for good
+                mvmnt = None
+                Logger.warning('ImageProcessor: unable to compare frame %s with the one before it: %s'
+                               % (pair_frame_no, err))
+            sequencer.finish_pair(pair)
+            sequencer.release(pair_frame_no, pair_timestamp, mvmnt)
+
+    def skip(self, frame_no, timestamp):
+        if frame_no is None:
+            return
+        if self.owner.cur_image.image_processing_mode == 'image delta':
+            self.add_delta_frame(frame_no, timestamp, None)
+        else:
+            self.release(frame_no, timestamp, None)
 
 
 class CurrentImage:
     def __init__(self, imaging_parameters):
-        self.im = None
         self.imaging_parameters = imaging_parameters
         self.image_processing_mode = imaging_parameters['image_processing_mode']
         self.imaging_parameters['strel'] = cv2.getStructuringElement(cv2.MORPH_CROSS, (5, 5))
         self.lock = threading.Lock()
         self.width, self.height = self.imaging_parameters['image_resolution']
         self.fwidth, self.fheight = self.raw_resolution((self.width, self.height))
+        self.arenas = None
+        if self.image_processing_mode in ('image delta', 'background subtraction'):
+            self.arenas = arena_boxes(self.imaging_parameters)
+        if self.arenas is not None:
+            # index of the arena whose animal drives the LED feedback
+            self.arena_feedback = min(max(self.imaging_parameters['arena_feedback'], 1), len(self.arenas)) - 1
+            self.arena_subdirs = [join('processed', 'arena_%s' % (i + 1)) for i in range(len(self.arenas))]
+            if self.imaging_parameters['save_processed_images']:
+                # both image writers expect the directories they write to, whether pngs or hdf5 stacks, to exist
+                for subdir in self.arena_subdirs:
+                    os.makedirs(join(self.imaging_parameters['img_dir'], subdir), exist_ok=True)
+            Logger.info('CurrentImage: analysing %s arenas %s' % (len(self.arenas), self.arenas))
+        self.roi = None
+        if self.image_processing_mode == 'image delta' and self.imaging_parameters['use_roi']:
+            if self.arenas is None:
+                self.roi = RoiTracker(self.imaging_parameters)
+            else:
+                Logger.info('CurrentImage: arenas are analysed whole, so the ROI setting is ignored')
+        # start without a worm location
+        self.worm_loc = (None, None)
+        self.gate = None
+        self.tracker = None
         if self.image_processing_mode == 'neural net':
-            # start without a worm location
-            self.worm_loc = (None, None)
             self.nn_count_eggs = imaging_parameters['nn_count_eggs']
+            # seconds between egg counts; the worm is located in every image
+            self.egg_interval = imaging_parameters['nn_egg_interval']
+            self.last_egg_count = None
+            if imaging_parameters['nn_gate']:
+                self.gate = InferenceGate(imaging_parameters)
+            if imaging_parameters['nn_multi_worm']:
+                self.tracker = MultiWormTracker(min_iou=imaging_parameters['nn_track_min_iou'],
+                                                max_misses=imaging_parameters['nn_track_max_misses'],
+                                                csv_path=join(imaging_parameters['img_dir'], 'tracks.csv'))
             # load the frozen inference graph and label map, and set up general parameters
+            crop_size = imaging_parameters['nn_crop_size'] if imaging_parameters['nn_tracking'] else None
+            backend = imaging_parameters['nn_backend']
+            backend_kwargs = {}
+            if backend == 'tflite':
+                backend_kwargs['num_threads'] = imaging_parameters['nn_num_threads']
+            elif backend == 'opencv dnn':
+                backend_kwargs['class_offset'] = imaging_parameters['nn_class_offset']
             self.CNN = CNN(self.imaging_parameters['save_processed_images'], self.imaging_parameters['img_dir'],
-                           (self.fwidth, self.fheight))
+                           (self.fwidth, self.fheight), crop_size=crop_size, backend=backend,
+                           backend_kwargs=backend_kwargs, worker_process=imaging_parameters['nn_worker_process'],
+                           max_batch=imaging_parameters['nn_max_batch'],
+                           max_latency=imaging_parameters['nn_batch_latency'],
+                           output_dims=imaging_parameters['output_resolution'])
 
         Logger.debug('CurrentImage: initialized')
 
@@ -381,10 +1055,15 @@ class CurrentImage:
         fheight = (height + 15) & ~15
         return fwidth, fheight
 
-    def set_image(self, im):
+    def egg_count_due(self, timestamp):
+        """ Whether eggs should be counted in the image taken at timestamp. If so, the count is booked for it. """
+        if not self.nn_count_eggs:
+            return False
         with self.lock:
-            self.im = im
-            Logger.debug('CurrentImage: updated')
+            if self.last_egg_count is None or timestamp - self.last_egg_count >= self.egg_interval:
+                self.last_egg_count = timestamp
+                return True
+            return False
 
     def set_worm_loc(self, worm_loc_x, worm_loc_y):
         with self.lock:
@@ -0,0 +1,118 @@
+import os
+import queue
+import threading
+from os.path import join
+
+import cv2
+from kivy.logger import Logger
+
+from imageProcessing.frame_store import FrameStackWriter
+
+
+class ImageWriter(threading.Thread):
+    """
+    Saves analysis images from a background thread, so that slow SD card writes don't hold up image processing.
+    Images wait in a bounded queue; when it is full they are either dropped or the caller blocks until there's room,
+    depending on block_when_full. An image that can't be written (e.g. the SD card is full) is logged and counted, and
+    the writer carries on with the next one. Counts of queued, written, dropped and failed images are kept for logging.
+    """
+
+    def __init__(self, img_dir, queue_size=32, block_when_full=False, png_compression=1):
+        super(ImageWriter, self).__init__(name='image_writer')
+        self.img_dir = img_dir
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.block_when_full = block_when_full
+        # 0 (fastest, largest files) to 9 (slowest, smallest) - png is lossless at every level
+        self.params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.start()
+
+    def save(self, subdir, frame_no, image, timestamp=None, copy=True):
+        """
+        Queue an image to be written as <img_dir>/<subdir>/img<frame_no>.png. Pass copy=False only if the caller
+        won't touch the image again - buffers that get reused must be copied.
+        """
+        if copy:
+            image = image.copy()
+        item = (subdir, frame_no, timestamp, image)
+        try:
+            if self.block_when_full:
+                self.queue.put(item)
+            else:
+                self.queue.put_nowait(item)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            Logger.debug('ImageWriter: queue full, dropped image %s' % frame_no)
+            return False
+        with self.lock:
+            self.queued += 1
+        return True
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            subdir, frame_no, timestamp, image = item
+            try:
+                self.write(subdir, frame_no, timestamp, image)
+            except Exception as err:
+                # the thread has to keep emptying the queue, or callers blocked on a full queue would wait forever
+                with self.lock:
+                    self.failed += 1
+                Logger.warning('ImageWriter: unable to save image %s to %s: %s' % (frame_no, subdir, err))
+                continue
+            with self.lock:
+                self.written += 1
+
+    def write(self, subdir, frame_no, timestamp, image):
+        fp = join(self.img_dir, subdir, 'img' + str(frame_no) + '.png')
+        if not cv2.imwrite(fp, image, self.params):
+            raise IOError('cv2.imwrite failed for %s' % fp)
+
+    def close(self):
+        # everything already queued is written before the thread exits
+        self.queue.put(None)
+        self.join()
+        Logger.info('ImageWriter: %s images queued, %s written, %s dropped, %s failed' % (
+            self.queued, self.written, self.dropped, self.failed))
+
+
+class StackImageWriter(ImageWriter):
+    """
+    ImageWriter that appends images to chunked HDF5 stacks (see FrameStackWriter) in each subdirectory instead of
+    writing one png per image.
+    """
+
+    def __init__(self, img_dir, frames_per_file=500, **kwargs):
+        self.frames_per_file = frames_per_file
+        self.stacks = {}
+        super(StackImageWriter, self).__init__(img_dir, **kwargs)
+
+    def write(self, subdir, frame_no, timestamp, image):
+        if subdir not in self.stacks:
+            # every image processing worker process has its own writer, so stacks are named by process id
+            self.stacks[subdir] = FrameStackWriter(join(self.img_dir, subdir), 'stack_%s' % os.getpid(),
+                                                   frames_per_file=self.frames_per_file,
+                                                   compression_level=self.params[1])
+        self.stacks[subdir].append(frame_no, timestamp, image)
+
+    def close(self):
+        super(StackImageWriter, self).close()
+        for stack in self.stacks.values():
+            stack.close()
+
+
+def image_writer_from_parameters(imaging_parameters):
+    kwargs = {'queue_size': imaging_parameters['image_queue_size'],
+              'block_when_full': imaging_parameters['image_queue_policy'] == 'block',
+              'png_compression': imaging_parameters['png_compression']}
+    if imaging_parameters['image_storage'] == 'hdf5 stacks':
+        return StackImageWriter(imaging_parameters['img_dir'],
+                                frames_per_file=imaging_parameters['frames_per_stack'], **kwargs)
+    return ImageWriter(imaging_parameters['img_dir'], **kwargs)
@@ -0,0 +1,219 @@
+import re
+from os.path import join, exists
+
+import cv2
+import numpy as np
+from kivy.logger import Logger
+
+
+class InferenceError(Exception):
+    """ Raised by a backend when a detection couldn't be run, e.g. because the Pi ran out of memory. """
+
+
+def load_label_map(path):
+    """ Read a label_map.pbtxt into a category index ({id: {'id': id, 'name': name}}) without object_detection. """
+    with open(path) as f:
+        text = f.read()
+    category_index = {}
+    for item in re.findall(r'item\s*{(.*?)}', text, re.DOTALL):
+        class_id = int(re.search(r'\bid:\s*(\d+)', item).group(1))
+        name = re.search(r'\b(?:display_name|name):\s*[\'"](.*?)[\'"]', item).group(1)
+        category_index[class_id] = {'id': class_id, 'name': name}
+    return category_index
+
+
+class TFSessionBackend:
+    """
+    Runs the frozen TF1 object detection graph in a tf.compat.v1.Session. This is the reference backend, but
+    importing tensorflow and loading the graph takes minutes and hundreds of MB on a Pi.
+    """
+
+    def __init__(self, model_dir):
+        # only pay for the tensorflow import if this backend is used
+        import tensorflow as tf
+        self.tf = tf
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            od_graph_def = tf.compat.v1.GraphDef()
+            with tf.io.gfile.GFile(join(model_dir, 'frozen_inference_graph.pb'), 'rb') as fid:
+                serialized_graph = fid.read()
+                od_graph_def.ParseFromString(serialized_graph)
+                tf.import_graph_def(od_graph_def, name='')
+        self.sess = tf.compat.v1.Session(graph=self.graph)
+        self.fetches = [self.graph.get_tensor_by_name(name + ':0') for name in
+                        ('detection_boxes', 'detection_scores', 'detection_classes', 'num_detections')]
+        self.image_tensor = self.graph.get_tensor_by_name('image_tensor:0')
+
+    def run(self, image):
+        try:
+            boxes, scores, classes, num_detections = self.sess.run(
+                self.fetches, feed_dict={self.image_tensor: np.expand_dims(image, axis=0)})
+        except self.tf.compat.v1.errors.ResourceExhaustedError as err:
+            raise InferenceError('out of memory: %s' % err)
+        return np.squeeze(classes).astype(np.int32), np.squeeze(boxes), np.squeeze(scores)
+
+    def run_batch(self, images):
+        if len(images) == 1 or len({image.shape for image in images}) > 1:
+            # the graph takes a batch of images of one size
+            return [self.run(image) for image in images]
+        try:
+            boxes, scores, classes, num_detections = self.sess.run(
+                self.fetches, feed_dict={self.image_tensor: np.stack(images)})
+        except self.tf.compat.v1.errors.ResourceExhaustedError as err:
+            raise InferenceError('out of memory: %s' % err)
+        return [(classes[i].astype(np.int32), boxes[i], scores[i]) for i in range(len(images))]
+
+
+class OpenCVDNNBackend:
+    """
+    Runs the same frozen graph with OpenCV's DNN module, which needs the text graph description made for it by
+    OpenCV's tf_text_graph_ssd.py or tf_text_graph_faster_rcnn.py script (saved as frozen_inference_graph.pbtxt).
+    Much lighter than tensorflow to load.
+    """
+
+    def __init__(self, model_dir, class_offset=0):
+        self.net = cv2.dnn.readNetFromTensorflow(join(model_dir, 'frozen_inference_graph.pb'),
+                                                 join(model_dir, 'frozen_inference_graph.pbtxt'))
+        # Faster R-CNN text graphs number classes from 0 rather than from 1 like the label map
+        self.class_offset = class_offset
+
+    def run(self, image):
+        return self.run_batch([image])[0]
+
+    def run_batch(self, images):
+        height, width = images[0].shape[:2]
+        if any(image.shape != images[0].shape for image in images):
+            return [self.run(image) for image in images]
+        self.net.setInput(cv2.dnn.blobFromImages(images, size=(width, height), swapRB=False, crop=False))
+        # one row per detection: (image, class, score, left, top, right, bottom)
+        detections = self.net.forward()[0, 0]
+        results = []
+        for i in range(len(images)):
+            image_detections = detections[detections[:, 0] == i]
+            image_detections = image_detections[np.argsort(-image_detections[:, 2], kind='stable')]
+            classes = image_detections[:, 1].astype(np.int32) + self.class_offset
+            boxes = np.clip(image_detections[:, [4, 3, 6, 5]], 0, 1)
+            results.append((classes, boxes, image_detections[:, 2]))
+        return results
+
+
+class TFLiteBackend:
+    """
+    Runs a TFLite conversion of the detection model (detect.tflite, made with the object detection API's
+    export_tflite_ssd_graph.py and the TFLite converter). Uses the small tflite_runtime package if it's installed and
+    falls back on tensorflow's copy of the interpreter. Images are resized to the model's fixed input size.
+    """
+
+    def __init__(self, model_dir, num_threads=4):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        self.interpreter = Interpreter(model_path=join(model_dir, 'detect.tflite'), num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        input_details = self.interpreter.get_input_details()[0]
+        self.input_index = input_details['index']
+        self.input_dtype = input_details['dtype']
+        self.input_height, self.input_width = input_details['shape'][1:3]
+        # boxes, classes, scores, count from the TFLite_Detection_PostProcess op
+        self.output_indexes = [d['index'] for d in self.interpreter.get_output_details()[:3]]
+
+    def run(self, image):
+        if image.shape[:2] != (self.input_height, self.input_width):
+            image = cv2.resize(image, (self.input_width, self.input_height), interpolation=cv2.INTER_AREA)
+        if self.input_dtype == np.float32:
+            # float models expect values in [-1, 1]
+            image = (image.astype(np.float32) - 127.5) / 127.5
+        self.interpreter.set_tensor(self.input_index, np.expand_dims(image, axis=0))
+        self.interpreter.invoke()
+        boxes, classes, scores = [self.interpreter.get_tensor(i)[0] for i in self.output_indexes]
+        # the post-processing op numbers classes from 0, the label map from 1
+        return classes.astype(np.int32) + 1, np.clip(boxes, 0, 1), scores
+
+    def run_batch(self, images):
+        # the converted model has a fixed batch size of one
+        return [self.run(image) for image in images]
+
+
+BACKENDS = {'tensorflow': TFSessionBackend,
+            'opencv dnn': OpenCVDNNBackend,
+            'tflite': TFLiteBackend}
+
+
+def model_input_size(name, model_dir, frame_size):
+    """
+    The (width, height) the model will scale a frame_size (width, height) image to before detection, so analysis
+    images can be captured at that size by the camera's hardware resizer instead of being resized in software. Read
+    from the TFLite model's input, or from the image_resizer in the object detection API's pipeline.config next to a
+    frozen graph. Returns None if it can't be worked out.
+    """
+    if name == 'tflite':
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        height, width = Interpreter(model_path=join(model_dir, 'detect.tflite')).get_input_details()[0]['shape'][1:3]
+        return int(width), int(height)
+
+    config_path = join(model_dir, 'pipeline.config')
+    if not exists(config_path):
+        return None
+    with open(config_path) as f:
+        config = f.read()
+    fixed = re.search(r'fixed_shape_resizer\s*{[^}]*?height:\s*(\d+)[^}]*?width:\s*(\d+)', config)
+    if fixed:
+        return int(fixed.group(2)), int(fixed.group(1))
+    keep_aspect = re.search(r'keep_aspect_ratio_resizer\s*{[^}]*?min_dimension:\s*(\d+)[^}]*?max_dimension:\s*(\d+)',
+                            config)
+    if keep_aspect:
+        min_dimension, max_dimension = int(keep_aspect.group(1)), int(keep_aspect.group(2))
+        width, height = frame_size
+        # the short side is scaled to min_dimension, unless that makes the long side longer than max_dimension
+        scale = min_dimension / min(width, height)
+        if max(width, height) * scale > max_dimension:
+            scale = max_dimension / max(width, height)
+        return int(round(width * scale)), int(round(height * scale))
+    return None
+
+
+def load_backend(name, model_dir, **kwargs):
+    """ Load the named backend. Every backend has run(image) and run_batch(images) for RGB uint8 images. """
+    backend = BACKENDS[name](model_dir, **kwargs)
+    Logger.info('InferenceBackend: %s model loaded from %s' % (name, model_dir))
+    return backend
+
+
+def backend_parity(reference, candidate, images, min_score=0.8, min_iou=0.7):
+    """
+    Compare two backends on a list of RGB images, matching the confident (score >= min_score) detections of each by
+    class and box overlap. Returns a list of (image index, message) for every image where they disagree - an empty
+    list means the candidate backend can stand in for the reference.
+    """
+    mismatches = []
+    for i, image in enumerate(images):
+        detections = []
+        for backend in (reference, candidate):
+            classes, boxes, scores = backend.run(image)
+            keep = scores >= min_score
+            detections.append((classes[keep], boxes[keep].reshape(-1, 4)))
+        (ref_classes, ref_boxes), (cand_classes, cand_boxes) = detections
+        if len(ref_classes) != len(cand_classes):
+            mismatches.append((i, '%s detections vs %s' % (len(ref_classes), len(cand_classes))))
+            continue
+        for ref_class, ref_box in zip(ref_classes, ref_boxes):
+            same_class = cand_boxes[cand_classes == ref_class]
+            if not len(same_class) or box_iou(ref_box, same_class).max() < min_iou:
+                mismatches.append((i, 'no match for class %s box %s' % (ref_class, ref_box)))
+    return mismatches
+
+
+def box_iou(box, boxes):
+    """ Intersection over union of one (ymin, xmin, ymax, xmax) box with each row of boxes. """
+    ymin = np.maximum(box[0], boxes[:, 0])
+    xmin = np.maximum(box[1], boxes[:, 1])
+    ymax = np.minimum(box[2], boxes[:, 2])
+    xmax = np.minimum(box[3], boxes[:, 3])
+    intersection = np.clip(ymax - ymin, 0, None) * np.clip(xmax - xmin, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return intersection / (area + areas - intersection)
@@ -0,0 +1,178 @@
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+from kivy.logger import Logger
+
+from imageProcessing.inference_backends import InferenceError, load_backend
+
+
+def inference_worker(backend_name, model_dir, backend_kwargs, shm_name, n_slots, slot_size,
+                     task_queue, result_queue, max_batch, max_latency):
+    """
+    Runs in the inference process. The model is loaded once, and then None, or the error if it couldn't be loaded, is
+    sent back to say so. Each task names a request, the shared memory slot holding its image and the image's shape.
+    Tasks that arrive within max_latency seconds of the first one waiting (up to max_batch of them) are run through
+    the model together, and the results are sent back tagged with their request numbers. Any error is sent back as
+    an InferenceError in place of the results, since the main process is waiting on them.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    slots = np.ndarray((n_slots, slot_size), dtype=np.uint8, buffer=shm.buf)
+    try:
+        try:
+            backend = load_backend(backend_name, model_dir, **backend_kwargs)
+        except Exception as err:
+            result_queue.put(InferenceError('%s: %s' % (type(err).__name__, err)))
+            return
+        result_queue.put(None)
+        stop = False
+        while not stop:
+            task = task_queue.get()
+            if task is None:
+                break
+            batch = [task]
+            deadline = time.monotonic() + max_latency
+            while len(batch) < max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    task = task_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if task is None:
+                    stop = True
+                    break
+                batch.append(task)
+
+            try:
+                images = [slots[slot, :int(np.prod(shape))].reshape(shape) for request, slot, shape in batch]
+                results = backend.run_batch(images)
+            except InferenceError as err:
+                results = [err] * len(batch)
+            except Exception as err:
+                # the exception itself may not pickle, so send its description
+                results = [InferenceError('%s: %s' % (type(err).__name__, err))] * len(batch)
+            images = None
+            result_queue.put([(request, result) for (request, slot, shape), result in zip(batch, results)])
+    finally:
+        del slots
+        shm.close()
+
+
+class RemoteBackend:
+    """
+    Inference backend that runs another backend in a separate, long-lived process, so tensorflow's memory isn't part
+    of the main program and image processing threads don't have to take turns with the model. Images are handed over
+    through shared memory, and requests from several threads that arrive close together are run as one batch.
+    Has the same run(image) interface as the backends it wraps; run blocks until its own result is back.
+    """
+
+    def __init__(self, backend_name, model_dir, backend_kwargs, max_image_size, max_batch=4, max_latency=0.05,
+                 load_timeout=600):
+        self.slot_size = max_image_size
+        # one slot for every request that can be in a batch, plus a batch's worth being filled
+        self.n_slots = 2 * max_batch
+        self.shm = shared_memory.SharedMemory(create=True, size=self.n_slots * self.slot_size)
+        self.slots = np.ndarray((self.n_slots, self.slot_size), dtype=np.uint8, buffer=self.shm.buf)
+        self.free_slots = list(range(self.n_slots))
+        self.slot_semaphore = threading.Semaphore(self.n_slots)
+        self.lock = threading.Lock()
+        self.request_numbers = itertools.count()
+        # request number -> [event, result, slot]. A slot goes back on free_slots when the worker's reply arrives,
+        # not when run gives up waiting, since until then the worker may still be reading it
+        self.pending = {}
+
+        self.task_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.worker = multiprocessing.Process(target=inference_worker, name='inference_worker',
+                                              args=(backend_name, model_dir, backend_kwargs, self.shm.name,
+                                                    self.n_slots, self.slot_size, self.task_queue,
+                                                    self.result_queue, max_batch, max_latency))
+        self.worker.start()
+        self.receiver = None
+        error = self.wait_for_load(load_timeout)
+        if error is not None:
+            self.close()
+            raise InferenceError('unable to load the %s model in the inference process: %s' % (backend_name, error))
+        self.receiver = threading.Thread(target=self.receive, name='inference_receiver')
+        self.receiver.start()
+        Logger.info('RemoteBackend: %s inference process started' % backend_name)
+
+    def wait_for_load(self, timeout):
+        """ Wait for the worker to load its model. Returns None once it has, or what went wrong. """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.result_queue.get(timeout=1)
+            except queue.Empty:
+                if not self.worker.is_alive():
+                    return 'the inference process exited with code %s' % self.worker.exitcode
+                if time.monotonic() > deadline:
+                    return 'timed out after %s s' % timeout
+
+    def run(self, image):
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        if image.nbytes > self.slot_size:
+            raise InferenceError('image of shape %s is too large for the inference process' % (image.shape,))
+        if not self.slot_semaphore.acquire(timeout=60):
+            raise InferenceError('no free slot for the inference process')
+        with self.lock:
+            slot = self.free_slots.pop()
+            request = next(self.request_numbers)
+            pending = self.pending[request] = [threading.Event(), None, slot]
+        try:
+            self.slots[slot, :image.nbytes] = image.reshape(-1)
+            self.task_queue.put((request, slot, image.shape))
+        except Exception:
+            # never handed over, so the slot is still ours to free
+            self.free(request)
+            raise
+        if not pending[0].wait(timeout=60):
+            # leave the slot to be freed by receive if the reply ever comes
+            raise InferenceError('no result from the inference process')
+        result = pending[1]
+        if isinstance(result, Exception):
+            raise InferenceError(str(result))
+        return result
+
+    def run_batch(self, images):
+        return [self.run(image) for image in images]
+
+    def free(self, request):
+        """ Forget a request and give its slot back. Returns the request's [event, result, slot], or None. """
+        with self.lock:
+            pending = self.pending.pop(request, None)
+            if pending is None:
+                return None
+            self.free_slots.append(pending[2])
+        self.slot_semaphore.release()
+        return pending
+
+    def receive(self):
+        while True:
+            results = self.result_queue.get()
+            if results is None:
+                return
+            for request, result in results:
+                pending = self.free(request)
+                if pending is not None:
+                    pending[1] = result
+                    pending[0].set()
+
+    def close(self):
+        self.task_queue.put(None)
+        self.worker.join(timeout=30)
+        if self.worker.is_alive():
+            self.worker.terminate()
+        if self.receiver is not None:
+            self.result_queue.put(None)
+            self.receiver.join()
+        del self.slots
+        self.shm.close()
+        self.shm.unlink()
+        Logger.info('RemoteBackend: inference process stopped')
@@ -0,0 +1,39 @@
+import numpy as np
+
+# the H.264 encoder estimates one motion vector per 16x16 pixel macroblock
+MACROBLOCK_SIZE = 16
+
+
+def parse_roi(roi_string):
+    """ Turn an 'x0,y0,x1,y1' pixel box from the config into a tuple, or None for a blank or 'None' string. """
+    if roi_string is None or roi_string.strip() in ('', 'None'):
+        return None
+    x0, y0, x1, y1 = (int(v) for v in roi_string.split(','))
+    return x0, y0, x1, y1
+
+
+def roi_to_blocks(roi):
+    """ Convert an (x0, y0, x1, y1) pixel box to the macroblocks it overlaps, as row and column slices. """
+    x0, y0, x1, y1 = roi
+    rows = slice(y0 // MACROBLOCK_SIZE, -(-y1 // MACROBLOCK_SIZE))
+    cols = slice(x0 // MACROBLOCK_SIZE, -(-x1 // MACROBLOCK_SIZE))
+    return rows, cols
+
+
+def aggregate_motion_vectors(mv, min_magnitude, roi=None):
+    """
+    Reduce one frame of encoder motion vectors to a single motion value. mv is the (rows, cols) record array with 'x'
+    and 'y' fields that picamera hands to PiMotionAnalysis.analyse (the extra column picamera includes doesn't matter).
+    Macroblocks whose vector is at least min_magnitude long count as moving, and the result is the number of moving
+    blocks times the pixels in a block, so it's on a similar scale to the pixel counts from image deltas. Only blocks
+    overlapping roi, an (x0, y0, x1, y1) box in video pixels, are counted if it's given.
+    """
+    if roi is not None:
+        rows, cols = roi_to_blocks(roi)
+        mv = mv[rows, cols]
+    # a squared length is up to 2 * 128 ** 2, which overflows int16
+    x = mv['x'].astype(np.int32)
+    y = mv['y'].astype(np.int32)
+    # compare squared lengths, so no square root is needed
+    moving = np.count_nonzero(x * x + y * y >= min_magnitude * min_magnitude)
+    return moving * MACROBLOCK_SIZE * MACROBLOCK_SIZE
@@ -0,0 +1,210 @@
+import multiprocessing
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+from kivy.logger import Logger
+
+from imageProcessing.image_processing import DeltaKernel, FrameSequencer
+from imageProcessing.image_writer import image_writer_from_parameters
+
+
+def frame_view(buf, nbytes, frame_dims, channels):
+    """ View nbytes of a frame slot as a grayscale-or-bgr image, trying both paddings picamera may use. """
+    width, height, fwidth, fheight, swidth, sheight = frame_dims
+    if nbytes != fwidth * fheight * channels:
+        fwidth, fheight = swidth, sheight
+        if nbytes != fwidth * fheight * channels:
+            return None
+    im = buf[:nbytes].reshape((fheight, fwidth, channels))[:height, :width, :]
+    if channels == 1:
+        return im[:, :, 0]
+    return im
+
+
+def delta_worker(shm_name, n_slots, slot_size, frame_dims, channels, imaging_parameters,
+                 task_queue, result_queue, batch_size):
+    """
+    Runs in a worker process. Each task names the frame slots of two consecutive frames in shared memory; the worker
+    takes the delta between them and sends results back in batches, whenever batch_size are ready or it runs out of
+    queued tasks.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames = np.ndarray((n_slots, slot_size), dtype=np.uint8, buffer=shm.buf)
+    width, height = frame_dims[:2]
+    gray = [np.empty((height, width), dtype=np.uint8) for i in range(2)]
+    writer = None
+    if imaging_parameters['save_images'] or imaging_parameters['save_processed_images']:
+        writer = image_writer_from_parameters(imaging_parameters)
+    delta_kernel = DeltaKernel(imaging_parameters, writer)
+    batch = []
+    try:
+        while True:
+            try:
+                task = task_queue.get(timeout=0.1 if batch else None)
+            except queue.Empty:
+                result_queue.put(batch)
+                batch = []
+                continue
+            if task is None:
+                break
+            frame_no, timestamp, prev_slot, prev_nbytes, slot, nbytes = task
+            mvmnt = None
+            try:
+                im2 = frame_view(frames[slot], nbytes, frame_dims, channels)
+                if im2 is not None and im2.ndim == 3:
+                    im2 = cv2.cvtColor(im2, cv2.COLOR_BGR2GRAY, dst=gray[1])
+                if im2 is not None and imaging_parameters['save_images']:
+                    writer.save('unprocessed', frame_no, im2, timestamp)
+                if prev_slot is not None and im2 is not None:
+                    im1 = frame_view(frames[prev_slot], prev_nbytes, frame_dims, channels)
+                    if im1 is not None:
+                        if im1.ndim == 3:
+                            im1 = cv2.cvtColor(im1, cv2.COLOR_BGR2GRAY, dst=gray[0])
+                        mvmnt = delta_kernel(im1, im2, frame_no)
+            except Exception as err:
+                Logger.warning('DeltaWorker: unable to process frame %s: %s' % (frame_no, err))
+            batch.append((frame_no, timestamp, prev_slot, slot, mvmnt))
+            if len(batch) >= batch_size:
+                result_queue.put(batch)
+                batch = []
+        if batch:
+            result_queue.put(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+        del frames
+        shm.close()
+
+
+class SharedMemoryProcessorPool:
+    """
+    Drop-in alternative to ProcessorPool for 'image delta' processing that runs the work in separate processes, so it
+    isn't limited to one core by the GIL. Frames are written into slots of one shared memory block; each worker is
+    handed the slot numbers of two consecutive frames, and a collector thread reads the batched results back, frees
+    slots once both of their deltas are done and puts the motion values back in frame order.
+    """
+
+    def __init__(self, num_workers, cur_image,
+                 motion_list, motion_list_lock,
+                 egg_count_list, egg_count_list_lock, channels=3, batch_size=4):
+        self.done = False
+        self.cur_image = cur_image
+        self.channels = channels
+        self.lock = threading.Lock()
+        self.motion_list = motion_list
+        self.motion_list_lock = motion_list_lock
+        self.egg_count_list = egg_count_list
+        self.egg_count_list_lock = egg_count_list_lock
+        self.sequencer = FrameSequencer(self.emit)
+        self.frame_count = 0
+        self.frame_time = None
+
+        swidth, sheight = cur_image.raw_resolution((cur_image.width, cur_image.height), splitter=True)
+        frame_dims = (cur_image.width, cur_image.height, cur_image.fwidth, cur_image.fheight, swidth, sheight)
+        self.slot_size = max(swidth * sheight, cur_image.fwidth * cur_image.fheight) * channels
+        # a slot is only freed once the batches holding both of its tasks come back, so allow for every worker to
+        # be sitting on a full batch, plus the newest frame that's kept for the next task
+        self.n_slots = num_workers * (batch_size + 1) + 2
+        self.shm = shared_memory.SharedMemory(create=True, size=self.n_slots * self.slot_size)
+        self.frames = np.ndarray((self.n_slots, self.slot_size), dtype=np.uint8, buffer=self.shm.buf)
+        self.free_slots = list(range(self.n_slots))
+        self.slot_refs = [0] * self.n_slots
+        self.slot = None
+        self.filling = False
+        self.offset = 0
+        # (slot, nbytes) of the last frame dispatched, which the next frame will be compared against
+        self.prev = None
+
+        # the kivy DictProperty can't be pickled, and the workers don't need the CNN
+        imaging_parameters = dict(cur_image.imaging_parameters)
+        self.task_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.workers = [multiprocessing.Process(target=delta_worker, name='delta_worker',
+                                                args=(self.shm.name, self.n_slots, self.slot_size, frame_dims,
+                                                      channels, imaging_parameters, self.task_queue,
+                                                      self.result_queue, batch_size))
+                        for i in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+        self.collector = threading.Thread(target=self.collect, name='delta_collector')
+        self.collector.start()
+        Logger.info('SharedMemoryProcessorPool: initialized with %s worker processes' % num_workers)
+
+    def write(self, image):
+        if not self.done:
+            if not self.filling:
+                self.filling = True
+                self.offset = 0
+                self.frame_time = time.time()
+                with self.lock:
+                    if self.free_slots:
+                        self.slot = self.free_slots.pop()
+                    else:
+                        # every slot is still waiting on a worker, so skip this frame
+                        self.slot = None
+                        Logger.info('SharedMemoryProcessorPool: no frame slot available')
+            if self.slot is not None:
+                chunk = np.frombuffer(image, dtype=np.uint8)
+                end = self.offset + chunk.size
+                if end > self.slot_size:
+                    Logger.debug('SharedMemoryProcessorPool: frame is larger than its slot, dropping it')
+                    with self.lock:
+                        self.free_slots.append(self.slot)
+                    self.slot = None
+                else:
+                    self.frames[self.slot, self.offset:end] = chunk
+                    self.offset = end
+
+    def flush(self):
+        if self.filling:
+            self.filling = False
+            if self.slot is not None:
+                self.frame_count += 1
+                with self.lock:
+                    # a slot is referenced by the task it ends (the first frame's task just saves it) and by the
+                    # one it starts
+                    self.slot_refs[self.slot] = 2
+                prev_slot, prev_nbytes = self.prev if self.prev is not None else (None, 0)
+                self.task_queue.put((self.frame_count, self.frame_time, prev_slot, prev_nbytes,
+                                     self.slot, self.offset))
+                self.prev = (self.slot, self.offset)
+                self.slot = None
+
+    def collect(self):
+        while True:
+            batch = self.result_queue.get()
+            if batch is None:
+                return
+            for frame_no, timestamp, prev_slot, slot, mvmnt in batch:
+                with self.lock:
+                    for s in (prev_slot, slot):
+                        if s is not None:
+                            self.slot_refs[s] -= 1
+                            if self.slot_refs[s] == 0:
+                                self.free_slots.append(s)
+                self.sequencer.release(frame_no, timestamp, mvmnt)
+
+    def emit(self, frame_no, timestamp, result):
+        """ Called by the sequencer with each frame's result, in frame order. """
+        if result is not None:
+            with self.motion_list_lock:
+                self.motion_list.append(result)
+
+    def exit(self):
+        self.done = True
+        for i in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self.result_queue.put(None)
+        self.collector.join()
+        del self.frames
+        self.shm.close()
+        self.shm.unlink()
+        Logger.info('SharedMemoryProcessorPool: exiting')
@@ -0,0 +1,141 @@
+import csv
+
+import numpy as np
+from kivy.logger import Logger
+
+
+def iou_matrix(boxes1, boxes2):
+    """ Intersection over union of every (x0, y0, x1, y1) box in boxes1 with every box in boxes2, as a 2D array. """
+    x0 = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    y0 = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    x1 = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    y1 = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+    intersection = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    areas1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    areas2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    union = areas1[:, None] + areas2[None, :] - intersection
+    return np.where(union > 0, intersection / np.where(union > 0, union, 1), 0)
+
+
+def greedy_assignment(scores, min_score):
+    """
+    Pair rows with columns of a score matrix, best pairs first, each row and column at most once and only pairs
+    scoring at least min_score. Returns arrays of matched row and column indexes.
+    Rather than going through the candidate pairs one at a time, every pair that is the best left for both its row and
+    its column is matched in one array operation, and the pairs that share a row or column with them dropped, until
+    none are left. That gives the same pairs, in rarely more than a couple of passes, so the cost per frame stays flat
+    as worms are added.
+    """
+    rows, cols = np.nonzero(scores >= min_score)
+    order = np.argsort(-scores[rows, cols], kind='stable')
+    rows, cols = rows[order], cols[order]
+    matched_rows, matched_cols = [], []
+    used_rows = np.zeros(scores.shape[0], dtype=bool)
+    used_cols = np.zeros(scores.shape[1], dtype=bool)
+    while len(rows):
+        # the pairs are sorted by score, so a row's or column's best pair is the first one it's in
+        best = np.zeros(len(rows), dtype=bool)
+        best[np.unique(rows, return_index=True)[1]] = True
+        col_best = np.zeros(len(rows), dtype=bool)
+        col_best[np.unique(cols, return_index=True)[1]] = True
+        best &= col_best
+        matched_rows.append(rows[best])
+        matched_cols.append(cols[best])
+        used_rows[rows[best]] = True
+        used_cols[cols[best]] = True
+        left = ~(used_rows[rows] | used_cols[cols])
+        rows, cols = rows[left], cols[left]
+    if not matched_rows:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    return np.concatenate(matched_rows), np.concatenate(matched_cols)
+
+
+class MultiWormTracker:
+    """
+    Follows every worm the neural net finds from frame to frame, so motion is measured per animal instead of between
+    whichever boxes happened to score highest. Boxes are matched to existing tracks by overlap (IoU) in one array
+    operation per frame; unmatched boxes start new tracks and tracks that go unmatched for max_misses frames are
+    dropped. Track state lives in flat arrays. One track is designated to drive the LED feedback: the first one seen,
+    and when it's lost, the track that has been matched in the most frames.
+    Frames must be passed to update() in order. Each worm's position and motion are written to csv_path if given.
+    """
+
+    def __init__(self, min_iou=0.1, max_misses=5, csv_path=None):
+        self.min_iou = min_iou
+        self.max_misses = max_misses
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.boxes = np.zeros((0, 4), dtype=np.float64)
+        self.misses = np.zeros(0, dtype=np.int64)
+        self.hits = np.zeros(0, dtype=np.int64)
+        self.next_id = 1
+        self.designated = None
+        self.csv_file = None
+        if csv_path is not None:
+            self.csv_file = open(csv_path, 'a', newline='')
+            self.csv_writer = csv.writer(self.csv_file)
+            if self.csv_file.tell() == 0:
+                self.csv_writer.writerow(['frame_no', 'timestamp', 'track_id', 'x', 'y', 'motion'])
+
+    @staticmethod
+    def centers(boxes):
+        return np.column_stack(((boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2))
+
+    def update(self, frame_no, timestamp, boxes):
+        """
+        Match this frame's worm boxes (an (n, 4) array of x0, y0, x1, y1) to the tracks. Returns a dict of track id to
+        distance moved since the track's last match, for every track matched in this frame.
+        """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        track_rows, box_cols = greedy_assignment(iou_matrix(self.boxes, boxes), self.min_iou)
+
+        motion = np.linalg.norm(self.centers(boxes[box_cols]) - self.centers(self.boxes[track_rows]), axis=1)
+        self.boxes[track_rows] = boxes[box_cols]
+        self.hits[track_rows] += 1
+        self.misses += 1
+        self.misses[track_rows] = 0
+        motions = dict(zip(self.ids[track_rows].tolist(), motion.tolist()))
+        matched_ids = self.ids[track_rows]
+
+        # boxes that didn't match a track start new ones
+        new = np.ones(len(boxes), dtype=bool)
+        new[box_cols] = False
+        n_new = int(new.sum())
+        new_ids = np.arange(self.next_id, self.next_id + n_new)
+        self.next_id += n_new
+        self.ids = np.concatenate((self.ids, new_ids))
+        self.boxes = np.concatenate((self.boxes, boxes[new]))
+        self.misses = np.concatenate((self.misses, np.zeros(n_new, dtype=np.int64)))
+        self.hits = np.concatenate((self.hits, np.ones(n_new, dtype=np.int64)))
+
+        # forget tracks that haven't been seen for a while
+        keep = self.misses <= self.max_misses
+        if not keep.all():
+            Logger.debug('MultiWormTracker: lost tracks %s' % self.ids[~keep].tolist())
+            self.ids, self.boxes, self.misses, self.hits = (self.ids[keep], self.boxes[keep], self.misses[keep],
+                                                            self.hits[keep])
+        if self.designated is None or not (self.ids == self.designated).any():
+            designated = int(self.ids[np.argmax(self.hits)]) if len(self.ids) else None
+            if designated != self.designated:
+                Logger.info('MultiWormTracker: track %s now drives the LEDs' % designated)
+            self.designated = designated
+
+        if self.csv_file is not None:
+            centers = self.centers(boxes)
+            ids = np.concatenate((matched_ids, new_ids))
+            rows = np.concatenate((box_cols, np.flatnonzero(new)))
+            for track_id, row in zip(ids.tolist(), rows.tolist()):
+                x, y = centers[row]
+                self.csv_writer.writerow([frame_no, timestamp, track_id, '%.1f' % x, '%.1f' % y,
+                                          '%.2f' % motions[track_id] if track_id in motions else ''])
+            self.csv_file.flush()
+        return motions
+
+    def designated_center(self):
+        if self.designated is None:
+            return None, None
+        x, y = self.centers(self.boxes[self.ids == self.designated])[0]
+        return float(x), float(y)
+
+    def close(self):
+        if self.csv_file is not None:
+            self.csv_file.close()
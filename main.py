@@ -227,16 +227,54 @@ class Interface(BoxLayout):
         self.imaging_params['video_resolution'] = app.config.get('camera settings', 'resolution')
         self.inter_video_interval = app.config.getint('camera settings', 'inter_video_interval')
         self.video_length = app.config.getint('camera settings', 'video_length')
-        self.imaging_params['image_frequency'] = app.config.getint('main image processing', 'image_frequency')
+        self.imaging_params['image_frequency'] = app.config.getfloat('main image processing', 'image_frequency')
+        self.imaging_params['arena_grid'] = app.config.get('main image processing', 'arena_grid')
+        self.imaging_params['arena_rois'] = app.config.get('main image processing', 'arena_rois')
+        self.imaging_params['arena_feedback'] = app.config.getint('main image processing', 'arena_feedback')
         self.imaging_params['delta_threshold'] = app.config.getint('image delta', 'delta_threshold')
         self.imaging_params['num_pixel_threshold'] = app.config.getint('image delta', 'num_pixel_threshold')
+        self.imaging_params['use_roi'] = bool(app.config.getint('image delta', 'use_roi'))
+        self.imaging_params['roi_refresh_frames'] = app.config.getint('image delta', 'roi_refresh_frames')
+        self.imaging_params['roi_padding'] = app.config.getint('image delta', 'roi_padding')
+        self.imaging_params['roi_mask_method'] = app.config.get('image delta', 'roi_mask_method')
+        self.imaging_params['bg_method'] = app.config.get('background subtraction', 'bg_method')
+        self.imaging_params['bg_learning_rate'] = app.config.getfloat('background subtraction', 'bg_learning_rate')
+        self.imaging_params['bg_threshold'] = app.config.getint('background subtraction', 'bg_threshold')
+        self.imaging_params['mv_min_magnitude'] = app.config.getint('motion vectors', 'mv_min_magnitude')
+        self.imaging_params['mv_roi'] = app.config.get('motion vectors', 'mv_roi')
+        self.imaging_params['thresh_block_size'] = app.config.getint('image thresholding', 'thresh_block_size')
+        self.imaging_params['threshold_c'] = app.config.getint('image thresholding', 'image_threshold')
+        self.imaging_params['keep_border_data'] = bool(app.config.getint('image thresholding', 'keep_border_data'))
+        self.imaging_params['min_area'] = app.config.getint('image thresholding', 'min_area')
+        self.imaging_params['max_area'] = app.config.getint('image thresholding', 'max_area')
+        self.imaging_params['dilation_size'] = app.config.getint('image thresholding', 'dilation_size')
         self.image_processing_mode = app.config.get('main image processing', 'image_processing_mode')
         self.nn_count_eggs = bool(int(app.config.get('neural net', 'nn_count_eggs')))
+        self.imaging_params['nn_egg_interval'] = app.config.getfloat('neural net', 'nn_egg_interval')
+        self.imaging_params['nn_multi_worm'] = bool(app.config.getint('neural net', 'nn_multi_worm'))
+        self.imaging_params['nn_track_min_iou'] = app.config.getfloat('neural net', 'nn_track_min_iou')
+        self.imaging_params['nn_track_max_misses'] = app.config.getint('neural net', 'nn_track_max_misses')
+        self.imaging_params['nn_tracking'] = bool(app.config.getint('neural net', 'nn_tracking'))
+        self.imaging_params['nn_crop_size'] = app.config.getint('neural net', 'nn_crop_size')
+        self.imaging_params['nn_backend'] = app.config.get('neural net', 'nn_backend')
+        self.imaging_params['nn_num_threads'] = app.config.getint('neural net', 'nn_num_threads')
+        self.imaging_params['nn_class_offset'] = app.config.getint('neural net', 'nn_class_offset')
+        self.imaging_params['nn_gate'] = bool(app.config.getint('neural net', 'nn_gate'))
+        self.imaging_params['nn_gate_threshold'] = app.config.getint('neural net', 'nn_gate_threshold')
+        self.imaging_params['nn_gate_max_skips'] = app.config.getint('neural net', 'nn_gate_max_skips')
+        self.imaging_params['nn_worker_process'] = bool(app.config.getint('neural net', 'nn_worker_process'))
+        self.imaging_params['nn_max_batch'] = app.config.getint('neural net', 'nn_max_batch')
+        self.imaging_params['nn_batch_latency'] = app.config.getfloat('neural net', 'nn_batch_latency')
         self.imaging_params['image_processing_mode'] = self.image_processing_mode
 
         self.imaging_params['save_images'] = bool(app.config.getint('main image processing', 'save_images'))
         self.imaging_params['save_processed_images'] = \
             bool(app.config.getint('main image processing', 'save_processed_images'))
+        self.imaging_params['png_compression'] = app.config.getint('main image processing', 'png_compression')
+        self.imaging_params['image_queue_size'] = app.config.getint('main image processing', 'image_queue_size')
+        self.imaging_params['image_queue_policy'] = app.config.get('main image processing', 'image_queue_policy')
+        self.imaging_params['image_storage'] = app.config.get('main image processing', 'image_storage')
+        self.imaging_params['frames_per_stack'] = app.config.getint('main image processing', 'frames_per_stack')
 
         if paired_system_id in SYSTEM_IDS and self.image_processing_mode != 'None':
             self.paired_system_id = paired_system_id
@@ -340,13 +378,21 @@ class KivycamApp(App):
             'gain': 1.0,
             'resolution': '1920x1080',
             'video_length': 30,
-            'inter_video_interval': 0
+            'inter_video_interval': 0,
+            'remux_videos': 0,
+            'restart_retries': 5,
+            'restart_backoff': 1
         })
 
         config.setdefaults('webstreaming', {
             'do_webstream': 0,
             'youtube_link': "rtmp://a.rtmp.youtube.com/live2/",
-            'youtube_key': "xxxxxxxxxxxxxxxx"
+            'youtube_key': "xxxxxxxxxxxxxxxx",
+            'do_preview': 0,
+            'preview_port': 8000,
+            'preview_resolution': '320x240',
+            'preview_fps': 2,
+            'preview_overlay': 0
         })
 
         config.setdefaults('pressure control', {
@@ -361,8 +407,19 @@ class KivycamApp(App):
             'max_exposure': 30,
             'image_resolution': '640x480',
             'image_frequency': 15,
+            'capture_mode': 'still',
+            'pool_backend': 'threads',
+            'pool_size': 3,
+            'arena_grid': '1x1',
+            'arena_rois': 'None',
+            'arena_feedback': 1,
             'save_images': 1,
             'save_processed_images': 1,
+            'png_compression': 1,
+            'image_queue_size': 32,
+            'image_queue_policy': 'drop',
+            'image_storage': 'png',
+            'frames_per_stack': 500,
             'is_driving_system': 1,
             'check_dosage_interval': 360,
             'paired_systemid': 'test2'
@@ -370,14 +427,55 @@ class KivycamApp(App):
 
         config.setdefaults('neural net', {
             'nn_count_eggs': 0,
-            'nn_distance_thresh': 10
+            'nn_distance_thresh': 10,
+            'nn_egg_interval': 300,
+            'nn_multi_worm': 0,
+            'nn_track_min_iou': 0.1,
+            'nn_track_max_misses': 5,
+            'nn_tracking': 0,
+            'nn_crop_size': 320,
+            'nn_backend': 'tensorflow',
+            'nn_num_threads': 4,
+            'nn_class_offset': 0,
+            'nn_gate': 0,
+            'nn_gate_threshold': 8,
+            'nn_gate_max_skips': 10,
+            'nn_worker_process': 0,
+            'nn_max_batch': 4,
+            'nn_batch_latency': 0.05
         })
 
         config.setdefaults('image delta', {
             'delta_threshold': 4,
+            'num_pixel_threshold': 2000,
+            'use_roi': 0,
+            'roi_refresh_frames': 30,
+            'roi_padding': 40,
+            'roi_mask_method': 'components'
+        })
+
+        config.setdefaults('background subtraction', {
+            'bg_method': 'running average',
+            'bg_learning_rate': 0.01,
+            'bg_threshold': 15,
+            'num_pixel_threshold': 500
+        })
+
+        config.setdefaults('motion vectors', {
+            'mv_min_magnitude': 2,
+            'mv_roi': 'None',
             'num_pixel_threshold': 2000
         })
 
+        config.setdefaults('image thresholding', {
+            'thresh_block_size': 61,
+            'keep_border_data': 0,
+            'image_threshold': 5,
+            'min_area': 50,
+            'max_area': 500,
+            'dilation_size': 3
+        })
+
     def build_settings(self, settings):
         settings.add_json_panel('Experiment Info', self.config,
                                 data=expSettings_json)
@@ -0,0 +1,68 @@
+"""
+Checks the live preview of one or more rigs from any computer on the same network (it only needs python 3):
+
+    python3 preview_client.py http://mipi-1.local:8000 http://mipi-2.local:8000 --frames 20
+
+For every rig, reads frames from the MJPEG stream and prints the frame rate, frame size and bandwidth it's using.
+Add --save to keep the last frame from each rig as a jpg.
+"""
+import argparse
+import time
+import urllib.request
+from urllib.parse import urlparse
+
+
+def read_stream(url, frames, timeout=10):
+    """ Read frames JPEGs from a rig's /stream.mjpg. Returns (number of frames, seconds taken, bytes, last JPEG). """
+    stream = urllib.request.urlopen(url.rstrip('/') + '/stream.mjpg', timeout=timeout)
+    n, total, jpeg = 0, 0, None
+    start = None
+    while n < frames:
+        line = stream.readline()
+        if not line:
+            break
+        if not line.startswith(b'--'):
+            continue
+        headers = {}
+        while True:
+            line = stream.readline().strip()
+            if not line:
+                break
+            key, value = line.decode().split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+        jpeg = stream.read(int(headers['content-length']))
+        if start is None:
+            # the first frame may have been waiting, so time from it
+            start = time.monotonic()
+        else:
+            n += 1
+            total += len(jpeg)
+    stream.close()
+    return n, time.monotonic() - start if start is not None else 0, total, jpeg
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the live preview of mi-pi rigs')
+    parser.add_argument('urls', nargs='+', help='rig preview address, e.g. http://mipi-1.local:8000')
+    parser.add_argument('--frames', type=int, default=10, help='frames to read from each rig')
+    parser.add_argument('--save', action='store_true', help='save the last frame from each rig')
+    args = parser.parse_args()
+    for url in args.urls:
+        try:
+            n, seconds, total, jpeg = read_stream(url, args.frames)
+        except OSError as err:
+            print('%s: %s' % (url, err))
+            continue
+        if not n or not seconds:
+            print('%s: no frames' % url)
+            continue
+        print('%s: %.1f fps, %.1f kB per frame, %.0f kbit/s' % (url, n / seconds, total / n / 1000,
+                                                                  total * 8 / seconds / 1000))
+        if args.save and jpeg:
+            name = urlparse(url).netloc.replace(':', '_') + '.jpg'
+            with open(name, 'wb') as f:
+                f.write(jpeg)
+
+
+if __name__ == '__main__':
+    main()
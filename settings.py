@@ -138,6 +138,21 @@ imagingSettings_json = json.dumps([
      'desc': 'how much time (in seconds) between each video?',
      'section': 'camera settings',
      'key': 'inter_video_interval'},
+    {'type': 'bool',
+     'title': 'Remux videos to mp4',
+     'desc': 'copy each finished video into a seekable mp4 with the camera frame times (needs ffmpeg)',
+     'section': 'camera settings',
+     'key': 'remux_videos'},
+    {'type': 'numeric',
+     'title': 'Camera restart attempts',
+     'desc': 'how many times to try reopening the camera after an error before ending the experiment',
+     'section': 'camera settings',
+     'key': 'restart_retries'},
+    {'type': 'numeric',
+     'title': 'Camera restart backoff',
+     'desc': 'seconds to wait before the second attempt, doubling for each attempt after that',
+     'section': 'camera settings',
+     'key': 'restart_backoff'},
 
     {'type': 'title',
      'title': 'Webstreaming'},
@@ -155,7 +170,32 @@ imagingSettings_json = json.dumps([
      'title': 'youtube livestream key',
      'desc': 'from live streaming dashboard',
      'section': 'webstreaming',
-     'key': 'youtube_key'}
+     'key': 'youtube_key'},
+    {'type': 'bool',
+     'title': 'Local preview?',
+     'desc': 'serve a small live preview to browsers on the local network',
+     'section': 'webstreaming',
+     'key': 'do_preview'},
+    {'type': 'numeric',
+     'title': 'Preview port',
+     'desc': 'watch the preview at http://<this pi>:<port>',
+     'section': 'webstreaming',
+     'key': 'preview_port'},
+    {'type': 'string',
+     'title': 'Preview resolution',
+     'desc': 'pixel w x h',
+     'section': 'webstreaming',
+     'key': 'preview_resolution'},
+    {'type': 'numeric',
+     'title': 'Preview frame rate',
+     'desc': 'preview frames per second',
+     'section': 'webstreaming',
+     'key': 'preview_fps'},
+    {'type': 'bool',
+     'title': 'Preview overlay',
+     'desc': 'draw the arenas or motion vector ROI and the latest motion on the preview (uses more CPU)',
+     'section': 'webstreaming',
+     'key': 'preview_overlay'}
 ])
 
 pressureSettings_json = json.dumps([
@@ -176,7 +216,7 @@ imageProcessingSettings_json = json.dumps([
      'desc': 'Which type (if any)?',
      'section': 'main image processing',
      'key': 'image_processing_mode',
-     'options': ['None', 'image delta', 'neural net']},
+     'options': ['None', 'image delta', 'background subtraction', 'motion vectors', 'neural net']},
     {'type': 'bool',
      'title': 'Link motion to blue light?',
      'desc': 'record motion with blue light feedback',
@@ -198,11 +238,70 @@ imageProcessingSettings_json = json.dumps([
      'desc': 'pretty self explanatory',
      'section': 'main image processing',
      'key': 'save_processed_images'},
+    {'type': 'numeric',
+     'title': 'PNG compression',
+     'desc': '0 (fastest, largest files) to 9 (slowest, smallest files) for saved images or stacks',
+     'section': 'main image processing',
+     'key': 'png_compression'},
+    {'type': 'options',
+     'title': 'Saved image format',
+     'desc': 'one png per image, or compressed hdf5 stacks of many images each',
+     'section': 'main image processing',
+     'key': 'image_storage',
+     'options': ['png', 'hdf5 stacks']},
+    {'type': 'numeric',
+     'title': 'Images per stack',
+     'desc': 'a new hdf5 stack is started after this many images',
+     'section': 'main image processing',
+     'key': 'frames_per_stack'},
+    {'type': 'numeric',
+     'title': 'Image save queue size',
+     'desc': 'number of images that can wait to be written to disk',
+     'section': 'main image processing',
+     'key': 'image_queue_size'},
+    {'type': 'options',
+     'title': 'When the image save queue is full',
+     'desc': 'drop new images, or wait (and hold up image processing) until there is room',
+     'section': 'main image processing',
+     'key': 'image_queue_policy',
+     'options': ['drop', 'block']},
     {'type': 'numeric',
      'title': 'Image frequency',
-     'desc': 'integer in seconds defining frequency of images used for image analysis',
+     'desc': 'seconds between images used for image analysis (fractions of a second need the yuv stream)',
      'section': 'main image processing',
      'key': 'image_frequency'},
+    {'type': 'options',
+     'title': 'Analysis capture mode',
+     'desc': 'still: one capture per image, yuv stream: continuous grayscale stream sampled at the image frequency',
+     'section': 'main image processing',
+     'key': 'capture_mode',
+     'options': ['still', 'yuv stream']},
+    {'type': 'options',
+     'title': 'Image processing backend',
+     'desc': 'run image delta processing in threads or in separate processes (uses all cores)',
+     'section': 'main image processing',
+     'key': 'pool_backend',
+     'options': ['threads', 'processes']},
+    {'type': 'numeric',
+     'title': 'Image processing workers',
+     'desc': 'number of threads or processes analysing images concurrently',
+     'section': 'main image processing',
+     'key': 'pool_size'},
+    {'type': 'string',
+     'title': 'Arena grid',
+     'desc': 'split the image into this many columns x rows of arenas, each analysed separately (1x1 for one)',
+     'section': 'main image processing',
+     'key': 'arena_grid'},
+    {'type': 'string',
+     'title': 'Arena boxes',
+     'desc': 'x0,y0,x1,y1;x0,y0,x1,y1;... in image pixels instead of a grid, or None',
+     'section': 'main image processing',
+     'key': 'arena_rois'},
+    {'type': 'numeric',
+     'title': 'Feedback arena',
+     'desc': 'number of the arena whose motion decides the blue light',
+     'section': 'main image processing',
+     'key': 'arena_feedback'},
     {'type': 'bool',
      'title': 'Is this the driving system?',
      'desc': 'the driving system will control illumination dosage on the paired system',
@@ -241,11 +340,87 @@ imageProcessingSettings_json = json.dumps([
      'desc': 'estimate number of eggs in image',
      'section': 'neural net',
      'key': 'nn_count_eggs'},
+    {'type': 'numeric',
+     'title': 'egg counting interval',
+     'desc': 'seconds between egg counts (the worm is located in every image)',
+     'section': 'neural net',
+     'key': 'nn_egg_interval'},
     {'type': 'numeric',
      'title': 'threshold distance for LED illumination',
      'desc': 'worm centroid movement greater than this many pixels prevents LED stimulation',
      'section': 'neural net',
      'key': 'nn_distance_thresh'},
+    {'type': 'bool',
+     'title': 'Several worms',
+     'desc': 'follow every worm on the plate and measure motion for each',
+     'section': 'neural net',
+     'key': 'nn_multi_worm'},
+    {'type': 'numeric',
+     'title': 'Minimum box overlap',
+     'desc': 'how much (0 to 1) a worm box must overlap its box in the last image to be the same worm',
+     'section': 'neural net',
+     'key': 'nn_track_min_iou'},
+    {'type': 'numeric',
+     'title': 'Images before a worm is lost',
+     'desc': 'a worm not found in more than this many images in a row is forgotten',
+     'section': 'neural net',
+     'key': 'nn_track_max_misses'},
+    {'type': 'bool',
+     'title': 'Track the worm',
+     'desc': 'look for the worm near its last location before searching the whole image',
+     'section': 'neural net',
+     'key': 'nn_tracking'},
+    {'type': 'numeric',
+     'title': 'Tracking crop size',
+     'desc': 'size in pixels of the square searched around the worm',
+     'section': 'neural net',
+     'key': 'nn_crop_size'},
+    {'type': 'options',
+     'title': 'Inference backend',
+     'desc': 'what runs the neural net - tflite and opencv dnn load much faster and use less memory',
+     'section': 'neural net',
+     'key': 'nn_backend',
+     'options': ['tensorflow', 'opencv dnn', 'tflite']},
+    {'type': 'numeric',
+     'title': 'Inference threads',
+     'desc': 'CPU threads used by the tflite backend',
+     'section': 'neural net',
+     'key': 'nn_num_threads'},
+    {'type': 'numeric',
+     'title': 'Class number offset',
+     'desc': 'added to class numbers from the opencv dnn backend (1 for Faster R-CNN models)',
+     'section': 'neural net',
+     'key': 'nn_class_offset'},
+    {'type': 'bool',
+     'title': 'Skip unchanged images',
+     'desc': 'only run the neural net when the image has changed since it last ran',
+     'section': 'neural net',
+     'key': 'nn_gate'},
+    {'type': 'numeric',
+     'title': 'Image change threshold',
+     'desc': 'grey levels a (shrunken) image must change by for the neural net to run',
+     'section': 'neural net',
+     'key': 'nn_gate_threshold'},
+    {'type': 'numeric',
+     'title': 'Most images skipped in a row',
+     'desc': 'the neural net runs at least once in this many images plus one',
+     'section': 'neural net',
+     'key': 'nn_gate_max_skips'},
+    {'type': 'bool',
+     'title': 'Separate inference process',
+     'desc': 'run the neural net in its own process, batching images that arrive together',
+     'section': 'neural net',
+     'key': 'nn_worker_process'},
+    {'type': 'numeric',
+     'title': 'Maximum inference batch',
+     'desc': 'most images run through the neural net at once',
+     'section': 'neural net',
+     'key': 'nn_max_batch'},
+    {'type': 'numeric',
+     'title': 'Inference batch latency',
+     'desc': 'seconds to wait for more images to batch with the first one',
+     'section': 'neural net',
+     'key': 'nn_batch_latency'},
 
     {'type': 'title',
      'title': 'Image Delta Processing'},
@@ -257,5 +432,98 @@ imageProcessingSettings_json = json.dumps([
      'title': 'threshold for pixel number > delta magnitude',
      'section': 'image delta',
      'key': 'num_pixel_threshold'},
+    {'type': 'bool',
+     'title': 'Only look for motion around the worm?',
+     'desc': 'restrict image deltas to a region of interest found by image thresholding',
+     'section': 'image delta',
+     'key': 'use_roi'},
+    {'type': 'numeric',
+     'title': 'ROI refresh interval',
+     'desc': 'number of images between searches for the worm (motion at the ROI edge triggers one sooner)',
+     'section': 'image delta',
+     'key': 'roi_refresh_frames'},
+    {'type': 'numeric',
+     'title': 'ROI padding',
+     'desc': 'pixels added around the worm on every side',
+     'section': 'image delta',
+     'key': 'roi_padding'},
+    {'type': 'options',
+     'title': 'ROI search method',
+     'desc': 'connected components are much faster than contours on noisy plates',
+     'section': 'image delta',
+     'key': 'roi_mask_method',
+     'options': ['components', 'contours']},
+
+    {'type': 'title',
+     'title': 'Background Subtraction'},
+    {'type': 'options',
+     'title': 'Background model',
+     'desc': 'how the picture of the empty plate is kept up to date',
+     'section': 'background subtraction',
+     'key': 'bg_method',
+     'options': ['running average', 'gaussian mixture']},
+    {'type': 'numeric',
+     'title': 'Background learning rate',
+     'desc': 'fraction of the background replaced by each new image (0 to 1)',
+     'section': 'background subtraction',
+     'key': 'bg_learning_rate'},
+    {'type': 'numeric',
+     'title': 'Foreground threshold',
+     'desc': 'grey levels a pixel must differ from the background by (running average only)',
+     'section': 'background subtraction',
+     'key': 'bg_threshold'},
+    {'type': 'numeric',
+     'title': 'threshold for foreground pixel number',
+     'section': 'background subtraction',
+     'key': 'num_pixel_threshold'},
+
+    {'type': 'title',
+     'title': 'Motion Vector Processing'},
+    {'type': 'numeric',
+     'title': 'Minimum motion vector length',
+     'desc': 'shorter encoder motion vectors are treated as noise',
+     'section': 'motion vectors',
+     'key': 'mv_min_magnitude'},
+    {'type': 'string',
+     'title': 'Motion vector region of interest',
+     'desc': 'x0,y0,x1,y1 in video pixels, or None for the whole frame',
+     'section': 'motion vectors',
+     'key': 'mv_roi'},
+    {'type': 'numeric',
+     'title': 'threshold for moving pixel number',
+     'section': 'motion vectors',
+     'key': 'num_pixel_threshold'},
+
+    {'type': 'title',
+     'title': 'Image Thresholding'},
+    {'type': 'numeric',
+     'title': 'Threshold block size',
+     'desc': 'odd number of pixels in the neighbourhood used for adaptive thresholding',
+     'section': 'image thresholding',
+     'key': 'thresh_block_size'},
+    {'type': 'numeric',
+     'title': 'Threshold offset',
+     'desc': 'how much brighter than its neighbourhood a pixel must be',
+     'section': 'image thresholding',
+     'key': 'image_threshold'},
+    {'type': 'numeric',
+     'title': 'Minimum worm area',
+     'desc': 'in pixels',
+     'section': 'image thresholding',
+     'key': 'min_area'},
+    {'type': 'numeric',
+     'title': 'Maximum worm area',
+     'desc': 'in pixels',
+     'section': 'image thresholding',
+     'key': 'max_area'},
+    {'type': 'bool',
+     'title': 'Keep objects touching the border?',
+     'section': 'image thresholding',
+     'key': 'keep_border_data'},
+    {'type': 'numeric',
+     'title': 'Dilation size',
+     'desc': 'size of the element used to grow the worm mask',
+     'section': 'image thresholding',
+     'key': 'dilation_size'},
 
     ])
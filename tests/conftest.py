@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules are imported from the top of the repository, like main.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,77 @@
+import cv2
+import numpy as np
+import pytest
+
+from imageProcessing.image_processing import get_image_mask, get_contour_areas, get_component_mask, \
+    get_component_areas
+
+
+def plate(seed, ring=True, shape=(480, 640)):
+    """ A dim, noisy agar plate with a few bright worms on it, one of them curled into a ring. """
+    rng = np.random.default_rng(seed)
+    im = cv2.GaussianBlur(rng.integers(40, 80, shape, dtype=np.uint8), (3, 3), 0)
+    cv2.polylines(im, [np.array([[100, 100], [130, 110], [150, 140]], dtype=np.int32)], False, 200, 4)
+    cv2.polylines(im, [np.array([[400, 300], [420, 330], [460, 335]], dtype=np.int32)], False, 200, 5)
+    if ring:
+        cv2.circle(im, (250, 350), 15, 200, 3)
+    # a worm on the border, which is dropped unless keep_border_data is set
+    cv2.line(im, (0, 200), (25, 215), 200, 4)
+    return im
+
+
+def speckled_plate(seed, shape=(480, 640)):
+    """ A plate with hundreds of small specks of dirt. """
+    rng = np.random.default_rng(seed)
+    return cv2.GaussianBlur(rng.normal(60, 8, shape).clip(0, 255).astype(np.uint8), (5, 5), 0)
+
+
+def parameters(keep_border_data=False, min_area=50, max_area=2000, threshold_c=15):
+    return {'thresh_block_size': 61,
+            'threshold_c': threshold_c,
+            'keep_border_data': keep_border_data,
+            'min_area': min_area,
+            'max_area': max_area,
+            'dilation_size': 3}
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('keep_border_data', [False, True])
+def test_mask_matches_contours(seed, keep_border_data):
+    im = plate(seed)
+    imaging_parameters = parameters(keep_border_data)
+    assert np.array_equal(get_component_mask(im, imaging_parameters), get_image_mask(im, imaging_parameters))
+
+
+@pytest.mark.parametrize('max_area', [300, 500])
+def test_area_limits_match_contours(max_area):
+    # worms just under and over max_area are kept or dropped the same way
+    im = plate(0)
+    imaging_parameters = parameters(max_area=max_area)
+    assert np.array_equal(get_component_mask(im, imaging_parameters), get_image_mask(im, imaging_parameters))
+
+
+def test_ring_is_filled():
+    mask = get_component_mask(plate(0), parameters())
+    assert mask[350, 250] == 1
+
+
+def test_bgr_images():
+    im = cv2.cvtColor(plate(0), cv2.COLOR_GRAY2BGR)
+    assert np.array_equal(get_component_mask(im, parameters()), get_image_mask(im, parameters()))
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_speckled_plate(seed):
+    # small specks are where diagonal joins can shift an area by a pixel, so allow a few pixels to differ
+    im = speckled_plate(seed)
+    imaging_parameters = parameters(min_area=5, max_area=500, threshold_c=5)
+    component_mask = get_component_mask(im, imaging_parameters)
+    assert (component_mask == get_image_mask(im, imaging_parameters)).mean() > 0.999
+    assert component_mask.any()
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_areas_match_contours(seed):
+    # without the ring, whose hole get_contour_areas also counts as a blob
+    im = plate(seed, ring=False)
+    assert get_component_areas(im, parameters()) == pytest.approx(get_contour_areas(im, parameters()))
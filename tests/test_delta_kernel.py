@@ -0,0 +1,57 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from imageProcessing.image_processing import DeltaKernel, delta_movement
+
+
+def frame_pair(seed, shape=(480, 640)):
+    """ Two frames of a blurry 'plate' with a few bright blobs that move between them, plus sensor noise. """
+    rng = np.random.default_rng(seed)
+    plate = cv2.GaussianBlur(rng.integers(60, 120, shape, dtype=np.uint8), (9, 9), 0)
+    frames = []
+    for shift in (0, 7):
+        im = plate.copy()
+        for x, y in ((100, 100), (320, 240), (500, 400)):
+            cv2.circle(im, (x + shift, y), 12, 220, -1)
+        noise = rng.integers(-4, 5, shape)
+        frames.append(np.clip(im.astype(np.int16) + noise, 0, 255).astype(np.uint8))
+    return frames
+
+
+def parameters(threshold, img_dir, save=False):
+    return {'strel': cv2.getStructuringElement(cv2.MORPH_CROSS, (5, 5)),
+            'delta_threshold': threshold,
+            'save_processed_images': save,
+            'img_dir': str(img_dir)}
+
+
+@pytest.mark.parametrize('threshold', [0, 1, 2.5, 10, 30.75, 254])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_pixel_count_matches_delta_movement(threshold, seed, tmp_path):
+    im1, im2 = frame_pair(seed)
+    imaging_parameters = parameters(threshold, tmp_path)
+    kernel = DeltaKernel(imaging_parameters)
+    assert kernel(im1, im2, 1) == delta_movement(im1, im2, 1, imaging_parameters)
+    # and again, with the scratch buffers from the first call
+    assert kernel(im2, im1, 2) == delta_movement(im2, im1, 2, imaging_parameters)
+
+
+def test_random_frames(tmp_path):
+    rng = np.random.default_rng(3)
+    kernel = DeltaKernel(parameters(5, tmp_path))
+    for i in range(5):
+        im1, im2 = rng.integers(0, 256, (2, 240, 320), dtype=np.uint8)
+        assert kernel(im1, im2, i) == delta_movement(im1, im2, i, parameters(5, tmp_path))
+
+
+def test_processed_images_match(tmp_path):
+    im1, im2 = frame_pair(4)
+    os.makedirs(tmp_path / 'processed')
+    os.makedirs(tmp_path / 'kernel')
+    delta_movement(im1, im2, 1, parameters(10, tmp_path, save=True))
+    DeltaKernel(parameters(10, tmp_path, save=True), subdir='kernel')(im1, im2, 1)
+    expected = cv2.imread(str(tmp_path / 'processed' / 'img1.png'))
+    assert np.array_equal(cv2.imread(str(tmp_path / 'kernel' / 'img1.png')), expected)
@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from imageProcessing.image_processing import FrameSequencer, ImageProcessor
+
+
+def frame(value):
+    return np.full((4, 4), value, dtype=np.uint8)
+
+
+def test_results_are_released_in_frame_order():
+    released = []
+    sequencer = FrameSequencer(lambda frame_no, timestamp, result: released.append((frame_no, result)))
+    for frame_no in (3, 1, 4, 2, 6, 5):
+        sequencer.release(frame_no, frame_no * 0.1, 'result %s' % frame_no)
+        # nothing is handed on until every frame before it is in
+        assert [n for n, result in released] == list(range(1, len(released) + 1))
+    assert released == [(n, 'result %s' % n) for n in range(1, 7)]
+    assert not sequencer.results
+
+
+def test_failing_callback_does_not_hold_back_later_frames():
+    released = []
+
+    def callback(frame_no, timestamp, result):
+        if frame_no == 2:
+            raise ValueError('bad result')
+        released.append(frame_no)
+
+    sequencer = FrameSequencer(callback)
+    for frame_no in (2, 3, 1, 4):
+        sequencer.release(frame_no, 0, None)
+    assert released == [1, 3, 4]
+    assert sequencer.next_frame == 5
+
+
+def test_pairs_are_consecutive_frames():
+    sequencer = FrameSequencer(lambda *args: None)
+    assert sequencer.add_frame(2, 0.2, frame(2)) == []
+    pairs = sequencer.add_frame(3, 0.3, frame(3))
+    assert [(pair[0], pair[2][0, 0], pair[3][0, 0]) for pair in pairs] == [(3, 2, 3)]
+    # frame 1 completes the pair with the frame after it too
+    pairs = sequencer.add_frame(1, 0.1, frame(1))
+    assert [(pair[0], pair[2][0, 0], pair[3][0, 0]) for pair in pairs] == [(2, 1, 2)]
+
+
+class FailingKernel:
+    """ Returns the difference of the two images' first pixels, and fails when comparing frame fail_on. """
+
+    def __init__(self, fail_on):
+        self.fail_on = fail_on
+
+    def __call__(self, im1, im2, frame_no):
+        if frame_no == self.fail_on:
+            raise RuntimeError('kernel failed')
+        return int(im2[0, 0]) - int(im1[0, 0])
+
+
+def delta_processor(kernel):
+    released = []
+    owner = SimpleNamespace(sequencer=FrameSequencer(lambda frame_no, timestamp, result:
+                                                     released.append((frame_no, result))),
+                            cur_image=SimpleNamespace(roi=None, arenas=None))
+    processor = ImageProcessor.__new__(ImageProcessor)
+    processor.owner = owner
+    processor.delta_kernel = kernel
+    processor.sequenced = False
+    return processor, released
+
+
+def test_delta_frames_out_of_order_with_a_failing_kernel():
+    processor, released = delta_processor(FailingKernel(fail_on=3))
+    sequencer = processor.owner.sequencer
+    # frame 3 completes two pairs, (2, 3) and (3, 4), and the kernel fails on the first
+    for frame_no in (1, 2, 4, 3, 6, 5):
+        processor.add_delta_frame(frame_no, frame_no * 0.1, frame(frame_no * 10))
+    assert released == [(1, None), (2, 10), (3, None), (4, 10), (5, 10), (6, 10)]
+    assert not sequencer.results and sequencer.next_frame == 7
+    # only the last frame is kept, for the pair it will make with frame 7
+    assert list(sequencer.frames) == [6]
+
+
+def test_delta_frames_that_could_not_be_read():
+    processor, released = delta_processor(FailingKernel(fail_on=None))
+    for frame_no, im in ((1, frame(10)), (3, frame(30)), (2, None), (4, frame(70))):
+        processor.add_delta_frame(frame_no, 0, im)
+    # there's no movement for either side of the missing frame, but the frames are all released in order
+    assert released == [(1, None), (2, None), (3, None), (4, 40)]
@@ -0,0 +1,110 @@
+import glob
+import os
+from os.path import join, exists
+
+import cv2
+import numpy as np
+import pytest
+
+from imageProcessing.inference_backends import BACKENDS, InferenceError, load_label_map, load_backend, backend_parity
+from imageProcessing.inference_worker import RemoteBackend
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_DIR = join(REPO, 'neural_net')
+SAMPLE_IMAGES = sorted(glob.glob(join(REPO, 'tests', 'sample_images', '*.png')) +
+                       glob.glob(join(REPO, 'tests', 'sample_images', '*.jpg')))
+# files each backend needs besides the sample images
+MODEL_FILES = {'tensorflow': ['frozen_inference_graph.pb'],
+               'opencv dnn': ['frozen_inference_graph.pb', 'frozen_inference_graph.pbtxt'],
+               'tflite': ['detect.tflite']}
+
+
+class FixedBackend:
+    """ Returns the same detections for every image. """
+
+    def __init__(self, classes, boxes, scores):
+        self.detections = np.array(classes), np.array(boxes, dtype=np.float64).reshape(-1, 4), np.array(scores)
+
+    def run(self, image):
+        return self.detections
+
+
+class MeanBackend:
+    """ For the inference process tests: reports each image's mean as its score, and fails on blank images. """
+
+    def __init__(self, model_dir, fail_to_load=False):
+        if fail_to_load:
+            raise RuntimeError('no model in %s' % model_dir)
+
+    def run_batch(self, images):
+        if any(not image.any() for image in images):
+            raise ValueError('blank image')
+        return [(np.array([1]), np.zeros((1, 4)), np.array([image.mean()])) for image in images]
+
+
+@pytest.fixture
+def mean_backend():
+    BACKENDS['mean'] = MeanBackend
+    yield 'mean'
+    del BACKENDS['mean']
+
+
+def test_remote_backend(mean_backend):
+    backend = RemoteBackend(mean_backend, MODEL_DIR, {}, max_image_size=300, max_batch=2)
+    try:
+        for value in (1, 7, 200):
+            classes, boxes, scores = backend.run(np.full((10, 10, 3), value, dtype=np.uint8))
+            assert scores[0] == value
+        # an error in the worker comes back for that request, and every slot is returned either way
+        with pytest.raises(InferenceError, match='blank image'):
+            backend.run(np.zeros((10, 10, 3), dtype=np.uint8))
+        assert sorted(backend.free_slots) == list(range(backend.n_slots)) and not backend.pending
+    finally:
+        backend.close()
+
+
+def test_remote_backend_load_failure(mean_backend):
+    with pytest.raises(InferenceError, match='no model'):
+        RemoteBackend(mean_backend, MODEL_DIR, {'fail_to_load': True}, max_image_size=300)
+
+
+def test_label_map():
+    category_index = load_label_map(join(MODEL_DIR, 'label_map.pbtxt'))
+    assert category_index
+    for class_id, category in category_index.items():
+        assert category['id'] == class_id and category['name']
+
+
+def test_parity_of_matching_detections():
+    images = [np.zeros((10, 10, 3), dtype=np.uint8)] * 2
+    reference = FixedBackend([1, 2], [[0.1, 0.1, 0.3, 0.3], [0.5, 0.5, 0.9, 0.9]], [0.95, 0.9])
+    # same detections in another order, slightly moved, plus one that isn't confident
+    candidate = FixedBackend([2, 1, 1], [[0.5, 0.5, 0.9, 0.88], [0.1, 0.1, 0.3, 0.3], [0, 0, 1, 1]],
+                             [0.92, 0.97, 0.3])
+    assert backend_parity(reference, candidate, images) == []
+
+
+def test_parity_reports_mismatches():
+    images = [np.zeros((10, 10, 3), dtype=np.uint8)]
+    reference = FixedBackend([1], [[0.1, 0.1, 0.3, 0.3]], [0.95])
+    assert len(backend_parity(reference, FixedBackend([], [], []), images)) == 1
+    assert len(backend_parity(reference, FixedBackend([2], [[0.1, 0.1, 0.3, 0.3]], [0.95]), images)) == 1
+    assert len(backend_parity(reference, FixedBackend([1], [[0.6, 0.6, 0.9, 0.9]], [0.95]), images)) == 1
+
+
+def needs(backend):
+    missing = [f for f in MODEL_FILES[backend] if not exists(join(MODEL_DIR, f))]
+    if missing:
+        pytest.skip('model files %s not in neural_net/' % ', '.join(missing))
+
+
+@pytest.mark.parametrize('candidate', ['opencv dnn', 'tflite'])
+def test_backend_parity_on_sample_images(candidate):
+    if not SAMPLE_IMAGES:
+        pytest.skip('no sample images in tests/sample_images')
+    needs('tensorflow')
+    needs(candidate)
+    pytest.importorskip('tensorflow')
+    images = [cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB) for path in SAMPLE_IMAGES]
+    reference = load_backend('tensorflow', MODEL_DIR)
+    assert backend_parity(reference, load_backend(candidate, MODEL_DIR), images) == []
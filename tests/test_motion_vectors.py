@@ -0,0 +1,47 @@
+import numpy as np
+
+from imageProcessing.motion_vectors import MACROBLOCK_SIZE, aggregate_motion_vectors, parse_roi, roi_to_blocks
+
+BLOCK = MACROBLOCK_SIZE * MACROBLOCK_SIZE
+
+
+def motion_vectors(rows, cols):
+    """ An empty frame of vectors in the layout picamera gives PiMotionAnalysis, with its extra column. """
+    return np.zeros((rows, cols + 1), dtype=[('x', 'i1'), ('y', 'i1'), ('sad', 'u2')])
+
+
+def test_threshold():
+    mv = motion_vectors(4, 5)
+    mv['x'][0, 0], mv['y'][0, 0] = 3, 4
+    mv['x'][1, 1] = -5
+    mv['y'][2, 2] = 4
+    # vectors of length 5 count as moving at 5, but not above it
+    assert aggregate_motion_vectors(mv, 5) == 2 * BLOCK
+    assert aggregate_motion_vectors(mv, 4) == 3 * BLOCK
+    assert aggregate_motion_vectors(mv, 6) == 0
+    assert aggregate_motion_vectors(motion_vectors(4, 5), 0) == 4 * 6 * BLOCK
+
+
+def test_extreme_vectors():
+    mv = motion_vectors(2, 2)
+    mv['x'][0, 0], mv['y'][0, 0] = -128, -128
+    mv['x'][1, 1], mv['y'][1, 1] = 127, -128
+    assert aggregate_motion_vectors(mv, 100) == 2 * BLOCK
+    assert aggregate_motion_vectors(mv, 181) == BLOCK
+
+
+def test_roi():
+    mv = motion_vectors(4, 5)
+    mv['x'][0, 0] = 10
+    mv['x'][2, 3] = 10
+    mv['x'][3, 4] = 10
+    # the box reaches into the macroblocks in rows 1-2 and columns 2-3 without covering them
+    roi = parse_roi('40,20,50,47')
+    assert roi_to_blocks(roi) == (slice(1, 3), slice(2, 4))
+    assert aggregate_motion_vectors(mv, 5, roi) == BLOCK
+    assert aggregate_motion_vectors(mv, 5) == 3 * BLOCK
+
+
+def test_parse_roi():
+    assert parse_roi(None) is None and parse_roi(' None ') is None and parse_roi('') is None
+    assert parse_roi('1,2,30,40') == (1, 2, 30, 40)
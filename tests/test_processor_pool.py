@@ -0,0 +1,94 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+
+from imageProcessing.image_processing import FrameSequencer, ImageProcessor, ProcessorPool
+
+WIDTH, HEIGHT = 32, 16
+
+
+class RecordingWriter:
+    """ Stands in for the ImageWriter, and fails if an image is saved once it's closed. """
+
+    def __init__(self):
+        self.saved = []
+        self.closed = False
+
+    def save(self, subdir, frame_no, image, timestamp):
+        assert not self.closed, 'image saved after the writer was closed'
+        self.saved.append(frame_no)
+
+    def close(self):
+        self.closed = True
+
+
+def current_image():
+    return SimpleNamespace(imaging_parameters={'save_images': True, 'save_processed_images': False},
+                           image_processing_mode='none', arenas=None, width=WIDTH, height=HEIGHT,
+                           fwidth=WIDTH, fheight=HEIGHT, raw_resolution=lambda resolution, splitter=False: resolution)
+
+
+def test_exit_waits_for_busy_processors(monkeypatch):
+    started, proceed = threading.Event(), threading.Event()
+
+    def process(self, im, frame_no, timestamp):
+        started.set()
+        proceed.wait(5)
+        self.owner.writer.save('unprocessed', frame_no, im, timestamp)
+        self.release(frame_no, timestamp, None)
+
+    monkeypatch.setattr(ImageProcessor, 'process', process)
+    monkeypatch.setattr('imageProcessing.image_processing.image_writer_from_parameters',
+                        lambda imaging_parameters: RecordingWriter())
+    pool = ProcessorPool(2, current_image(), [], threading.Lock(), [], threading.Lock(), channels=1)
+    pool.write(bytes(WIDTH * HEIGHT))
+    pool.flush()
+    assert started.wait(5)
+
+    exiting = threading.Thread(target=pool.exit)
+    exiting.start()
+    time.sleep(0.2)
+    # the busy processor still has the writer, so it mustn't be closed yet
+    assert exiting.is_alive() and not pool.writer.closed
+    proceed.set()
+    exiting.join(10)
+    assert not exiting.is_alive()
+    assert pool.writer.saved == [1] and pool.writer.closed
+    assert not any(proc.is_alive() for proc in pool.processors)
+
+
+class ArenaKernel:
+    """ Returns its arena's number and the change in the arena's top left pixel, noting the thread it ran on. """
+
+    def __init__(self, arena, threads):
+        self.arena = arena
+        self.threads = threads
+
+    def __call__(self, im1, im2, frame_no):
+        self.threads.add(threading.current_thread().name)
+        return self.arena, int(im2[0, 0]) - int(im1[0, 0])
+
+
+def test_arenas_are_analysed_on_the_arena_threads():
+    arenas = [(0, 0, 16, 8), (16, 0, 32, 8), (0, 8, 16, 16), (16, 8, 32, 16)]
+    threads = set()
+    released = []
+    owner = SimpleNamespace(sequencer=FrameSequencer(lambda frame_no, timestamp, result:
+                                                     released.append((frame_no, result))),
+                            cur_image=SimpleNamespace(roi=None, arenas=arenas),
+                            arena_executor=ThreadPoolExecutor(max_workers=2, thread_name_prefix='arena'))
+    processor = ImageProcessor.__new__(ImageProcessor)
+    processor.owner = owner
+    processor.arena_kernels = [ArenaKernel(i, threads) for i in range(len(arenas))]
+    for frame_no in (1, 2):
+        im = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+        for i, (x0, y0, x1, y1) in enumerate(arenas):
+            im[y0:y1, x0:x1] = frame_no * (i + 1)
+        processor.add_delta_frame(frame_no, 0, im)
+    owner.arena_executor.shutdown()
+    # one result per arena, in arena order, whichever thread finished first
+    assert released == [(1, None), (2, [(0, 1), (1, 2), (2, 3), (3, 4)])]
+    assert threads and all(name.startswith('arena') for name in threads)
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from imageProcessing.tracking import MultiWormTracker, greedy_assignment, iou_matrix
+
+
+def box(x, y, size=20):
+    return [x, y, x + size, y + size]
+
+
+def test_greedy_assignment_takes_the_best_pairs_first():
+    scores = np.array([[0.9, 0.8, 0.0],
+                       [0.85, 0.5, 0.0],
+                       [0.0, 0.6, 0.05]])
+    rows, cols = greedy_assignment(scores, min_score=0.1)
+    # (0, 0) goes first, so row 1 loses its best column, and column 1 goes to row 2, which scores higher there
+    assert sorted(zip(rows.tolist(), cols.tolist())) == [(0, 0), (2, 1)]
+
+
+def test_greedy_assignment_of_nothing():
+    for shape in ((0, 3), (3, 0), (0, 0)):
+        rows, cols = greedy_assignment(np.zeros(shape), min_score=0.1)
+        assert len(rows) == len(cols) == 0
+    rows, cols = greedy_assignment(np.full((2, 2), 0.05), min_score=0.1)
+    assert len(rows) == 0
+
+
+def test_greedy_assignment_matches_one_at_a_time_matching():
+    rng = np.random.default_rng(1)
+    for i in range(500):
+        # rounded so there are ties, which are broken the same way
+        scores = np.round(rng.random(rng.integers(0, 8, 2)), 1)
+        expected = set()
+        used_rows, used_cols = set(), set()
+        candidates = sorted(zip(*np.nonzero(scores >= 0.3)), key=lambda pair: -scores[pair])
+        for row, col in candidates:
+            if row not in used_rows and col not in used_cols:
+                used_rows.add(row)
+                used_cols.add(col)
+                expected.add((row, col))
+        rows, cols = greedy_assignment(scores, min_score=0.3)
+        assert set(zip(rows.tolist(), cols.tolist())) == expected
+
+
+def test_iou_matrix():
+    iou = iou_matrix(np.array([box(0, 0), box(100, 100)], dtype=float), np.array([box(10, 0)], dtype=float))
+    assert iou[:, 0] == pytest.approx([200 / 600, 0])
+
+
+def test_tracks_follow_worms_that_swap_rank():
+    tracker = MultiWormTracker(min_iou=0.1)
+    # the neural net lists boxes from the highest score down, and the worms' scores swap from frame to frame
+    tracker.update(1, 0.0, [box(100, 100), box(300, 300)])
+    first = tracker.designated
+    for frame_no in range(2, 8):
+        step = 2 * (frame_no - 1)
+        worm_a, worm_b = box(100 + step, 100), box(300, 300 - step)
+        boxes = [worm_b, worm_a] if frame_no % 2 == 0 else [worm_a, worm_b]
+        motions = tracker.update(frame_no, frame_no * 0.1, boxes)
+        # each worm keeps its track and only its own small movement is measured
+        assert sorted(motions) == [1, 2]
+        assert motions[1] == pytest.approx(2) and motions[2] == pytest.approx(2)
+        assert tracker.designated == first == 1
+        assert tracker.designated_center() == pytest.approx((110 + step, 110))
+    assert tracker.next_id == 3
+
+
+def test_lost_tracks_hand_over_the_leds():
+    tracker = MultiWormTracker(min_iou=0.1, max_misses=2)
+    tracker.update(1, 0, [box(100, 100)])
+    tracker.update(2, 0, [box(100, 100), box(300, 300)])
+    for frame_no in range(3, 6):
+        tracker.update(frame_no, 0, [box(300, 300)])
+    # track 1 was missed for more than max_misses frames, so track 2 took over
+    assert tracker.ids.tolist() == [2]
+    assert tracker.designated == 2